@@ -0,0 +1,432 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Google Inc. All Rights Reserved.
+"""
+  imap_benchmark.py
+
+DESCRIPTION:
+  Measures the throughput of IMAPConnection and of the Gmail IMAP tools in
+  this directory against a local FakeGmailIMAPServer, so that changes to
+  their hot paths can be compared in numbers without a live Gmail account.
+
+  For each mailbox size, every benchmark runs in its own process against a
+  freshly started server, which runs in another process so the two don't
+  compete for the interpreter lock. Messages reinjected by imap_reinjector
+  go to a null SMTP sink, and documents created by imap_to_drive to a null
+  Drive sink. A benchmark that runs longer than --time_limit seconds is
+  stopped and reported as timed out.
+
+  For each run the elapsed time, messages per second, peak memory of the
+  benchmark process and the number of each IMAP command sent are reported.
+
+  Benchmarks:
+    search             IMAPConnection.GetMessageLocatorsInLabel
+    get_message        IMAPConnection.GetMessage, once per message
+    fetch_headers      IMAPConnection.FetchMessages of the Message-ID header
+    fetch_messages     IMAPConnection.FetchMessages of whole messages
+    store_labels       IMAPConnection.StoreLabels on every message
+    duplicate_check    imap_duplicate_check for one user
+    reinjector         imap_reinjector.ImapSearch with --threads threads
+    to_drive           imap_to_drive.ImapSearch for one user
+
+USAGE:
+  ./imap_benchmark.py --sizes 1000,100000 --latency 0.02 \
+      --benchmarks fetch_headers,duplicate_check --output_file results.json
+
+DEPENDENCIES:
+  Use of this tool requires the supplementary Python libraries in
+  apps/python/lib, including FakeGmailIMAPServer.py and IMAPConnection.py,
+  to be importable. The imap_duplicate_check and imap_to_drive benchmarks
+  also require the gdata library they import; they are reported as skipped
+  if it is not installed.
+
+LICENSING:
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+###########################################################################
+DISCLAIMER:
+
+(i) GOOGLE INC. ("GOOGLE") PROVIDES YOU ALL CODE HEREIN "AS IS" WITHOUT ANY
+WARRANTIES OF ANY KIND, EXPRESS, IMPLIED, STATUTORY OR OTHERWISE, INCLUDING,
+WITHOUT LIMITATION, ANY IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NON-INFRINGEMENT; AND
+
+(ii) IN NO EVENT WILL GOOGLE BE LIABLE FOR ANY LOST REVENUES, PROFIT OR DATA,
+OR ANY DIRECT, INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE
+DAMAGES, HOWEVER CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, EVEN IF
+GOOGLE HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH DAMAGES, ARISING OUT OF
+THE USE OR INABILITY TO USE, MODIFICATION OR DISTRIBUTION OF THIS CODE OR ITS
+DERIVATIVES.
+###########################################################################
+"""
+
+import imaplib
+import json
+import logging
+import multiprocessing
+import os
+import Queue
+import resource
+import smtplib
+import sys
+import threading
+import time
+import types
+
+from FakeGmailIMAPServer import ALL_MAIL_LABEL
+from FakeGmailIMAPServer import DEFAULT_DUPLICATE_PERCENT
+from FakeGmailIMAPServer import DEFAULT_MESSAGE_SIZE
+from FakeGmailIMAPServer import FakeGmailIMAPServer
+from FakeGmailIMAPServer import SyntheticMailbox
+import IMAPConnection
+from optparse import OptionParser
+
+DEFAULT_SIZES = '1000,100000,1000000'
+
+# The label applied by the benchmarks that change messages
+BENCHMARK_LABEL = 'Benchmark'
+
+
+class NullSink(object):
+  """Counts the messages a tool delivers, and discards them."""
+
+  def __init__(self):
+    self.count = 0
+    self.lock = threading.Lock()
+
+  def Add(self):
+    self.lock.acquire()
+    try:
+      self.count += 1
+    finally:
+      self.lock.release()
+
+
+SINK = NullSink()
+
+
+class NullSMTP(object):
+  """Replaces smtplib.SMTP for imap_reinjector."""
+
+  def __init__(self, host='', port=0):
+    pass
+
+  def sendmail(self, sender, recipients, message):
+    SINK.Add()
+    return {}
+
+  def quit(self):
+    pass
+
+  def close(self):
+    pass
+
+
+class NullFolder(object):
+  def __init__(self, name, parent=None):
+    self.name = name
+    self.parent = parent
+    self.folder = None
+
+
+class NullDocsConnection(object):
+  """Replaces imap_to_drive.DocsConnection."""
+
+  def __init__(self, xoauth):
+    self.folder = None
+
+  def CreateFolder(self, name, owner=None, parent=None):
+    self.folder = NullFolder(name, parent)
+
+  def FolderComplete(self):
+    self.folder = self.folder.parent
+
+  def CreateDoc(self, name, content, owner=None):
+    SINK.Add()
+    return (True, False)
+
+
+def _ReplaceModule(module, **attributes):
+  """Returns a copy of module with some of its attributes replaced."""
+  replacement = types.ModuleType(module.__name__)
+  replacement.__dict__.update(module.__dict__)
+  replacement.__dict__.update(attributes)
+  return replacement
+
+
+def _ConnectTools(host, port):
+  """Points IMAPConnection, and tools that use imaplib directly, at host."""
+  IMAPConnection.IMAP_HOST = host
+  IMAPConnection.IMAP_PORT = port
+  IMAPConnection.IMAP_USE_SSL = False
+
+  def IMAP4_SSL(unused_host='', unused_port=0, *unused_args):
+    return imaplib.IMAP4(host, port)
+
+  return _ReplaceModule(imaplib, IMAP4_SSL=IMAP4_SSL)
+
+
+def _SpoolingIMAP4(unused_host='', unused_port=0, *unused_args):
+  """Replaces SpoolingIMAP4_SSL in tools, once _ConnectTools has run."""
+  return IMAPConnection.SpoolingIMAP4(IMAPConnection.IMAP_HOST,
+                                      IMAPConnection.IMAP_PORT)
+
+
+def _Connect(mailbox):
+  imap_connection = IMAPConnection.IMAPConnection(xoauth_string='benchmark',
+                                                  user=mailbox.user)
+  imap_connection.Select(ALL_MAIL_LABEL)
+  return imap_connection
+
+
+def BenchmarkSearch(mailbox, options):
+  imap_connection = _Connect(mailbox)
+  count = len(imap_connection.GetMessageLocatorsInLabel(ALL_MAIL_LABEL, ''))
+  imap_connection.Close()
+  return count
+
+
+def BenchmarkGetMessage(mailbox, options):
+  imap_connection = _Connect(mailbox)
+  count = 0
+  for locator in imap_connection.GetMessageLocatorsInLabel(ALL_MAIL_LABEL, ''):
+    if imap_connection.GetMessage(locator):
+      count += 1
+  imap_connection.Close()
+  return count
+
+
+def BenchmarkFetchHeaders(mailbox, options):
+  imap_connection = _Connect(mailbox)
+  locators = imap_connection.GetMessageLocatorsInLabel(ALL_MAIL_LABEL, '')
+  count = 0
+  for unused_message in imap_connection.FetchMessages(
+      locators, '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'):
+    count += 1
+  imap_connection.Close()
+  return count
+
+
+def BenchmarkFetchMessages(mailbox, options):
+  imap_connection = _Connect(mailbox)
+  locators = imap_connection.GetMessageLocatorsInLabel(ALL_MAIL_LABEL, '')
+  count = 0
+  for unused_message in imap_connection.FetchMessages(locators, '(RFC822)'):
+    count += 1
+  imap_connection.Close()
+  return count
+
+
+def BenchmarkStoreLabels(mailbox, options):
+  imap_connection = _Connect(mailbox)
+  locators = imap_connection.GetMessageLocatorsInLabel(ALL_MAIL_LABEL, '')
+  imap_connection.CreateLabel(BENCHMARK_LABEL)
+  imap_connection.StoreLabels(locators, BENCHMARK_LABEL)
+  imap_connection.Close()
+  return len(locators)
+
+
+def BenchmarkDuplicateCheck(mailbox, options):
+  import imap_duplicate_check
+
+  imap_duplicate_check.SpoolingIMAP4_SSL = _SpoolingIMAP4
+  worker = imap_duplicate_check.Worker(
+      'benchmark', 'benchmark', None, None, 'example.com', None, None, 0, 0,
+      False, BENCHMARK_LABEL, 0)
+  worker._ProcessUser(imap_duplicate_check.Instruction(mailbox.user))
+  return mailbox.message_count
+
+
+def BenchmarkReinjector(mailbox, options):
+  import imap_reinjector
+
+  imap_reinjector.smtplib = _ReplaceModule(smtplib, SMTP=NullSMTP)
+  imap_reinjector.ImapSearch('benchmark', '', completed_label=BENCHMARK_LABEL,
+                             threads=options.threads, user=mailbox.user)
+  return SINK.count
+
+
+def BenchmarkToDrive(mailbox, options):
+  import imap_to_drive
+
+  imap_to_drive.imaplib = options.imaplib
+  imap_to_drive.DocsConnection = NullDocsConnection
+  xoauth = imap_to_drive.XOAuthInfo(mailbox.user, 'benchmark', 'benchmark')
+  imap_to_drive.ImapSearch(mailbox.user, xoauth, None, '', None, 0)
+  return SINK.count
+
+
+BENCHMARKS = [
+    ('search', BenchmarkSearch),
+    ('get_message', BenchmarkGetMessage),
+    ('fetch_headers', BenchmarkFetchHeaders),
+    ('fetch_messages', BenchmarkFetchMessages),
+    ('store_labels', BenchmarkStoreLabels),
+    ('duplicate_check', BenchmarkDuplicateCheck),
+    ('reinjector', BenchmarkReinjector),
+    ('to_drive', BenchmarkToDrive),
+]
+
+
+def _CreateMailbox(size, options):
+  return SyntheticMailbox(size, message_size=options.message_size,
+                          duplicate_percent=options.duplicate_percent)
+
+
+def _Serve(size, options, pipe):
+  """Runs a FakeGmailIMAPServer until told to stop, in its own process."""
+  server = FakeGmailIMAPServer(_CreateMailbox(size, options),
+                               latency=options.latency)
+  server.Start()
+  pipe.send((server.host, server.port))
+  pipe.recv()
+  server.Stop()
+  pipe.send(server.GetCommandCounts())
+
+
+def _Run(function, size, host, port, options, results):
+  """Runs one benchmark and reports its result, in its own process."""
+  # Tools print their own progress; only the benchmark results matter here
+  sys.stdout = open(os.devnull, 'w')
+  logging.basicConfig(level=logging.CRITICAL)
+
+  options.imaplib = _ConnectTools(host, port)
+  mailbox = _CreateMailbox(size, options)
+
+  start = time.time()
+  try:
+    count = function(mailbox, options)
+  except ImportError, e:
+    results.put({'error': 'skipped: %s' % e})
+    return
+  except Exception, e:
+    results.put({'error': 'failed: %s' % e})
+    return
+  elapsed = time.time() - start
+
+  results.put({'messages': count,
+               'seconds': elapsed,
+               'messages_per_second': count / max(elapsed, 0.000001),
+               'peak_rss_mb': resource.getrusage(
+                   resource.RUSAGE_SELF).ru_maxrss / 1024.0})
+
+
+def RunBenchmark(name, function, size, options):
+  """Runs a benchmark against a new server for a mailbox of size messages.
+
+  Returns:
+    A dictionary describing the run.
+  """
+  (pipe, server_pipe) = multiprocessing.Pipe()
+  server = multiprocessing.Process(target=_Serve,
+                                   args=(size, options, server_pipe))
+  server.start()
+  (host, port) = pipe.recv()
+
+  results = multiprocessing.Queue()
+  runner = multiprocessing.Process(
+      target=_Run, args=(function, size, host, port, options, results))
+  runner.start()
+  runner.join(options.time_limit)
+  if runner.is_alive():
+    runner.terminate()
+    runner.join()
+    result = {'error': 'timed out after %ss' % options.time_limit}
+  else:
+    try:
+      result = results.get(timeout=1)
+    except Queue.Empty:
+      result = {'error': 'failed: exit code %s' % runner.exitcode}
+
+  pipe.send('stop')
+  result['commands'] = pipe.recv()
+  server.join()
+
+  result.update({'benchmark': name, 'size': size, 'latency': options.latency})
+  return result
+
+
+def FormatResult(result):
+  if 'error' in result:
+    summary = result['error']
+  else:
+    summary = '%8.1fs %10.1f msg/s %8.1f MB' % (
+        result['seconds'], result['messages_per_second'],
+        result['peak_rss_mb'])
+  commands = ' '.join(['%s=%s' % (name, count) for (name, count) in
+                       sorted(result['commands'].items())])
+  return '%-16s %9s  %s  [%s]' % (result['benchmark'], result['size'],
+                                  summary, commands)
+
+
+def ParseInputs():
+  """Interprets command line parameters.
+
+  Returns:
+    The options object of parsed command line options.
+  """
+
+  parser = OptionParser()
+  parser.add_option('--sizes', dest='sizes', default=DEFAULT_SIZES,
+                    help='Comma-separated mailbox sizes to benchmark. '
+                    'Default = %s' % DEFAULT_SIZES)
+  parser.add_option('--benchmarks', dest='benchmarks',
+                    default=','.join([name for (name, unused) in BENCHMARKS]),
+                    help='Comma-separated benchmarks to run. Default = all')
+  parser.add_option('--latency', dest='latency', default=0.0, type='float',
+                    help='Seconds added to every IMAP response. Default = 0')
+  parser.add_option('--message_size', dest='message_size',
+                    default=DEFAULT_MESSAGE_SIZE, type='int',
+                    help='The size of each message in bytes. Default = %s'
+                    % DEFAULT_MESSAGE_SIZE)
+  parser.add_option('--duplicate_percent', dest='duplicate_percent',
+                    default=DEFAULT_DUPLICATE_PERCENT, type='int',
+                    help='The percentage of duplicated messages. Default = %s'
+                    % DEFAULT_DUPLICATE_PERCENT)
+  parser.add_option('--threads', dest='threads', default=10, type='int',
+                    help='The number of threads imap_reinjector uses. '
+                    'Default = 10')
+  parser.add_option('--time_limit', dest='time_limit', default=600,
+                    type='int',
+                    help='Seconds after which a benchmark is stopped. '
+                    'Default = 600')
+  parser.add_option('--output_file', dest='output_file', default=None,
+                    help='[OPTIONAL] A file to write the results to as JSON')
+
+  (options, args) = parser.parse_args()
+  if args:
+    parser.print_help()
+    parser.exit(msg='\nUnexpected arguments: %s\n' % ' '.join(args))
+
+  known = dict(BENCHMARKS)
+  for name in options.benchmarks.split(','):
+    if name not in known:
+      parser.exit(msg='Unknown benchmark: %s\n' % name)
+
+  return options
+
+
+def main():
+  options = ParseInputs()
+
+  known = dict(BENCHMARKS)
+  results = []
+  for size in [int(size) for size in options.sizes.split(',')]:
+    for name in options.benchmarks.split(','):
+      result = RunBenchmark(name, known[name], size, options)
+      print FormatResult(result)
+      sys.stdout.flush()
+      results.append(result)
+
+  if options.output_file:
+    output_file = open(options.output_file, 'w')
+    json.dump(results, output_file, indent=2, sort_keys=True)
+    output_file.close()
+
+
+if __name__ == '__main__':
+  main()
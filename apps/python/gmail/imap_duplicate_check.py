@@ -67,29 +67,241 @@ Example #4: For a specific user, leave one copy of duplicates
                           --specific_user=mdauphinee@mdauphinee.info \
                           -l Duplicates \
                           --modify_messages
+
+Example #5: For a specific user, treat messages as duplicates when their
+            headers and body match, whatever their Message-IDs
+./imap_duplicate_check.py -u administrator \
+                          -p mypass \
+                          -d mdauphinee.info \
+                          -k mdauphinee.info \
+                          -s "2IxnnYqrkMKgqCMCTGxq" \
+                          --specific_user=mdauphinee@mdauphinee.info \
+                          --dedup_key=content
+
+Duplicates are found with one of these --dedup_key values:
+  message_id  The Message-ID header (the default). Messages without one
+              are not checked.
+  gm_thrid    The Message-ID header within an X-GM-THRID conversation, so
+              unrelated messages that reuse a Message-ID aren't matched.
+  content     A hash of the From, To, Cc, Subject and Date headers and the
+              body, with whitespace and line endings normalized.
+Only a fixed-size digest of each key is kept, so memory per message doesn't
+depend on the length of the headers. Bodies larger than 64KB are streamed
+into temporary files and hashed from there a line at a time, so content
+doesn't hold more than a fetch of small messages in memory either.
+Gmail's own X-GM-MSGID can't be used as a key: All Mail holds each message
+once whatever its labels, so no two messages there ever share one. Use
+gm_thrid to key messages by Gmail's conversation instead.
+
+Example #6: For all users, keep the index of each mailbox on disk, so that
+            running again only checks messages that arrived since
+./imap_duplicate_check.py -u administrator \
+                          -p mypass \
+                          -d mdauphinee.info \
+                          -k mdauphinee.info \
+                          -s "2IxnnYqrkMKgqCMCTGxq" \
+                          -t 10 \
+                          --index_dir=duplicate_index
+
+The digests seen are held in a compact in-memory table by default
+(--index=memory, about 16 bytes a message), or in a temporary SQLite file
+with --index=sqlite for mailboxes too large for that. With --index_dir an
+SQLite file per user is kept there with the UIDVALIDITY and last UID of
+the last complete run, and later runs only check newer messages against
+it; duplicate counts then cover the copies found by the current run plus
+the first copy.
+
+Example #7: For all users, write the number and total size of each user's
+            duplicates to a CSV file, and log the 20 users with the most
+./imap_duplicate_check.py -u administrator \
+                          -p mypass \
+                          -d mdauphinee.info \
+                          -k mdauphinee.info \
+                          -s "2IxnnYqrkMKgqCMCTGxq" \
+                          -t 10 \
+                          --stats_file=duplicates.csv \
+                          --top_n=20
+
+A --stats_file ending in .json also holds the domain totals and the top
+--top_n users.
+
+Dependencies:
+  Use of this tool requires a supplementary Python library to handle XOAuth
+  authentication and authorization. This library can be found at:
+    https://code.google.com/p/enterprise-deployments/source/browse/trunk/
+        apps/python/lib/XOAuth.py
+
+  Use of this tool requires a supplementary Python library to parse IMAP
+  responses. This library can be found at:
+    https://code.google.com/p/enterprise-deployments/source/browse/trunk/
+        apps/python/lib/IMAPConnection.py
+
+  Use of this tool requires a supplementary Python library to index message
+  digests. This library can be found at:
+    https://code.google.com/p/enterprise-deployments/source/browse/trunk/
+        apps/python/lib/DigestIndex.py
 """
 
 
-import base64
+import binascii
+import csv
 from datetime import datetime
 import hashlib
-import hmac
-import imaplib
+import itertools
+import json
 import logging
 from optparse import OptionParser
+import os
 import Queue
-import random
 import re
+import StringIO
 import sys
 import threading
 import time
-import urllib
 import gdata.apps.service
 
+from DigestIndex import DigestSet
+from DigestIndex import SQLiteDigestIndex
+from IMAPConnection import CompressUidSet
+from IMAPConnection import DEFAULT_FETCH_CHUNK_SIZE
+from IMAPConnection import DEFAULT_STORE_CHUNK_SIZE
+from IMAPConnection import ParseFetchResponse
+from IMAPConnection import SpoolingIMAP4_SSL
+from XOAuth import XOAuth
+
 # The maximum seconds to sustain an open IMAP connection
 # before reconnecting
 IMAP_CONNECTION_MAX_LENGTH = 300
 
+# The number of messages whose bodies --dedup_key content fetches at once
+CONTENT_FETCH_CHUNK_SIZE = 50
+
+# Message literals larger than this many bytes, e.g. the bodies fetched by
+# --dedup_key content, are streamed into temporary files rather than held in
+# memory
+KEY_SPOOL_THRESHOLD = 64 * 1024
+
+# The headers hashed along with the body by --dedup_key content
+CONTENT_HEADER_FIELDS = ('FROM', 'TO', 'CC', 'SUBJECT', 'DATE')
+
+# Continuation lines of a folded header field
+HEADER_FOLDING_PATTERN = re.compile(r'\r?\n(?=[ \t])')
+
+
+def _GetHeaderText(attributes):
+  """Returns the header section of a parsed FETCH response, or ''."""
+  for (name, value) in attributes.iteritems():
+    if name.startswith('BODY[HEADER') and value:
+      if isinstance(value, basestring):
+        return value
+      try:
+        return value.read()
+      finally:
+        value.close()
+  return ''
+
+
+def ParseHeaderFields(header_text):
+  """Returns the (name, value) of each field in a header, unfolded."""
+  fields = []
+  for line in HEADER_FOLDING_PATTERN.sub('', header_text).splitlines():
+    if ':' in line:
+      (name, value) = line.split(':', 1)
+      fields.append((name.strip(), ' '.join(value.split())))
+  return fields
+
+
+def GetMessageIdKey(attributes):
+  """Keys a message by the text of its Message-ID header."""
+  message_id = _GetHeaderText(attributes).strip(' \t\n\r')
+  if not message_id:
+    return (None, '')
+  return (hashlib.md5(message_id).digest(), message_id)
+
+
+def GetGmailThreadKey(attributes):
+  """Keys a message by its Message-ID header within its X-GM-THRID."""
+  message_id = _GetHeaderText(attributes).strip(' \t\n\r')
+  thread_id = attributes.get('X-GM-THRID')
+  if not message_id or not thread_id:
+    return (None, message_id)
+  return (hashlib.md5('%s %s' % (thread_id, message_id)).digest(), message_id)
+
+
+def GetContentKey(attributes):
+  """Keys a message by a hash of its normalized headers and body.
+
+  Field names are lower-cased, whitespace within values is collapsed and
+  the fields are sorted; line endings and trailing whitespace of the body
+  are normalized. The Message-ID is not hashed, only used to describe the
+  message. A body spooled to a temporary file is hashed from it a line at a
+  time, and closed.
+  """
+  body = attributes.get('BODY[TEXT]')
+  if body is None:
+    return (None, '')
+  if isinstance(body, basestring):
+    body = StringIO.StringIO(body)
+
+  description = ''
+  fields = []
+  for (name, value) in ParseHeaderFields(_GetHeaderText(attributes)):
+    if name.upper() == 'MESSAGE-ID':
+      description = '%s: %s' % (name, value)
+    else:
+      fields.append('%s: %s' % (name.lower(), value))
+  fields.sort()
+
+  digest = hashlib.md5('\n'.join(fields))
+  digest.update('\n\n')
+
+  # Blank lines are only hashed once a line with text follows them, so
+  # that trailing whitespace at the end of the body is ignored
+  separator = ''
+  blank_lines = 0
+  try:
+    for file_line in body:
+      for line in file_line.splitlines():
+        line = line.rstrip()
+        if line:
+          digest.update(separator + '\n' * blank_lines + line)
+          separator = '\n'
+          blank_lines = 0
+        else:
+          blank_lines += 1
+  finally:
+    body.close()
+
+  digest = digest.digest()
+  return (digest, description or 'content %s' % binascii.hexlify(digest))
+
+
+# For each --dedup_key, the data items fetched for every message, the number
+# of messages fetched at once and the function turning a parsed FETCH
+# response into a (digest, description) pair. The digest is None for
+# messages that can't be keyed.
+DEDUP_KEYS = {
+    'message_id': ('BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]',
+                   DEFAULT_FETCH_CHUNK_SIZE, GetMessageIdKey),
+    'gm_thrid': ('X-GM-THRID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]',
+                 DEFAULT_FETCH_CHUNK_SIZE, GetGmailThreadKey),
+    'content': ('BODY.PEEK[HEADER.FIELDS (MESSAGE-ID %s)] BODY.PEEK[TEXT]' %
+                ' '.join(CONTENT_HEADER_FIELDS), CONTENT_FETCH_CHUNK_SIZE,
+                GetContentKey),
+}
+DEFAULT_DEDUP_KEY = 'message_id'
+
+# Where the digests seen are kept, when not in --index_dir
+INDEX_TYPES = ('memory', 'sqlite')
+DEFAULT_INDEX_TYPE = 'memory'
+
+# The columns of --stats_file, with a row for each user
+STATS_FIELDS = ('user', 'messages', 'unkeyed_messages', 'duplicate_keys',
+                'duplicate_messages', 'duplicate_bytes')
+
+# The number of users with the most duplicates logged with --stats_file
+DEFAULT_TOP_N = 10
+
 
 class Instruction(object):
 
@@ -108,7 +320,9 @@ class Worker(threading.Thread):
 
   def __init__(self, consumer_key, consumer_secret, admin_user, admin_pass,
                domain, work_queue, failure_queue, max_retry, max_failures,
-               modify_messages, label_to_add, imap_debug_level):
+               modify_messages, label_to_add, imap_debug_level,
+               dedup_key=DEFAULT_DEDUP_KEY, index_type=DEFAULT_INDEX_TYPE,
+               index_dir=None, stats_queue=None):
 
     threading.Thread.__init__(self)
     self.consumer_key = consumer_key
@@ -123,6 +337,10 @@ class Worker(threading.Thread):
     self.modify_messages = modify_messages
     self.label_to_add = label_to_add
     self.imap_debug_level = imap_debug_level
+    self.dedup_key = dedup_key
+    self.index_type = index_type
+    self.index_dir = index_dir
+    self.stats_queue = stats_queue
 
   def run(self):
     """Main worker that manages the jobs and applies changes for each user."""
@@ -158,8 +376,33 @@ class Worker(threading.Thread):
       # signals to queue job is done
       self.work_queue.task_done()
 
+  def _OpenIndex(self, user, uidvalidity):
+    """Returns an index for the digests of user's messages and the first UID.
+
+    With index_dir the index is kept in a file per user, and only messages
+    with UIDs above the last complete run's are checked, unless the
+    mailbox's UIDVALIDITY or the dedup_key have changed since.
+    """
+    if not self.index_dir:
+      if self.index_type == 'sqlite':
+        return (SQLiteDigestIndex(), 1)
+      return (DigestSet(), 1)
+
+    index = SQLiteDigestIndex(os.path.join(self.index_dir, '%s.sqlite' % user))
+    if (index.GetState('uidvalidity') == str(uidvalidity) and
+        index.GetState('dedup_key') == self.dedup_key):
+      first_uid = int(index.GetState('last_uid', 0)) + 1
+      logging.info('Checking messages of [%s] from UID [%d]', user, first_uid)
+      return (index, first_uid)
+
+    index.Clear()
+    index.SetState('uidvalidity', uidvalidity)
+    index.SetState('dedup_key', self.dedup_key)
+    return (index, 1)
+
   def _ProcessUser(self, task):
 
+    index = None
     try:
       imap_conn = ImapConnectionManager(task.GetUserName(),
                                         self.label_to_add,
@@ -174,20 +417,31 @@ class Worker(threading.Thread):
                      self.label_to_add, task.GetUserName())
         imap_conn.CreateLabel()
 
+      (index, first_uid) = self._OpenIndex(task.GetUserName(),
+                                           imap_conn.uidvalidity)
+
       # Get a list of the UIDs for the messages
-      message_locators = imap_conn.GetMessageLocators()
+      message_locators = imap_conn.GetMessageLocators(first_uid)
       logging.info('Found [%d] messages for user [%s]',
                    len(message_locators), task.GetUserName())
 
-      # Initialize a dict for counting the number of times
-      # we see a Message ID
-      message_hash = {}
+      # For the digests of keys seen more than once, a [description, count]
+      # pair; the index holds every digest seen
+      duplicates = {}
+
+      # The UIDs of the messages to label, all at once after the scan
+      duplicate_locators = []
 
       # Initialize a counter to print after every x
       # as a status meter
       message_count = 0
+      unkeyed_count = 0
+      duplicate_count = 0
+      duplicate_bytes = 0
 
-      for message_locator in message_locators:
+      for (message_locator, key, message_id,
+           message_size) in imap_conn.GetMessageKeys(message_locators,
+                                                     self.dedup_key):
         message_count += 1
 
         # Print a heartbeat to let the user know it is running
@@ -195,37 +449,72 @@ class Worker(threading.Thread):
           logging.info('Retreived [%d] message IDs for [%s]',
                        message_count, task.GetUserName())
 
-        message_id = imap_conn.GetMessageId(message_locator)
+        # Messages without a key (e.g. no Message-ID) can't be compared
+        if key is None:
+          unkeyed_count += 1
+          continue
 
-        # Using a try/except here for optimization
-        # per the instructions here: http://wiki.python.org/moin/PythonSpeed/PerformanceTips
-        # under "Initializing Dictionary Elements"
-        try:
-          message_hash[message_id] += 1
+        if index.Add(key):
+          duplicate_count += 1
+          duplicate_bytes += message_size
+          try:
+            duplicates[key][1] += 1
+          except KeyError:
+            duplicates[key] = [message_id, 2]
           # Add the desired label to all duplicates found
           # NOTE: The first message in the set will *not* get the label
           if self.label_to_add:
             if self.modify_messages:
               logging.info('Adding label [%s] to message [%s] for user [%s]',
                            self.label_to_add, message_id, task.GetUserName())
-              imap_conn.AddLabel(message_locator)
+              duplicate_locators.append(message_locator)
             else:
               logging.info('Would have applied label [%s] to message [%s]',
                            self.label_to_add, message_id)
-        except KeyError:
-          # First messageID found will not be labeled
-          message_hash[message_id] = 1
+        # First message found with a key will not be labeled
+
+      imap_conn.AddLabel(duplicate_locators)
+
+      if unkeyed_count:
+        logging.info('Skipped [%d] messages without a [%s] key for [%s]',
+                     unkeyed_count, self.dedup_key, task.GetUserName())
 
-      for msgid in message_hash.keys():
-        if message_hash[msgid] > 1:
-          logging.warning('DUPLICATE FOUND for [%s]: [%s] [%s] times',
-                          task.GetUserName(), msgid, message_hash[msgid])
+      for (msgid, count) in duplicates.itervalues():
+        logging.warning('DUPLICATE FOUND for [%s]: [%s] [%s] times',
+                        task.GetUserName(), msgid, count)
+
+      # Only a complete scan is remembered, so that the messages that were
+      # skipped are checked again next time
+      if self.index_dir:
+        if imap_conn.skipped_messages:
+          logging.warning('Not saving the index of [%s], [%d] messages were '
+                          'skipped', task.GetUserName(),
+                          imap_conn.skipped_messages)
+        else:
+          if message_locators:
+            index.SetState('last_uid', max([int(message_locator) for
+                                            message_locator in
+                                            message_locators]))
+          index.Commit()
+
+      # Each worker reports a user's totals once it is done with them, and
+      # main() adds them up after the run
+      if self.stats_queue is not None:
+        self.stats_queue.put({'user': task.GetUserName(),
+                              'messages': message_count,
+                              'unkeyed_messages': unkeyed_count,
+                              'duplicate_keys': len(duplicates),
+                              'duplicate_messages': duplicate_count,
+                              'duplicate_bytes': duplicate_bytes})
 
       imap_conn.Logout()
     except Exception, err:
       logging.error('\t[%s] Error processing user [%s]: %s',
                     self.name, task.GetUserName(), str(err))
       raise
+    finally:
+      if index is not None:
+        index.Close()
 
 
 def ParseInputs():
@@ -272,6 +561,28 @@ def ParseInputs():
   parser.add_option('--modify_messages', action='store_true',
                     default=False, dest='modify_messages',
                     help='Unless present, script will run in read only mode.')
+  parser.add_option('--dedup_key', dest='dedup_key',
+                    default=DEFAULT_DEDUP_KEY,
+                    help="""[OPTIONAL] What makes two messages duplicates:
+                            message_id, gm_thrid or content.
+                            Default = message_id""")
+  parser.add_option('--index', dest='index_type', default=DEFAULT_INDEX_TYPE,
+                    help="""[OPTIONAL] Where to keep the digests of messages
+                            seen: memory, or sqlite for a temporary file.
+                            Default = memory""")
+  parser.add_option('--index_dir', dest='index_dir',
+                    help="""[OPTIONAL] A directory to keep an SQLite index
+                            of each user's messages in between runs, so
+                            that only new messages are checked.""")
+  parser.add_option('--stats_file', dest='stats_file',
+                    help="""[OPTIONAL] A file to write the number and size of
+                            each user's duplicates to, as JSON if the name
+                            ends in .json and CSV otherwise.""")
+  parser.add_option('--top_n', dest='top_n', default=DEFAULT_TOP_N,
+                    type='int',
+                    help="""[OPTIONAL] The number of users with the most
+                            duplicates to report with --stats_file.
+                            Default = 10""")
 
   (options, args) = parser.parse_args()
   if args:
@@ -294,6 +605,12 @@ def ParseInputs():
   if options.consumer_secret is None:
     print '-s (consumer_secret) is required'
     invalid_args = True
+  if options.dedup_key not in DEDUP_KEYS:
+    print '--dedup_key must be one of %s' % ', '.join(sorted(DEDUP_KEYS))
+    invalid_args = True
+  if options.index_type not in INDEX_TYPES:
+    print '--index must be one of %s' % ', '.join(INDEX_TYPES)
+    invalid_args = True
 
   if invalid_args:
     sys.exit(4)
@@ -317,28 +634,27 @@ class ImapConnectionManager(object):
 
   def __init__(self, user, label_to_add, consumer_key,
                consumer_secret, debug_level):
-    self.consumer_key = consumer_key
-    self.consumer_secret = consumer_secret
+    self.xoauth = XOAuth(consumer_key, consumer_secret)
     self.user = user
     self.debug_level = debug_level
     self.connection = None
     self.connection_start = datetime(1, 1, 1)
     self.label_to_add = label_to_add
+    self.uidvalidity = None
+    self.skipped_messages = 0
+    self.spool_threshold = None
     self.list_response_pattern = re.compile(
         r'\((?P<flags>.*?)\) "(?P<delimiter>.*)" (?P<name>.*)')
 
   def Login(self):
-    xoauth_string = self._GenerateXOauthString(self.consumer_key,
-                                               self.consumer_secret,
-                                               self.user,
-                                               'GET',
-                                               'imap')
+    xoauth_string = self.xoauth.GetXOAuthString(self.user, 'GET', 'imap')
 
     ## Setup the IMAP connection and authenticate using OAUTH
     logging.info('[%s] Attempting to login to mailbox', self.user)
     self.connection_start = datetime.now()
-    self.connection = imaplib.IMAP4_SSL('imap.gmail.com', 993)
+    self.connection = SpoolingIMAP4_SSL('imap.gmail.com', 993)
     self.connection.debug = self.debug_level
+    self.connection.spool_threshold = self.spool_threshold
     try:
       self.connection.authenticate('XOAUTH', lambda x: xoauth_string)
       logging.info('[%s] IMAP connection successfully created', self.user)
@@ -348,6 +664,7 @@ class ImapConnectionManager(object):
 
     logging.info('%s: Logged in to IMAP', datetime.now())
     self.connection.select(self._GetLocalizedLabelName('AllMail'))
+    self.uidvalidity = self.connection.response('UIDVALIDITY')[1][0]
     logging.info('%s: AllMail label selected', datetime.now())
 
   def _GetLocalizedLabelName(self, find_label):
@@ -369,32 +686,20 @@ class ImapConnectionManager(object):
       self.Logout()
       self.Login()
 
-  def AddLabel(self, message_locator):
-    self.connection.uid('COPY', message_locator, self.label_to_add)
-    #self.connection.expunge()
-
-  def CreateLabel(self):
-    self.connection.create(self.label_to_add)
-
-  def GetMessageLocators(self):
-    self._CheckRefresh()
-    logging.info('%s: Retrieving UIDs', datetime.now())
-    unused_type, data = self.connection.uid('SEARCH', 'X-GM-RAW', '')
-    return data[0].split()
-
-  def GetMessageId(self, message_locator):
-    self._CheckRefresh()
+  def _Uid(self, command, message_locators, *args):
+    """Runs a UID command on a set of messages, reconnecting on errors.
 
+    The command is tried up to five times, 3 seconds apart, and the last
+    exception is raised if it never succeeds.
+    """
     remaining_tries = 4
-    while remaining_tries >= 0:
+    while True:
       try:
-        (status, data) = self.connection.uid(
-            'FETCH', message_locator, '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
-
-        remaining_tries = -1
-      except Exception, e:
+        return self.connection.uid(command, CompressUidSet(message_locators),
+                                   *args)
+      except Exception:
         if remaining_tries == 0:
-          return ''
+          raise
         remaining_tries -= 1
         time.sleep(3)
         logging.info('%s:     Re-establishing IMAP connection',
@@ -402,9 +707,72 @@ class ImapConnectionManager(object):
         self.Logout()
         self.Login()
 
-    message_id = data[0][1]
-    message_id = message_id.strip(' \t\n\r')
-    return message_id
+  def AddLabel(self, message_locators, chunk_size=DEFAULT_STORE_CHUNK_SIZE):
+    """Applies the label to messages, with one UID COPY per chunk."""
+    for start in range(0, len(message_locators), chunk_size):
+      self._CheckRefresh()
+      self._Uid('COPY', message_locators[start:start + chunk_size],
+                self.label_to_add)
+
+  def CreateLabel(self):
+    self.connection.create(self.label_to_add)
+
+  def GetMessageLocators(self, first_uid=1):
+    self._CheckRefresh()
+    logging.info('%s: Retrieving UIDs', datetime.now())
+    if first_uid > 1:
+      unused_type, data = self.connection.uid('SEARCH', 'UID',
+                                              '%d:*' % first_uid)
+    else:
+      unused_type, data = self.connection.uid('SEARCH', 'X-GM-RAW', '')
+    # "n:*" matches the last message even when its UID is below n
+    return [message_locator for message_locator in data[0].split()
+            if int(message_locator) >= first_uid]
+
+  def GetMessageKeys(self, message_locators, dedup_key=DEFAULT_DEDUP_KEY):
+    """Yields (message_locator, digest, description, size) for each message.
+
+    The data items dedup_key needs and RFC822.SIZE are requested for a
+    chunk of messages by a single UID FETCH of a compressed UID set, so a
+    mailbox takes one round trip per chunk rather than per message. A
+    chunk that still can't be fetched after reconnecting a few times is
+    logged and skipped. See DEDUP_KEYS for the digest and description.
+
+    Literals over KEY_SPOOL_THRESHOLD bytes are streamed into temporary
+    files, so a chunk of large messages never has to fit in memory.
+    """
+    (data_items, chunk_size, get_key) = DEDUP_KEYS[dedup_key]
+    message_locators = iter(message_locators)
+    while True:
+      chunk = list(itertools.islice(message_locators, chunk_size))
+      if not chunk:
+        return
+
+      self._CheckRefresh()
+
+      # Kept on self too, so that a connection made by a retry spools
+      self.spool_threshold = KEY_SPOOL_THRESHOLD
+      self.connection.spool_threshold = KEY_SPOOL_THRESHOLD
+      try:
+        (status, data) = self._Uid('FETCH', chunk,
+                                   '(RFC822.SIZE %s)' % data_items)
+      except Exception, e:
+        logging.error('[%s] Skipping %s messages from UID %s: %s',
+                      self.user, len(chunk), chunk[0], str(e))
+        self.skipped_messages += len(chunk)
+        data = []
+      finally:
+        self.spool_threshold = None
+        if self.connection is not None:
+          self.connection.spool_threshold = None
+
+      for attributes in ParseFetchResponse(data):
+        if 'UID' not in attributes:
+          continue
+
+        (digest, description) = get_key(attributes)
+        yield (attributes['UID'], digest, description,
+               int(attributes.get('RFC822.SIZE') or 0))
 
   def Logout(self):
     try:
@@ -414,74 +782,6 @@ class ImapConnectionManager(object):
     except Exception, e:
       self.connection = None
 
-  def _EscapeAndJoin(self, elems):
-    return '&'.join([self._UrlEscape(x) for x in elems])
-
-  def _FormatUrlParams(self, params):
-    param_fragments = []
-    for param in sorted(params.iteritems(), key=lambda x: x[0]):
-      param_fragments.append('%s=%s' % (param[0], self._UrlEscape(param[1])))
-    return '&'.join(param_fragments)
-
-  def _UrlEscape(self, text):
-    # See OAUTH 5.1 for a definition of which characters need to be escaped.
-    return urllib.quote(text, safe='~-._')
-
-  def _GenerateOauthSignature(self, base_string, consumer_secret,
-                              token_secret=''):
-    key = self._EscapeAndJoin([consumer_secret, token_secret])
-    return self._GenerateHmacSha1Signature(base_string, key)
-
-  def _GenerateHmacSha1Signature(self, text, key):
-    digest = hmac.new(key, text, hashlib.sha1)
-    return base64.b64encode(digest.digest())
-
-  def _GenerateSignatureBaseString(self, method, request_url_base, params):
-    return self._EscapeAndJoin([method, request_url_base,
-                                self._FormatUrlParams(params)])
-
-  def _FillInCommonOauthParams(self, params, consumer_key):
-    params['oauth_consumer_key'] = consumer_key
-    params['oauth_nonce'] = str(random.randrange(2**64 - 1))
-    params['oauth_signature_method'] = 'HMAC-SHA1'
-    params['oauth_version'] = '1.0'
-    params['oauth_timestamp'] = str(int(time.time()))
-
-  def _GenerateXOauthString(self, consumer_key, consumer_secret,
-                            xoauth_requestor_id, method, protocol):
-
-    url_params = {}
-    url_params['xoauth_requestor_id'] = xoauth_requestor_id
-    oauth_params = {}
-    self._FillInCommonOauthParams(oauth_params, consumer_key)
-
-    signed_params = oauth_params.copy()
-    signed_params.update(url_params)
-    request_url_base = (
-        'https://mail.google.com/mail/b/%s/%s/' % (xoauth_requestor_id,
-                                                   protocol))
-    base_string = self._GenerateSignatureBaseString(method,
-                                                    request_url_base,
-                                                    signed_params)
-
-    oauth_params['oauth_signature'] = self._GenerateOauthSignature(
-        base_string, consumer_secret)
-
-    # Build list of oauth parameters
-    formatted_params = []
-    for k, v in sorted(oauth_params.iteritems()):
-      formatted_params.append('%s="%s"' % (k, self._UrlEscape(v)))
-    param_list = ','.join(formatted_params)
-
-    # Append URL parameters to request url, if present
-    if url_params:
-      request_url = '%s?%s' % (request_url_base,
-                               self._FormatUrlParams(url_params))
-    else:
-      request_url = request_url_base
-
-    return '%s %s %s' % (method, request_url, param_list)
-
 
 def GetUserList(options):
 
@@ -512,6 +812,43 @@ def GenerateWorkQueue(user_list):
   return work_queue
 
 
+def SummarizeStats(user_stats):
+  """Returns the domain totals of the STATS_FIELDS of each user."""
+  totals = {'users': len(user_stats)}
+  for field in STATS_FIELDS[1:]:
+    totals[field] = sum([stats[field] for stats in user_stats])
+  return totals
+
+
+def WriteStats(stats_queue, stats_file, top_n):
+  """Writes the statistics each user's worker reported, worst users first.
+
+  Returns:
+    The domain totals and the top_n users with the most duplicates.
+  """
+  user_stats = []
+  while not stats_queue.empty():
+    user_stats.append(stats_queue.get())
+  user_stats.sort(key=lambda stats: (stats['duplicate_messages'],
+                                     stats['duplicate_bytes']),
+                  reverse=True)
+  totals = SummarizeStats(user_stats)
+
+  if stats_file.endswith('.json'):
+    output_file = open(stats_file, 'w')
+    json.dump({'totals': totals, 'top_users': user_stats[:top_n],
+               'users': user_stats}, output_file, indent=2, sort_keys=True)
+    output_file.close()
+  else:
+    output_file = open(stats_file, 'wb')
+    writer = csv.DictWriter(output_file, fieldnames=STATS_FIELDS)
+    writer.writeheader()
+    writer.writerows(user_stats)
+    output_file.close()
+
+  return (totals, user_stats[:top_n])
+
+
 def main():
 
   options = ParseInputs()
@@ -529,9 +866,15 @@ def main():
   logging.info('Pass starting')
   t0 = time.time()
 
+  if options.index_dir and not os.path.isdir(options.index_dir):
+    os.makedirs(options.index_dir)
+
   user_list = GetUserList(options)
   work_queue = GenerateWorkQueue(user_list)
   failure_queue = Queue.Queue()
+  stats_queue = None
+  if options.stats_file:
+    stats_queue = Queue.Queue()
 
   # Spawn a pool of threads
   for i in range(options.threads):
@@ -547,7 +890,11 @@ def main():
                options.max_failures,
                options.modify_messages,
                options.label_to_add,
-               options.imap_debug_level)
+               options.imap_debug_level,
+               options.dedup_key,
+               options.index_type,
+               options.index_dir,
+               stats_queue)
     t.setDaemon(True)
     t.start()
 
@@ -562,6 +909,19 @@ def main():
   logging.info('\t[%d] users', len(user_list))
   logging.info('\t[%s] sec/user', str((duration_in_seconds/len(user_list))))
 
+  if options.stats_file:
+    (totals, top_users) = WriteStats(stats_queue, options.stats_file,
+                                     options.top_n)
+    logging.info('\t[%d] duplicate messages of [%d] in [%d] users, [%d] bytes',
+                 totals['duplicate_messages'], totals['messages'],
+                 totals['users'], totals['duplicate_bytes'])
+    logging.info('Users with the most duplicates:')
+    for stats in top_users:
+      logging.info('\t[%s] [%d] duplicate messages, [%d] bytes',
+                   stats['user'], stats['duplicate_messages'],
+                   stats['duplicate_bytes'])
+    logging.info('Statistics written to [%s]', options.stats_file)
+
 
 if __name__ == '__main__':
   main()
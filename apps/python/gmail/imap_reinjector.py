@@ -76,6 +76,14 @@ USAGE:
                           retransmitted messages
     --threads=NUMBER
                           The number of concurrent IMAP connections to attempt
+    --adaptive_threads
+                          Treat --threads as a maximum and adapt the number of
+                          connections to throttling by the servers
+    --max_messages_per_second=RATE
+                          The sustained rate at which to reinject messages
+    --checkpoint_file=FILE
+                          A file recording reinjected messages; rerunning
+                          with the same file resumes an interrupted run
 
 EXAMPLES:
 """
@@ -89,15 +97,78 @@ import sys
 from email.parser import Parser
 #    https://code.google.com/p/enterprise-deployments/source/browse/trunk/
 #        apps/python/gmail/IMAPConnection.py
+from IMAPConnection import DEFAULT_FETCH_CHUNK_SIZE
+from IMAPConnection import DEFAULT_PIPELINE_DEPTH
 from IMAPConnection import IMAPConnection
+from IMAPConnection import IMAPConnectionPool
+from IMAPConnection import LabelBatcher
 from optparse import OptionParser
 #    https://code.google.com/p/enterprise-deployments/source/browse/trunk/
 #        apps/python/lib/Threading.py
+from Threading import RateLimiter
 from Threading import Threading
+from Threading import ThrottledError
 #    https://code.google.com/p/enterprise-deployments/source/browse/trunk/
 #        apps/python/lib/XOAuth.py
 from XOAuth import XOAuth
 
+# The number of work items buffered ahead of each worker thread
+ITEMS_QUEUED_PER_THREAD = 4
+
+# SMTP reply codes indicating the sender is being rate limited
+SMTP_THROTTLE_CODES = (421, 450, 451, 452)
+
+# The header fields recipients are taken from
+RECIPIENT_HEADERS = ('To', 'Cc', 'X-Forwarded-To', 'Received')
+
+ADDRESS_PATTERN = '[a-z0-9\.\-\+\']*@[a-z0-9\.]*'
+
+
+def GetRecipients(headers, message):
+  """Returns the addresses a message was sent to.
+
+  Args:
+    headers: The message's headers, parsed by email.parser.Parser
+    message: The text of the message, or of its RECIPIENT_HEADERS fields
+
+  Returns:
+    A list of lower-case email addresses.
+  """
+  addresses = []
+  if headers['To']:
+    addresses.extend(re.findall(ADDRESS_PATTERN, headers['To'].lower()))
+  if headers['Cc']:
+    addresses.extend(re.findall(ADDRESS_PATTERN, headers['Cc'].lower()))
+  if headers['X-Forwarded-To']:
+    addresses.extend(re.findall(ADDRESS_PATTERN,
+                                headers['X-Forwarded-To'].lower()))
+
+  groups = re.findall('received: by .* for <%s>;' % ADDRESS_PATTERN,
+                      message.lower())
+  for group in groups:
+    addresses.extend(re.findall(ADDRESS_PATTERN, group))
+
+  return addresses
+
+
+def RestrictAddresses(addresses, restrict_domains):
+  """Returns the addresses that are in one of restrict_domains."""
+  new_addresses = []
+  for address in addresses:
+    for domain in restrict_domains:
+      if address[0 - len(domain):] == domain:
+        new_addresses.append(address)
+
+  return new_addresses
+
+
+def HasRestrictedRecipient(header_text, restrict_domains):
+  """Checks the RECIPIENT_HEADERS of a message against restrict_domains."""
+  headers = Parser().parsestr(header_text, headersonly=True)
+  return bool(RestrictAddresses(GetRecipients(headers, header_text),
+                                restrict_domains))
+
+
 def ReinjectMessage(thread_number=0, item={}, metadata={}):
   """Reinjects a message to aspmx.l.google.com
 
@@ -112,28 +183,51 @@ def ReinjectMessage(thread_number=0, item={}, metadata={}):
     True - if the message is reinjected
     False - if the message could not be reinjected
   """
-  locator = item['locator']
-  message_number = item['message_number']
-
-  message_count = metadata['message_count']
-  xoauth_string = metadata['xoauth_string']
-  imap_debug = metadata['imap_debug']
-  restrict_domains = metadata['restrict_domains']
-  remove_from_subject = metadata['remove_from_subject']
-  label = metadata['label']
-  query = metadata['query']
-  completed_label = metadata['completed_label']
+  imap_pool = metadata['imap_pool']
 
   try:
-    imap_connection = IMAPConnection(xoauth_string=xoauth_string,
-                                     imap_debug=imap_debug)
+    imap_connection = imap_pool.Checkout(metadata['user'],
+                                         metadata['xoauth_string'],
+                                         metadata['label'],
+                                         metadata['xoauth'])
   except:
     return False
 
   try:
-    imap_connection.GetMessageLocatorsInLabel(label, query)
+    reinjected = ReinjectMessageFromConnection(imap_connection, thread_number,
+                                               item, metadata)
   except:
-    return False
+    imap_pool.Return(imap_connection, discard=True)
+    raise
+
+  # A failed fetch is most likely a broken connection, so don't reuse it
+  imap_pool.Return(imap_connection, discard=not reinjected)
+  return reinjected
+
+
+def ReinjectMessageFromConnection(imap_connection, thread_number, item,
+                                  metadata):
+  """Reinjects a message using an IMAP connection with its label selected.
+
+  Args:
+    imap_connection: An IMAPConnection
+    thread_number: The number/id of the processing thread
+    item: A dictionary containing information specific to the item being
+        processed
+    metadata: A dictionary containing information about all items being
+        processed
+
+  Returns:
+    True - if the message is reinjected
+    False - if the message could not be fetched
+  """
+  locator = item['locator']
+  message_number = item['message_number']
+
+  message_count = metadata['message_count']
+  restrict_domains = metadata['restrict_domains']
+  remove_from_subject = metadata['remove_from_subject']
+  label_batcher = metadata['label_batcher']
 
   logging.info('Thread #%s - Fetching message #%s of %s (%s).',
                thread_number, message_number, message_count, locator)
@@ -145,37 +239,14 @@ def ReinjectMessage(thread_number=0, item={}, metadata={}):
   headers = Parser().parsestr(message)
 
   if headers['From']:
-    sender = re.findall('[a-z0-9\.\-\+\']*@[a-z0-9\.]*',
-                     headers['From'].lower())
+    sender = re.findall(ADDRESS_PATTERN, headers['From'].lower())
   elif headers['Sender']:
-    sender = re.findall('[a-z0-9\.\-\+\']*@[a-z0-9\.]*',
-                     headers['Sender'].lower())
+    sender = re.findall(ADDRESS_PATTERN, headers['Sender'].lower())
   
-  addresses = []
-  if headers['To']:
-    addresses.extend(re.findall('[a-z0-9\.\-\+\']*@[a-z0-9\.]*',
-                     headers['To'].lower()))
-  if headers['Cc']:
-    addresses.extend(re.findall('[a-z0-9\.\-\+\']*@[a-z0-9\.]*',
-                     headers['Cc'].lower()))
-  if headers['X-Forwarded-To']:
-    addresses.extend(re.findall('[a-z0-9\.\-\+\']*@[a-z0-9\.]*',
-                     headers['X-Forwarded-To'].lower()))
-
-  groups = re.findall('received: by .* '
-                      'for <[a-z0-9\.\-\+\']*@[a-z0-9\.]*>;',
-                      message.lower())
-  for group in groups:
-    addresses.extend(re.findall('[a-z0-9\.\-\+\']*@[a-z0-9\.]*', group))
+  addresses = GetRecipients(headers, message)
 
   if restrict_domains:
-    new_addresses = []
-    for address in addresses:
-      for domain in restrict_domains:
-        if address[0 - len(domain):] == domain:
-          new_addresses.append(address)
-
-    addresses = new_addresses
+    addresses = RestrictAddresses(addresses, restrict_domains)
 
   if addresses:
     if remove_from_subject:
@@ -186,23 +257,96 @@ def ReinjectMessage(thread_number=0, item={}, metadata={}):
 
     logging.info('  Thread #%s - Reinjecting message #%s.' % (thread_number,
                                                               message_number))
-    smtp_connection = smtplib.SMTP('aspmx.l.google.com')
-    smtp_connection.sendmail(sender, addresses, message)
-    smtp_connection.quit()
-
-    if completed_label:
-      imap_connection.AddLabel(locator, completed_label)
+    smtp_connection = None
+    try:
+      try:
+        smtp_connection = smtplib.SMTP('aspmx.l.google.com')
+        smtp_connection.sendmail(sender, addresses, message)
+        smtp_connection.quit()
+      except smtplib.SMTPRecipientsRefused, e:
+        # Every recipient was refused, so nothing was sent; a rate limit at
+        # RCPT time is reported here, one reply per recipient
+        for (code, error) in e.recipients.values():
+          if code in SMTP_THROTTLE_CODES:
+            raise ThrottledError('SMTP %s: %s' % (code, error))
+        raise
+      except smtplib.SMTPResponseException, e:
+        if e.smtp_code in SMTP_THROTTLE_CODES:
+          raise ThrottledError('SMTP %s: %s' % (e.smtp_code, e.smtp_error))
+        raise
+    finally:
+      if smtp_connection is not None:
+        smtp_connection.close()
+
+    if label_batcher:
+      label_batcher.Add(locator)
   else:
     logging.info('  No acceptable addresses to reinject to. Skipping.')
 
-  imap_connection.Close()
-
   return True
 
 
+def SelectRestrictedLocators(metadata, locators):
+  """Returns the locators of messages with a recipient in restrict_domains.
+
+  Only the recipient headers are downloaded. If they can't be, every
+  locator is returned and ReinjectMessage checks the recipients instead.
+  """
+  imap_pool = metadata['imap_pool']
+  imap_connection = None
+  failed = False
+  try:
+    try:
+      imap_connection = imap_pool.Checkout(metadata['user'],
+                                           metadata['xoauth_string'],
+                                           metadata['label'],
+                                           metadata['xoauth'])
+      return imap_connection.FilterMessageLocators(
+          locators, RECIPIENT_HEADERS,
+          lambda header_text: HasRestrictedRecipient(
+              header_text, metadata['restrict_domains']))
+    except Exception, e:
+      logging.warning('Could not fetch the recipients of %s messages: %s',
+                      len(locators), e)
+      failed = True
+      return locators
+  finally:
+    if imap_connection is not None:
+      imap_pool.Return(imap_connection, discard=failed)
+
+
+def GenerateItems(locators, select=None,
+                  batch_size=DEFAULT_FETCH_CHUNK_SIZE * DEFAULT_PIPELINE_DEPTH):
+  """Yields one work item per message locator, numbered from 1.
+
+  Args:
+    locators: A list of IMAP message locators
+    select: Optionally, a function given a list of locators that returns
+        those to yield items for. It is called for batch_size locators at a
+        time as items are read, so that the first messages can be processed
+        before the rest have been selected.
+
+  Yields:
+    A dictionary describing the message to be processed
+  """
+  message_number = 0
+  for start in range(0, len(locators), batch_size):
+    batch = locators[start:start + batch_size]
+    selected = None
+    if select:
+      selected = set(select(batch))
+
+    for locator in batch:
+      message_number += 1
+      if selected is None or locator in selected:
+        yield {'locator': locator, 'message_number': message_number}
+
+
 def ImapSearch(xoauth_string, query, restrict_domains_file='',
                completed_label='', remove_from_subject='', threads=1,
-               imap_debug=0):
+               imap_debug=0, adaptive_threads=False,
+               max_messages_per_second=None, checkpoint_file=None,
+               user=None, xoauth=None):
   """Searches an inbox for certain messages and queues each one for reinjection
 
   Args:
@@ -217,12 +361,23 @@ def ImapSearch(xoauth_string, query, restrict_domains_file='',
     threads: An integer; the number of IMAP connections to establish
         simultaneously
     imap_debug: IMAP debug level
+    adaptive_threads: If True, threads is an upper bound and the number of
+        concurrent connections adapts to throttling by the servers
+    max_messages_per_second: If set, reinjection is paced to this sustained
+        rate across all threads
+    checkpoint_file: If set, a journal of reinjected messages; messages
+        already listed in it are not reinjected again
+    user: The email address of the mailbox, used to share IMAP connections
+        between threads
+    xoauth: An optional XOAuth signer, used to sign xoauth_string again for
+        connections opened after it has expired
 
   Raises:
     An IOException if the restrict_domains_file can't be opened.
   """
   imap_connection = IMAPConnection(xoauth_string=xoauth_string,
-                                   imap_debug=imap_debug)
+                                   imap_debug=imap_debug, user=user,
+                                   xoauth=xoauth)
   if completed_label:
     imap_connection.CreateLabel(completed_label)
   imap_connection.Close()
@@ -240,34 +395,75 @@ def ImapSearch(xoauth_string, query, restrict_domains_file='',
     for domain in domains:
       restrict_domains.append(domain.rstrip())
 
+  rate_limiters = []
+  if max_messages_per_second:
+    rate_limiters.append(RateLimiter(max_messages_per_second))
+
+  # One more than the workers, for the connection selecting messages
+  imap_pool = IMAPConnectionPool(imap_debug=imap_debug, max_idle=threads + 1)
+
   labels = ['[Gmail]/All Mail', '[Gmail]/Spam']
 
   for label in labels:
     metadata = {'label': label,
                 'query': query,
+                'user': user,
+                'imap_pool': imap_pool,
                 'xoauth_string': xoauth_string,
+                'xoauth': xoauth,
                 'imap_debug': imap_debug,
                 'restrict_domains': restrict_domains,
                 'remove_from_subject': remove_from_subject,
                 'completed_label': completed_label}
 
-    imap_connection = IMAPConnection(xoauth_string=xoauth_string,
-                                     imap_debug=imap_debug)
+    imap_connection = imap_pool.Checkout(user, xoauth_string, label, xoauth)
     locators = imap_connection.GetMessageLocatorsInLabel(label, query)
-    imap_connection.Close()
+    imap_pool.Return(imap_connection)
+
+    # Completed messages are labelled in batches on a dedicated connection
+    label_connection = None
+    metadata['label_batcher'] = None
+    if completed_label:
+      label_connection = imap_pool.Checkout(user, xoauth_string, label,
+                                            xoauth)
+      metadata['label_batcher'] = LabelBatcher(label_connection,
+                                               completed_label)
 
-    metadata['message_count'] = len(locators)
     logging.info('Found %s messages matching query \'%s\' in %s',
-                 metadata['message_count'], query, label)
+                 len(locators), query, label)
 
-    items = []
-    message_number = 0
-    for locator in locators:
-      message_number += 1
-      items.append({'locator': locator, 'message_number': message_number})
+    # Messages without recipients in the restricted domains are left out by
+    # their headers alone, a batch at a time as the workers take them
+    select = None
+    if restrict_domains:
+      select = lambda batch: SelectRestrictedLocators(metadata, batch)
 
-    Threading(items, function=ReinjectMessage, metadata=metadata,
-              threads=threads, debug_level=1)
+    metadata['message_count'] = len(locators)
+
+    try:
+      result = Threading(GenerateItems(locators, select),
+                         function=ReinjectMessage,
+                         metadata=metadata, threads=threads, debug_level=1,
+                         queue_size=threads * ITEMS_QUEUED_PER_THREAD,
+                         adaptive=adaptive_threads,
+                         rate_limiters=rate_limiters,
+                         checkpoint_file=checkpoint_file,
+                         item_id=lambda item: '%s %s' % (label,
+                                                         item['locator']))
+    finally:
+      # Label what was reinjected even if the run was interrupted
+      if label_connection:
+        metadata['label_batcher'].Flush()
+        for locator in metadata['label_batcher'].failed:
+          logging.error('Could not add label %s to message %s in %s.',
+                        completed_label, locator, label)
+        imap_pool.Return(label_connection)
+
+    for item in result.dead_letters:
+      logging.error('Message #%s (%s) in %s could not be reinjected.',
+                    item['message_number'], item['locator'], label)
+
+  imap_pool.CloseAll()
 
 
 def ParseInputs():
@@ -296,6 +492,18 @@ def ParseInputs():
   parser.add_option('--threads', dest='threads', default=1,
                     help='The number of IMAP connections to open. Default = 1'
                     'simultaneously', type='int')
+  parser.add_option('--adaptive_threads', dest='adaptive_threads',
+                    action='store_true', default=False,
+                    help='Treat --threads as a maximum and adjust the number '
+                    'of connections to the throughput the servers allow')
+  parser.add_option('--max_messages_per_second',
+                    dest='max_messages_per_second', default=None,
+                    help='[OPTIONAL] The sustained rate at which to reinject '
+                    'messages, across all threads', type='float')
+  parser.add_option('--checkpoint_file', dest='checkpoint_file',
+                    default=None,
+                    help='[OPTIONAL] A file recording reinjected messages, '
+                    'so that an interrupted run can be resumed')
   parser.add_option('--imap_debug_level', dest='imap_debug_level', default=0,
                     help='[OPTIONAL] Sets the imap debug level\n'
                     '   Change this to a higher number to enable console debug',
@@ -350,7 +558,9 @@ def main():
   # Run the IMAP search
   ImapSearch(xoauth_string, options.query, options.restrict_domains_file,
              options.completed_label, options.remove_from_subject,
-             int(options.threads), options.imap_debug_level)
+             int(options.threads), options.imap_debug_level,
+             options.adaptive_threads, options.max_messages_per_second,
+             options.checkpoint_file, options.user, xoauth)
 
   print 'Log file is: %s' % log_filename
 
@@ -48,23 +48,44 @@ Options:
   --truncate_label=LABEL
                         A Gmail label to add to any messages that were
                         truncated when pushed to Drive.
+  --state_file=FILE
+                        A file recording the Message-IDs of the messages
+                        exported, so that running again for the same user
+                        only exports messages that weren't exported before.
+                        Messages without a Message-ID are always exported.
+                        Optional.
+Dependencies:
+  Use of this tool requires a supplementary Python library to handle XOAuth
+  authentication and authorization. This library can be found at:
+    https://code.google.com/p/enterprise-deployments/source/browse/trunk/
+        apps/python/lib/XOAuth.py
+
+  Use of this tool requires supplementary Python libraries to parse IMAP
+  responses and index Message-IDs. These libraries can be found at:
+    https://code.google.com/p/enterprise-deployments/source/browse/trunk/
+        apps/python/lib/IMAPConnection.py
+    https://code.google.com/p/enterprise-deployments/source/browse/trunk/
+        apps/python/lib/DigestIndex.py
 """
 
-import base64
 from datetime import datetime
 import gdata.docs.client as docs_client
 import gdata.gauth
 import hashlib
-import hmac
 import imaplib
 import logging
 from optparse import OptionParser
-import random
 import re
 import StringIO
 import sys
 import time
-import urllib
+
+from DigestIndex import DigestSet
+from DigestIndex import SQLiteDigestIndex
+from IMAPConnection import CompressUidSet
+from IMAPConnection import DEFAULT_FETCH_CHUNK_SIZE
+from IMAPConnection import ParseFetchResponse
+from XOAuth import XOAuth
 
 # The maximum seconds to sustain an open connection to each of the services
 # we rely on
@@ -75,135 +96,6 @@ IMAP_CONNECTION_MAX_LENGTH = 300
 EMAIL_TRUNCATE_BYTES = 256000
 
 
-class OAuthEntity(object):
-  """Represents consumers and tokens in OAuth."""
-
-  def __init__(self, key, secret):
-    """ Initializes an OAuthEntity
-
-    Arguments:
-      key: a string, the OAuth key
-      secret: a string, the OAuth secret
-    """
-    self.key = key
-    self.secret = secret
-
-
-def EscapeAndJoin(elems):
-  return '&'.join([UrlEscape(x) for x in elems])
-
-
-def FormatUrlParams(params):
-  """Formats parameters into a URL query string.
-
-  Args:
-    params: A key-value map.
-
-  Returns:
-    A URL query string version of the given parameters.
-  """
-  param_fragments = []
-  for param in sorted(params.iteritems(), key=lambda x: x[0]):
-    param_fragments.append('%s=%s' % (param[0], UrlEscape(param[1])))
-  return '&'.join(param_fragments)
-
-
-def UrlEscape(text):
-  # See OAUTH 5.1 for a definition of which characters need to be escaped.
-  return urllib.quote(text, safe='~-._')
-
-
-def GenerateOauthSignature(base_string, secret, token_secret=''):
-  key = EscapeAndJoin([secret, token_secret])
-  return GenerateHmacSha1Signature(base_string, key)
-
-
-def GenerateHmacSha1Signature(text, key):
-  digest = hmac.new(key, text, hashlib.sha1)
-  return base64.b64encode(digest.digest())
-
-
-def GenerateSignatureBaseString(method, request_url_base, params):
-  """Generates an OAuth signature base string.
-
-  Args:
-    method: The HTTP request method, e.g. "GET".
-    request_url_base: The base of the requested URL. For example, if the
-      requested URL is
-      "https://mail.google.com/mail/b/xxx@domain.com/imap/?" +
-      "xoauth_requestor_id=xxx@domain.com", the request_url_base would be
-      "https://mail.google.com/mail/b/xxx@domain.com/imap/".
-    params: Key-value map of OAuth parameters, plus any parameters from the
-      request URL.
-
-  Returns:
-    A signature base string prepared according to the OAuth Spec.
-  """
-  return EscapeAndJoin([method, request_url_base, FormatUrlParams(params)])
-
-
-def FillInCommonOauthParams(params, consumer):
-  """Fills in parameters that are common to all oauth requests.
-
-  Args:
-    params: Parameter map, which will be added to.
-    consumer: An OAuthEntity representing the OAuth consumer.
-  """
-
-  params['oauth_consumer_key'] = consumer.key
-  params['oauth_nonce'] = str(random.randrange(2**64 - 1))
-  params['oauth_signature_method'] = 'HMAC-SHA1'
-  params['oauth_version'] = '1.0'
-  params['oauth_timestamp'] = str(int(time.time()))
-
-
-def GenerateXOauthString(consumer, xoauth_requestor_id, method, protocol):
-  """Generates an IMAP XOAUTH authentication string.
-
-  Args:
-    consumer: An OAuthEntity representing the consumer.
-    xoauth_requestor_id: The Google Mail user who's inbox will be
-                         searched (full email address)
-    method: The HTTP method used in the API request
-    protocol: The protocol used in the API request
-
-  Returns:
-    A string that can be passed as the argument to an IMAP
-    "AUTHENTICATE XOAUTH" command after being base64-encoded.
-  """
-
-  url_params = {}
-  url_params['xoauth_requestor_id'] = xoauth_requestor_id
-  oauth_params = {}
-  FillInCommonOauthParams(oauth_params, consumer)
-
-  signed_params = oauth_params.copy()
-  signed_params.update(url_params)
-  request_url_base = (
-      'https://mail.google.com/mail/b/%s/%s/' % (xoauth_requestor_id, protocol))
-  base_string = GenerateSignatureBaseString(
-      method,
-      request_url_base,
-      signed_params)
-
-  oauth_params['oauth_signature'] = GenerateOauthSignature(base_string,
-                                                           consumer.secret)
-
-  # Build list of oauth parameters
-  formatted_params = []
-  for k, v in sorted(oauth_params.iteritems()):
-    formatted_params.append('%s="%s"' % (k, UrlEscape(v)))
-  param_list = ','.join(formatted_params)
-
-  # Append URL parameters to request url, if present
-  if url_params:
-    request_url = '%s?%s' % (request_url_base,
-                             FormatUrlParams(url_params))
-  else:
-    request_url = request_url_base
-
-  return '%s %s %s' % (method, request_url, param_list)
-
 def GetHeaderFromMessage(message, header):
   tag_length = len(header) + 2
 
@@ -214,9 +106,11 @@ def GetHeaderFromMessage(message, header):
 
   return value.strip()
 
-# Keeps track of all processed Message-IDs in order to detect duplication
-processed_messages = []
-def ExportLabelToFolder(imap_connection, docs_connection, label, query, owner):
+# Keeps track of the digests of all processed Message-IDs in order to detect
+# duplication
+processed_messages = DigestSet()
+def ExportLabelToFolder(imap_connection, docs_connection, label, query, owner,
+                        exported_messages=None):
   """ Exports all messages under an IMAP label to a comparable Drive folder.
 
   Arguments:
@@ -227,6 +121,9 @@ def ExportLabelToFolder(imap_connection, docs_connection, label, query, owner):
     query: a Gmail-style query to restrict the export of messages. (None means
            to export all messages.)
     owner: a string, the email address of the person who should own the export
+    exported_messages: a DigestIndex of the Message-IDs exported by earlier
+                       runs, to skip and add to. (None means export all
+                       messages.)
 
   Returns:
     Nothing
@@ -234,6 +131,33 @@ def ExportLabelToFolder(imap_connection, docs_connection, label, query, owner):
   # Grab references to all of the messages in a label
   message_locators = imap_connection.GetMessageLocatorsInLabel(label, query)
 
+  # Leave out the messages earlier runs exported, by their Message-IDs alone.
+  # Those this run has exported are in processed_messages too, and are
+  # still exported to this label as duplicates.
+  if message_locators and exported_messages is not None and len(
+      exported_messages):
+    message_ids = imap_connection.GetMessageIds(message_locators)
+    new_locators = []
+    unknown_count = 0
+    for message_locator in message_locators:
+      # Without its Message-ID a message may have been exported before, so
+      # it is left for a later run rather than risk a second document
+      if message_locator not in message_ids:
+        unknown_count += 1
+        continue
+      if message_ids[message_locator]:
+        digest = hashlib.md5(message_ids[message_locator]).digest()
+        if digest in exported_messages and digest not in processed_messages:
+          continue
+      new_locators.append(message_locator)
+    if unknown_count:
+      logging.error('%s:   Skipping %s messages whose Message-IDs could not '
+                    'be retrieved.', datetime.now(), unknown_count)
+    logging.info('%s:   Skipping %s messages exported before.',
+                 datetime.now(),
+                 len(message_locators) - len(new_locators) - unknown_count)
+    message_locators = new_locators
+
   total_in_label = len(message_locators)
 
   if message_locators:
@@ -269,20 +193,35 @@ def ExportLabelToFolder(imap_connection, docs_connection, label, query, owner):
         subject = 'unknown_subject'
 
       message_id = GetHeaderFromMessage(message, 'Message-ID')
+      message_digest = hashlib.md5(message_id).digest()
 
-      if message_id in processed_messages:
+      duplicate = message_id and message_digest in processed_messages
+      if duplicate:
         message = 'Duplicate message with Message ID: ' + message_id
         logging.info('%s:     The following message is a duplicate:',
                      datetime.now())
-      else:
-        if message_id:
-          processed_messages.append(message_id)
 
       title = sender + ": " + subject
 
-      if docs_connection.CreateDoc(title, message, owner):
+      (created, truncated) = docs_connection.CreateDoc(title, message, owner)
+      if not created:
+        logging.error('%s:   %s of %s: Could not create "%s", skipping.',
+                      datetime.now(), message_count, total_in_label, title)
+        continue
+
+      if truncated:
         imap_connection.AddTruncationLabel(message_locator)
 
+      # Record the export at once, so an interrupted run resumes after it.
+      # A message whose document couldn't be created is neither recorded
+      # nor treated as a duplicate, so a later copy or run exports it.
+      if message_id:
+        if not duplicate:
+          processed_messages.Add(message_digest)
+        if exported_messages is not None:
+          exported_messages.Add(message_digest)
+          exported_messages.Commit()
+
       logging.info('%s:   %s of %s: Added "%s" to collection %s',
                    datetime.now(), message_count, total_in_label,
                    title, docs_connection.folder.name)
@@ -295,6 +234,7 @@ class XOAuthInfo(object):
     self.user = user
     self.key = key
     self.secret = secret
+    self.signer = XOAuth(key, secret)
 
 
 class IMAPConnection(object):
@@ -314,9 +254,8 @@ class IMAPConnection(object):
     self.connection = imaplib.IMAP4_SSL('imap.gmail.com', 993)
     self.connection.debug = self.imap_debug
 
-    consumer = OAuthEntity(self.xoauth.key, self.xoauth.secret)
-    xoauth_string = GenerateXOauthString(consumer, self.xoauth.user, 'GET',
-                                         'imap')
+    xoauth_string = self.xoauth.signer.GetXOAuthString(self.xoauth.user,
+                                                       'GET', 'imap')
 
     try:
       self.connection.authenticate('XOAUTH', lambda x: xoauth_string)
@@ -369,6 +308,50 @@ class IMAPConnection(object):
 
     return data[0].split()
 
+  def GetMessageIds(self, message_locators,
+                    chunk_size=DEFAULT_FETCH_CHUNK_SIZE):
+    """Returns a dict of the Message-IDs of messages, by message locator.
+
+    The Message-ID headers of chunk_size messages are fetched at a time,
+    and a chunk that fails is tried up to five times, reconnecting in
+    between. A message without a Message-ID maps to ''; messages whose
+    headers could not be fetched at all are left out.
+    """
+    message_ids = {}
+    for start in range(0, len(message_locators), chunk_size):
+      self._CheckRefresh()
+
+      chunk = message_locators[start:start + chunk_size]
+      data = []
+      remaining_tries = 4
+      while remaining_tries >= 0:
+        try:
+          (result, data) = self.connection.uid(
+              'FETCH', CompressUidSet(chunk),
+              '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+
+          remaining_tries = -1
+        except Exception, e:
+          logging.info('%s:     Could not retrieve Message-IDs: %s',
+                       datetime.now(), str(e))
+          if remaining_tries == 0:
+            break
+          remaining_tries -= 1
+          time.sleep(3)
+          self.Close()
+          self._Connect()
+
+      for attributes in ParseFetchResponse(data):
+        if 'UID' not in attributes:
+          continue
+        message_ids[attributes['UID']] = ''
+        for (name, value) in attributes.iteritems():
+          if name.startswith('BODY[HEADER') and value:
+            message_ids[attributes['UID']] = GetHeaderFromMessage(
+                value, 'Message-ID')
+
+    return message_ids
+
   def List(self):
     self._CheckRefresh()
 
@@ -485,6 +468,14 @@ class DocsConnection(object):
     self.folder = self.folder.parent
 
   def CreateDoc(self, name, content, owner=None):
+    """Uploads content as a document in the current collection.
+
+    The upload is tried up to five times, reconnecting in between.
+
+    Returns:
+      A (created, truncated) pair: whether the document was created, and
+      whether content had to be truncated to EMAIL_TRUNCATE_BYTES.
+    """
     self._CheckRefresh()
 
     truncated = False
@@ -506,6 +497,11 @@ class DocsConnection(object):
 
         remaining_tries = -2
       except Exception, e:
+        if remaining_tries == 0:
+          logging.error('%s:     Giving up creating document: %s',
+                        datetime.now(), str(e))
+          return (False, truncated)
+
         logging.info('%s:     Re-establishing Docs connection',
                      datetime.now())
         self.Close()
@@ -513,16 +509,17 @@ class DocsConnection(object):
 
         remaining_tries -= 1
 
-    if remaining_tries == -2 and owner:
+    if owner:
       acl_entry = gdata.docs.data.AclEntry(
           scope=gdata.acl.data.AclScope(value=owner, type='user'),
           role=gdata.acl.data.AclRole(value='owner'),)
 
       self.connection.AddAclEntry(document, acl_entry, send_notifications=False)
 
-    return truncated
+    return (True, truncated)
 
-def ImapSearch(user, xoauth, owner, query, truncate_label, imap_debug):
+def ImapSearch(user, xoauth, owner, query, truncate_label, imap_debug,
+               state_file=None):
   """Searches the user inbox for specific messages. Uploads them to Drive.
 
   Args:
@@ -531,10 +528,24 @@ def ImapSearch(user, xoauth, owner, query, truncate_label, imap_debug):
     owner: The owner of the uploaded Drive files
     query: A query to find messages
     imap_debug: IMAP debug level
+    state_file: A file of the Message-IDs already exported for user, to
+                skip and add to
   """
 
   messages_found = 0
 
+  exported_messages = None
+  if state_file:
+    exported_messages = SQLiteDigestIndex(state_file)
+    exported_user = exported_messages.GetState('user')
+    if exported_user and exported_user != user:
+      logging.error('%s: %s holds the messages exported for %s, not %s',
+                    datetime.now(), state_file, exported_user, user)
+      exported_messages.Close()
+      return
+    exported_messages.SetState('user', user)
+    exported_messages.Commit()
+
   # Setup the Drive connection and authenticate using OAUTH
   docs_connection = DocsConnection(xoauth)
 
@@ -557,8 +568,12 @@ def ImapSearch(user, xoauth, owner, query, truncate_label, imap_debug):
     labels.append(label)
 
   for label in labels:
-    ExportLabelToFolder(imap_connection, docs_connection, label, query, owner)
-    
+    ExportLabelToFolder(imap_connection, docs_connection, label, query, owner,
+                        exported_messages)
+
+  if exported_messages is not None:
+    exported_messages.Close()
+
   logging.info('%s: Processing complete.', datetime.now())
 
 
@@ -592,6 +607,8 @@ def ParseInputs():
                     help='A Gmail query to identify messages.')
   parser.add_option('--truncate_label', dest='trunacte_label', default=None,
                     help='A Gmail label to add to truncated messages.')
+  parser.add_option('--state_file', dest='state_file', default=None,
+                    help='A file of the Message-IDs already exported.')
 
   parser.add_option('--imap_debug_level', dest='imap_debug_level', default=0,
                     help="""[OPTIONAL] Sets the imap debug level.
@@ -639,7 +656,8 @@ def main():
   xoauth = XOAuthInfo(options.user, options.key, options.secret)
 
   ImapSearch(options.user, xoauth, options.owner, options.query,
-             options.trunacte_label, options.imap_debug_level)
+             options.trunacte_label, options.imap_debug_level,
+             options.state_file)
 
   print 'Log file is: %s' % log_filename
 
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Google Inc. All Rights Reserved.
+"""
+Tests the incremental --index_dir runs of imap_duplicate_check.py against a
+local FakeGmailIMAPServer.
+
+Usage:
+  PYTHONPATH=../lib python test_imap_duplicate_check.py
+
+The tests are skipped when the gdata library imap_duplicate_check imports
+is not installed.
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+###########################################################################
+DISCLAIMER:
+
+(i) GOOGLE INC. ("GOOGLE") PROVIDES YOU ALL CODE HEREIN "AS IS" WITHOUT ANY
+WARRANTIES OF ANY KIND, EXPRESS, IMPLIED, STATUTORY OR OTHERWISE, INCLUDING,
+WITHOUT LIMITATION, ANY IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NON-INFRINGEMENT; AND
+
+(ii) IN NO EVENT WILL GOOGLE BE LIABLE FOR ANY LOST REVENUES, PROFIT OR DATA,
+OR ANY DIRECT, INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE
+DAMAGES, HOWEVER CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, EVEN IF
+GOOGLE HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH DAMAGES, ARISING OUT OF
+THE USE OR INABILITY TO USE, MODIFICATION OR DISTRIBUTION OF THIS CODE OR ITS
+DERIVATIVES.
+###########################################################################
+"""
+
+import logging
+import shutil
+import tempfile
+import unittest
+
+import FakeGmailIMAPServer
+from FakeGmailIMAPServer import SyntheticMailbox
+import IMAPConnection
+
+try:
+  import imap_duplicate_check
+except ImportError:
+  imap_duplicate_check = None
+
+DUPLICATE_LABEL = 'Duplicates'
+
+
+@unittest.skipUnless(imap_duplicate_check, 'requires gdata')
+class IncrementalRunTest(unittest.TestCase):
+
+  def setUp(self):
+    self.index_dir = tempfile.mkdtemp()
+    self.servers = []
+    self.uidvalidity = FakeGmailIMAPServer.UIDVALIDITY
+    self.connection_class = imap_duplicate_check.SpoolingIMAP4_SSL
+
+  def tearDown(self):
+    imap_duplicate_check.SpoolingIMAP4_SSL = self.connection_class
+    FakeGmailIMAPServer.UIDVALIDITY = self.uidvalidity
+    for server in self.servers:
+      server.Stop()
+    shutil.rmtree(self.index_dir)
+
+  def StartServer(self, message_count):
+    server = FakeGmailIMAPServer.FakeGmailIMAPServer(
+        SyntheticMailbox(message_count))
+    server.Start()
+    self.servers.append(server)
+    imap_duplicate_check.SpoolingIMAP4_SSL = (
+        lambda unused_host, unused_port: IMAPConnection.SpoolingIMAP4(
+            server.host, server.port))
+    return server
+
+  def Run(self, server, index_dir=None):
+    """Checks the fake user's mailbox, returning the UIDs labeled so far."""
+    worker = imap_duplicate_check.Worker(
+        'example.com', 'secret', None, None, 'example.com', None, None, 0, 0,
+        True, DUPLICATE_LABEL, 0, index_dir=index_dir)
+    worker._ProcessUser(imap_duplicate_check.Instruction(server.mailbox.user))
+    return set(server.mailbox.labels.get(DUPLICATE_LABEL, ()))
+
+  def testNewMessagesAreCheckedAgainstEarlierRuns(self):
+    expected = self.Run(self.StartServer(2000))
+
+    server = self.StartServer(1000)
+    first_run = self.Run(server, self.index_dir)
+    self.assertEqual(set([uid for uid in expected if uid <= 1000]),
+                     first_run)
+
+    # New mail arrives, including copies of messages seen by the first run
+    server.mailbox.message_count = 2000
+    self.assertEqual(expected, self.Run(server, self.index_dir))
+
+  def testUnchangedMailboxFetchesNothing(self):
+    server = self.StartServer(1000)
+    labeled = self.Run(server, self.index_dir)
+    fetches = server.GetCommandCounts().get('UID FETCH', 0)
+
+    self.assertEqual(labeled, self.Run(server, self.index_dir))
+    self.assertEqual(fetches, server.GetCommandCounts().get('UID FETCH', 0))
+
+  def testNewUidValidityChecksEveryMessage(self):
+    server = self.StartServer(1000)
+    labeled = self.Run(server, self.index_dir)
+    server.mailbox.labels[DUPLICATE_LABEL].clear()
+
+    FakeGmailIMAPServer.UIDVALIDITY += 1
+    self.assertEqual(labeled, self.Run(server, self.index_dir))
+
+
+if __name__ == '__main__':
+  logging.basicConfig(level=logging.ERROR)
+  unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Google Inc. All Rights Reserved.
+"""
+  xoauth_benchmark.py
+
+DESCRIPTION:
+  Measures how many XOAUTH strings per second XOAuth.GetXOAuthString can
+  produce, as domain-wide tools sign one for every user and every reconnect.
+
+  Benchmarks:
+    sign      A new signature for each of --users users (max_age=0)
+    cached    Strings for the same users again, served from the cache with
+              max_age=XOAUTH_STRING_CACHE_LIFETIME (at most
+              XOAUTH_STRING_CACHE_SIZE users)
+    threads   New signatures from --threads threads sharing one XOAuth
+
+USAGE:
+  ./xoauth_benchmark.py --users 100000 --threads 10
+
+DEPENDENCIES:
+  Use of this tool requires a supplementary Python library to handle XOAuth
+  authentication and authorization. This library can be found at:
+    https://code.google.com/p/enterprise-deployments/source/browse/trunk/
+        apps/python/lib/XOAuth.py
+
+LICENSING:
+  Licensed under the Apache License, Version 2.0 (the "License");
+  you may not use this file except in compliance with the License.
+  You may obtain a copy of the License at
+
+  http://www.apache.org/licenses/LICENSE-2.0
+
+###########################################################################
+DISCLAIMER:
+
+(i) GOOGLE INC. ("GOOGLE") PROVIDES YOU ALL CODE HEREIN "AS IS" WITHOUT ANY
+WARRANTIES OF ANY KIND, EXPRESS, IMPLIED, STATUTORY OR OTHERWISE, INCLUDING,
+WITHOUT LIMITATION, ANY IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NON-INFRINGEMENT; AND
+
+(ii) IN NO EVENT WILL GOOGLE BE LIABLE FOR ANY LOST REVENUES, PROFIT OR DATA,
+OR ANY DIRECT, INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE
+DAMAGES, HOWEVER CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, EVEN IF
+GOOGLE HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH DAMAGES, ARISING OUT OF
+THE USE OR INABILITY TO USE, MODIFICATION OR DISTRIBUTION OF THIS CODE OR ITS
+DERIVATIVES.
+###########################################################################
+"""
+
+from optparse import OptionParser
+import threading
+import time
+
+from XOAuth import XOAUTH_STRING_CACHE_LIFETIME
+from XOAuth import XOAUTH_STRING_CACHE_SIZE
+from XOAuth import XOAuth
+
+
+def Sign(xoauth, users, max_age):
+  for user in users:
+    xoauth.GetXOAuthString(user, 'GET', 'imap', max_age=max_age)
+
+
+def SignInThreads(xoauth, users, threads):
+  workers = []
+  for thread_number in range(threads):
+    worker = threading.Thread(target=Sign,
+                              args=(xoauth, users[thread_number::threads], 0))
+    worker.start()
+    workers.append(worker)
+
+  for worker in workers:
+    worker.join()
+
+
+def Report(name, count, elapsed):
+  print '%-8s %9s signatures %8.2fs %12.1f signatures/s' % (
+      name, count, elapsed, count / max(elapsed, 0.000001))
+
+
+def ParseInputs():
+  """Interprets command line parameters.
+
+  Returns:
+    The options object of parsed command line options.
+  """
+
+  parser = OptionParser()
+  parser.add_option('--users', dest='users', default=100000, type='int',
+                    help='The number of users to sign strings for. '
+                    'Default = 100000')
+  parser.add_option('--threads', dest='threads', default=10, type='int',
+                    help='The number of threads for the threads benchmark. '
+                    'Default = 10')
+
+  (options, args) = parser.parse_args()
+  if args:
+    parser.print_help()
+    parser.exit(msg='\nUnexpected arguments: %s\n' % ' '.join(args))
+
+  return options
+
+
+def main():
+  options = ParseInputs()
+
+  users = ['user%s@example.com' % number for number in range(options.users)]
+  xoauth = XOAuth('example.com', 'benchmark-consumer-secret')
+
+  start = time.time()
+  Sign(xoauth, users, 0)
+  Report('sign', len(users), time.time() - start)
+
+  cached_users = users[-XOAUTH_STRING_CACHE_SIZE:]
+  start = time.time()
+  Sign(xoauth, cached_users, XOAUTH_STRING_CACHE_LIFETIME)
+  Report('cached', len(cached_users), time.time() - start)
+
+  xoauth = XOAuth('example.com', 'benchmark-consumer-secret')
+  start = time.time()
+  SignInThreads(xoauth, users, options.threads)
+  Report('threads', len(users), time.time() - start)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,246 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Google Inc. All Rights Reserved.
+"""
+DigestIndex.py remembers which messages have been seen by a digest of them.
+
+Tools that compare every message of a mailbox, such as
+imap_duplicate_check.py, keep one entry per message. Holding the full
+Message-IDs or even hash strings in a Python set costs around a hundred
+bytes a message, which large archive mailboxes processed by many threads at
+once can't afford. Both indexes here keep a 64-bit integer per message
+instead, taken from the first eight bytes of a digest such as
+hashlib.md5(key).digest():
+
+  DigestSet          A flat open-addressing table of about 12 to 24 bytes a
+                     digest, in memory
+  SQLiteDigestIndex  An SQLite table on disk behind a bounded in-memory
+                     front, which may be kept between runs along with a
+                     little state such as the last UID processed
+
+Usage:
+  from DigestIndex import DigestSet
+
+  seen = DigestSet()
+  for (uid, digest) in messages:
+    if seen.Add(digest):
+      print '%s is a duplicate' % uid
+  seen.Close()
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+###########################################################################
+DISCLAIMER:
+
+(i) GOOGLE INC. ("GOOGLE") PROVIDES YOU ALL CODE HEREIN "AS IS" WITHOUT ANY
+WARRANTIES OF ANY KIND, EXPRESS, IMPLIED, STATUTORY OR OTHERWISE, INCLUDING,
+WITHOUT LIMITATION, ANY IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NON-INFRINGEMENT; AND
+
+(ii) IN NO EVENT WILL GOOGLE BE LIABLE FOR ANY LOST REVENUES, PROFIT OR DATA,
+OR ANY DIRECT, INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE
+DAMAGES, HOWEVER CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, EVEN IF
+GOOGLE HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH DAMAGES, ARISING OUT OF
+THE USE OR INABILITY TO USE, MODIFICATION OR DISTRIBUTION OF THIS CODE OR ITS
+DERIVATIVES.
+###########################################################################
+"""
+
+import array
+import sqlite3
+import struct
+
+# The number of digests a DigestSet has room for before it first grows
+DEFAULT_DIGEST_SET_CAPACITY = 1024
+
+# The number of new digests an SQLiteDigestIndex holds in memory before
+# writing them to disk
+DEFAULT_FRONT_SIZE = 10000
+
+# Array type code of a signed 64-bit integer, where C longs are that wide
+if array.array('l').itemsize == 8:
+  _DIGEST_ARRAY_TYPE = 'l'
+else:
+  _DIGEST_ARRAY_TYPE = None
+
+
+def GetDigestValue(digest):
+  """Returns the first 8 bytes of a digest string as a signed integer."""
+  return struct.unpack('<q', digest[:8])[0]
+
+
+class DigestSet(object):
+  """A set of digests in a flat array of 64-bit integers.
+
+  Slots are probed linearly from the low bits of the digest, which are
+  already uniformly distributed, and the array doubles whenever it is two
+  thirds full. A zero digest is stored as one, since zero marks an empty
+  slot. On platforms without a 64-bit array type a Python set is used.
+  """
+
+  def __init__(self, capacity=DEFAULT_DIGEST_SET_CAPACITY):
+    size = 8
+    while size * 2 < capacity * 3:
+      size *= 2
+
+    self.count = 0
+    if _DIGEST_ARRAY_TYPE:
+      self._Allocate(size)
+    else:
+      self.values = set()
+
+  def _Allocate(self, size):
+    self.mask = size - 1
+    self.slots = array.array(_DIGEST_ARRAY_TYPE, [0]) * size
+
+  def _Insert(self, value):
+    """Stores value and returns True, or returns False if it is present."""
+    slots = self.slots
+    mask = self.mask
+    index = value & mask
+    while True:
+      current = slots[index]
+      if current == value:
+        return False
+      if not current:
+        slots[index] = value
+        return True
+      index = (index + 1) & mask
+
+  def _Grow(self):
+    old_slots = self.slots
+    self._Allocate(len(old_slots) * 2)
+    for value in old_slots:
+      if value:
+        self._Insert(value)
+
+  def Add(self, digest):
+    """Adds digest, returning True if it was already in the set."""
+    value = GetDigestValue(digest) or 1
+
+    if not _DIGEST_ARRAY_TYPE:
+      if value in self.values:
+        return True
+      self.values.add(value)
+      self.count += 1
+      return False
+
+    if not self._Insert(value):
+      return True
+    self.count += 1
+    if self.count * 3 > len(self.slots) * 2:
+      self._Grow()
+    return False
+
+  def __contains__(self, digest):
+    value = GetDigestValue(digest) or 1
+    if not _DIGEST_ARRAY_TYPE:
+      return value in self.values
+
+    slots = self.slots
+    mask = self.mask
+    index = value & mask
+    while slots[index]:
+      if slots[index] == value:
+        return True
+      index = (index + 1) & mask
+    return False
+
+  def __len__(self):
+    return self.count
+
+  def Commit(self):
+    pass
+
+  def Close(self):
+    pass
+
+
+class SQLiteDigestIndex(object):
+  """A set of digests in an SQLite table, with a bounded front in memory.
+
+  New digests are collected in a set of at most front_size entries and
+  written with a single executemany() when it fills, so disk writes are
+  batched while memory stays bounded however many messages are added. The
+  digest is the table's INTEGER PRIMARY KEY, so each costs little more
+  than its eight bytes on disk.
+
+  With the default filename of '' SQLite uses a temporary file that is
+  removed on Close(). Otherwise the digests, and any values stored with
+  SetState(), are kept for the next time the file is opened once Commit()
+  is called; Close() discards anything added since, so an interrupted
+  scan leaves the file as the last complete one did. Each index must only
+  be used from the thread that created it.
+  """
+
+  def __init__(self, filename='', front_size=DEFAULT_FRONT_SIZE):
+    self.front_size = front_size
+    self.front = set()
+    self.connection = sqlite3.connect(filename)
+    self.connection.execute(
+        'CREATE TABLE IF NOT EXISTS digests (digest INTEGER PRIMARY KEY)')
+    self.connection.execute(
+        'CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value TEXT)')
+    self.connection.commit()
+
+  def __contains__(self, digest):
+    value = GetDigestValue(digest)
+    if value in self.front:
+      return True
+    return bool(self.connection.execute(
+        'SELECT 1 FROM digests WHERE digest = ?', (value,)).fetchone())
+
+  def Add(self, digest):
+    """Adds digest, returning True if it was already in the index."""
+    if digest in self:
+      return True
+
+    self.front.add(GetDigestValue(digest))
+    if len(self.front) >= self.front_size:
+      self._Flush()
+    return False
+
+  def _Flush(self):
+    """Writes the digests held in memory to the current transaction."""
+    if self.front:
+      self.connection.executemany(
+          'INSERT OR IGNORE INTO digests (digest) VALUES (?)',
+          [(value,) for value in self.front])
+      self.front.clear()
+
+  def Clear(self):
+    """Removes every digest and all state."""
+    self.front.clear()
+    self.connection.execute('DELETE FROM digests')
+    self.connection.execute('DELETE FROM state')
+
+  def GetState(self, name, default=None):
+    row = self.connection.execute('SELECT value FROM state WHERE name = ?',
+                                  (name,)).fetchone()
+    if row is None:
+      return default
+    return row[0]
+
+  def SetState(self, name, value):
+    self.connection.execute(
+        'INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)',
+        (name, str(value)))
+
+  def Commit(self):
+    """Makes every change so far permanent."""
+    self._Flush()
+    self.connection.commit()
+
+  def __len__(self):
+    (count,) = self.connection.execute(
+        'SELECT COUNT(*) FROM digests').fetchone()
+    return count + len(self.front)
+
+  def Close(self):
+    """Closes the file, discarding any changes not committed."""
+    self.connection.close()
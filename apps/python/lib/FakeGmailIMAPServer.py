@@ -0,0 +1,831 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Google Inc. All Rights Reserved.
+"""
+FakeGmailIMAPServer.py is a local IMAP4rev1 server for testing and
+benchmarking the Gmail IMAP tools without a live Gmail account.
+
+It speaks the parts of the Gmail IMAP extensions the tools rely on:
+AUTHENTICATE XOAUTH (any credentials are accepted), XLIST, X-GM-RAW searches
+(the query itself is ignored and every message matches), X-GM-MSGID,
+X-GM-THRID and X-GM-LABELS fetches, X-GM-LABELS stores, and the CONDSTORE
+MODSEQ and HIGHESTMODSEQ items. The messages come from a SyntheticMailbox,
+which generates them on demand, so a mailbox of a million messages starts
+instantly and costs memory only for the messages whose labels change.
+
+Every response is held back by latency seconds to simulate the round trip
+to Gmail. Commands are still read while earlier responses are held back,
+so pipelined clients see the same benefit they would over a real network.
+
+Usage:
+  from FakeGmailIMAPServer import FakeGmailIMAPServer
+  from FakeGmailIMAPServer import SyntheticMailbox
+  import IMAPConnection
+
+  server = FakeGmailIMAPServer(SyntheticMailbox(100000), latency=0.05)
+  server.Start()
+
+  IMAPConnection.IMAP_HOST = server.host
+  IMAPConnection.IMAP_PORT = server.port
+  IMAPConnection.IMAP_USE_SSL = False
+  ...
+  print server.GetCommandCounts()
+  server.Stop()
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+###########################################################################
+DISCLAIMER:
+
+(i) GOOGLE INC. ("GOOGLE") PROVIDES YOU ALL CODE HEREIN "AS IS" WITHOUT ANY
+WARRANTIES OF ANY KIND, EXPRESS, IMPLIED, STATUTORY OR OTHERWISE, INCLUDING,
+WITHOUT LIMITATION, ANY IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NON-INFRINGEMENT; AND
+
+(ii) IN NO EVENT WILL GOOGLE BE LIABLE FOR ANY LOST REVENUES, PROFIT OR DATA,
+OR ANY DIRECT, INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE
+DAMAGES, HOWEVER CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, EVEN IF
+GOOGLE HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH DAMAGES, ARISING OUT OF
+THE USE OR INABILITY TO USE, MODIFICATION OR DISTRIBUTION OF THIS CODE OR ITS
+DERIVATIVES.
+###########################################################################
+"""
+
+import bisect
+import email.utils
+import Queue
+import re
+import socket
+import SocketServer
+import ssl
+import threading
+import time
+
+# The size in bytes of each generated message, headers included
+DEFAULT_MESSAGE_SIZE = 4096
+
+# The percentage of messages that repeat the Message-ID and content of an
+# earlier message
+DEFAULT_DUPLICATE_PERCENT = 10
+
+# One message in this many has no Message-ID header
+MISSING_MESSAGE_ID_INTERVAL = 500
+
+# The labels every mailbox has. INBOX and All Mail hold every message; Spam
+# and Trash are empty.
+ALL_MAIL_LABEL = '[Gmail]/All Mail'
+SYSTEM_LABELS = (
+    ('INBOX', '\\Inbox'),
+    (ALL_MAIL_LABEL, '\\AllMail'),
+    ('[Gmail]/Spam', '\\Spam'),
+    ('[Gmail]/Trash', '\\Trash'),
+)
+
+CAPABILITIES = ('IMAP4rev1 UNSELECT IDLE NAMESPACE QUOTA ID XLIST CHILDREN '
+                'X-GM-EXT-1 UIDPLUS COMPRESS=DEFLATE ENABLE MOVE CONDSTORE '
+                'ESEARCH AUTH=XOAUTH AUTH=XOAUTH2')
+
+UIDVALIDITY = 1
+
+# The first X-GM-MSGID and X-GM-THRID handed out
+GMAIL_ID_BASE = 1400000000000000000
+
+# Date of the first generated message; each later one is a minute newer
+FIRST_MESSAGE_DATE = 1356998400
+
+_TOKEN_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\()|(\))|([^\s()"]+)')
+_FETCH_ITEM_PATTERN = re.compile(
+    r'(BODY(?:\.PEEK)?\[[^\]]*\])|([A-Z0-9.\-]+)', re.IGNORECASE)
+_HEADER_FIELDS_PATTERN = re.compile(r'HEADER\.FIELDS(\.NOT)? \(([^)]*)\)',
+                                    re.IGNORECASE)
+
+
+def _Quote(text):
+  return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _ParseArguments(text):
+  """Splits command arguments into atoms, strings and nested lists."""
+  stack = [[]]
+  for (quoted, open_paren, close_paren, atom) in _TOKEN_PATTERN.findall(text):
+    if open_paren:
+      stack.append([])
+    elif close_paren:
+      if len(stack) > 1:
+        group = stack.pop()
+        stack[-1].append(group)
+    elif atom:
+      stack[-1].append(atom)
+    else:
+      stack[-1].append(re.sub(r'\\(.)', r'\1', quoted))
+  while len(stack) > 1:
+    group = stack.pop()
+    stack[-1].append(group)
+  return stack[0]
+
+
+def _ExpandSet(sequence_set, largest):
+  """Yields the numbers of an IMAP sequence set such as 1:5,7,10:*."""
+  for part in sequence_set.split(','):
+    if ':' in part:
+      (first, last) = part.split(':', 1)
+    else:
+      (first, last) = (part, part)
+    first = first == '*' and largest or int(first)
+    last = last == '*' and largest or int(last)
+    if first > last:
+      (first, last) = (last, first)
+    for number in xrange(first, last + 1):
+      yield number
+
+
+class SyntheticMailbox(object):
+  """A Gmail mailbox of generated messages.
+
+  Message n is generated from n alone whenever it is fetched. About
+  duplicate_percent in a hundred messages copy the Message-ID and content
+  of an earlier message, as mail delivered twice would, and one message in
+  MISSING_MESSAGE_ID_INTERVAL has no Message-ID at all. Recipients alternate
+  between two domains so that domain restrictions match about half of them.
+
+  Only labels created by clients, the messages copied or stored into them,
+  and the MODSEQ of changed messages are kept in memory. A single mailbox
+  may be shared by every connection to a server, and is thread-safe.
+  """
+
+  def __init__(self, message_count, message_size=DEFAULT_MESSAGE_SIZE,
+               duplicate_percent=DEFAULT_DUPLICATE_PERCENT,
+               user='user@example.com'):
+    self.message_count = message_count
+    self.message_size = message_size
+    self.duplicate_percent = duplicate_percent
+    self.user = user
+
+    self.lock = threading.Lock()
+    self.labels = {}
+    self.message_labels = {}
+    self.message_flags = {}
+    self.modseqs = {}
+    self.highest_modseq = message_count
+    self.body_filler = ('The quick brown fox jumps over the lazy dog. ' * 2 +
+                        '\r\n')
+
+  def GetOriginal(self, uid):
+    """Returns the UID of the first message with the same content as uid."""
+    while uid > 1 and (uid * 2654435761) % 100 < self.duplicate_percent:
+      uid = (uid * 40503) % (uid - 1) + 1
+    return uid
+
+  def GetLabelNames(self):
+    self.lock.acquire()
+    try:
+      return sorted(self.labels)
+    finally:
+      self.lock.release()
+
+  def _GetSystemLabel(self, label):
+    for (name, unused_flag) in SYSTEM_LABELS:
+      if label.upper() == name.upper():
+        return name
+    return None
+
+  def GetSelection(self, label):
+    """Returns a _Selection of the messages in label, or None."""
+    name = self._GetSystemLabel(label)
+    if name in ('INBOX', ALL_MAIL_LABEL):
+      return _Selection(self.message_count)
+    elif name:
+      return _Selection(self.message_count, [])
+
+    self.lock.acquire()
+    try:
+      if label not in self.labels:
+        return None
+      return _Selection(self.message_count, sorted(self.labels[label]))
+    finally:
+      self.lock.release()
+
+  def CreateLabel(self, label):
+    self.lock.acquire()
+    try:
+      if label in self.labels or self._GetSystemLabel(label):
+        return False
+      self.labels[label] = set()
+      return True
+    finally:
+      self.lock.release()
+
+  def _Touch(self, uid):
+    self.highest_modseq += 1
+    self.modseqs[uid] = self.highest_modseq
+
+  def CopyMessages(self, uids, label):
+    self.lock.acquire()
+    try:
+      if label not in self.labels:
+        return False
+      for uid in uids:
+        self.labels[label].add(uid)
+        self.message_labels.setdefault(uid, set()).add(label)
+        self._Touch(uid)
+      return True
+    finally:
+      self.lock.release()
+
+  def StoreLabels(self, uids, labels, remove=False):
+    self.lock.acquire()
+    try:
+      for uid in uids:
+        message_labels = self.message_labels.setdefault(uid, set())
+        for label in labels:
+          # System labels such as \\Inbox aren't tracked
+          if label.startswith('\\'):
+            continue
+          if label not in self.labels:
+            if remove:
+              continue
+            self.labels[label] = set()
+          if remove:
+            self.labels[label].discard(uid)
+            message_labels.discard(label)
+          else:
+            self.labels[label].add(uid)
+            message_labels.add(label)
+        self._Touch(uid)
+    finally:
+      self.lock.release()
+
+  def StoreFlags(self, uids, flags, operation):
+    self.lock.acquire()
+    try:
+      for uid in uids:
+        current = self.message_flags.get(uid, set(['\\Seen']))
+        if operation == '+':
+          current = current | set(flags)
+        elif operation == '-':
+          current = current - set(flags)
+        else:
+          current = set(flags)
+        self.message_flags[uid] = current
+        self._Touch(uid)
+    finally:
+      self.lock.release()
+
+  def GetLabels(self, uid):
+    self.lock.acquire()
+    try:
+      return sorted(self.message_labels.get(uid, ()))
+    finally:
+      self.lock.release()
+
+  def GetFlags(self, uid):
+    self.lock.acquire()
+    try:
+      return sorted(self.message_flags.get(uid, ('\\Seen',)))
+    finally:
+      self.lock.release()
+
+  def GetModseq(self, uid):
+    self.lock.acquire()
+    try:
+      return self.modseqs.get(uid, uid)
+    finally:
+      self.lock.release()
+
+  def GetHighestModseq(self):
+    self.lock.acquire()
+    try:
+      return self.highest_modseq
+    finally:
+      self.lock.release()
+
+  def GetHeader(self, uid):
+    original = self.GetOriginal(uid)
+    sender = 'sender%s@example.net' % (original % 97)
+    recipient = 'recipient%s@example.%s' % (original % 89,
+                                            original % 2 and 'org' or 'com')
+    date = email.utils.formatdate(FIRST_MESSAGE_DATE + original * 60)
+
+    header = [
+        'Return-Path: <%s>' % sender,
+        'Received: by 10.0.0.1 with SMTP id %s for <%s>; %s' % (
+            original, recipient, date),
+    ]
+    if (original - 1) % MISSING_MESSAGE_ID_INTERVAL:
+      header.append('Message-ID: <%s.synthetic@mail.example.net>' % original)
+    header.extend([
+        'Date: %s' % date,
+        'From: Sender %s <%s>' % (original % 97, sender),
+        'To: %s, %s' % (recipient, self.user),
+        'Subject: Synthetic message %s' % original,
+        'MIME-Version: 1.0',
+        'Content-Type: text/plain; charset=UTF-8',
+    ])
+    return '\r\n'.join(header) + '\r\n\r\n'
+
+  def GetBody(self, uid, header_size):
+    first_line = 'Synthetic message %s\r\n' % self.GetOriginal(uid)
+    remaining = max(self.message_size - header_size - len(first_line), 0)
+    repeats = remaining / len(self.body_filler) + 1
+    return first_line + (self.body_filler * repeats)[:remaining]
+
+  def GetMessage(self, uid):
+    header = self.GetHeader(uid)
+    return header + self.GetBody(uid, len(header))
+
+
+class _Selection(object):
+  """The messages of a label, numbered as they were when it was selected."""
+
+  def __init__(self, message_count, uids=None):
+    # uids is None when the label holds every message, UIDs 1 to count
+    self.uids = uids
+    if uids is None:
+      self.count = message_count
+    else:
+      self.count = len(uids)
+    self.uidnext = message_count + 1
+
+  def GetUids(self):
+    if self.uids is None:
+      return xrange(1, self.count + 1)
+    return self.uids
+
+  def GetLargestUid(self):
+    if self.uids is None:
+      return self.count
+    return self.uids and self.uids[-1] or 0
+
+  def GetSequenceNumber(self, uid):
+    """Returns the sequence number of uid, or None if it isn't selected."""
+    if self.uids is None:
+      if 1 <= uid <= self.count:
+        return uid
+      return None
+
+    position = bisect.bisect_left(self.uids, uid)
+    if position < len(self.uids) and self.uids[position] == uid:
+      return position + 1
+    return None
+
+  def GetUid(self, sequence_number):
+    if 1 <= sequence_number <= self.count:
+      if self.uids is None:
+        return sequence_number
+      return self.uids[sequence_number - 1]
+    return None
+
+
+class _ResponseWriter(threading.Thread):
+  """Writes each response to a client once its latency has elapsed."""
+
+  def __init__(self, wfile, latency):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.wfile = wfile
+    self.latency = latency
+    self.responses = Queue.Queue()
+
+  def Write(self, data):
+    self.responses.put((time.time() + self.latency, data))
+
+  def Close(self):
+    self.responses.put(None)
+    self.join()
+
+  def run(self):
+    while True:
+      response = self.responses.get()
+      if response is None:
+        return
+
+      (due, data) = response
+      delay = due - time.time()
+      if delay > 0:
+        time.sleep(delay)
+
+      try:
+        self.wfile.write(data)
+        self.wfile.flush()
+      except IOError:
+        return
+
+
+class _IMAPHandler(SocketServer.StreamRequestHandler):
+  """Serves the commands of one client connection."""
+
+  def setup(self):
+    SocketServer.StreamRequestHandler.setup(self)
+    self.mailbox = self.server.mailbox
+    self.selection = None
+    self.writer = _ResponseWriter(self.wfile, self.server.latency)
+    self.writer.start()
+
+  def finish(self):
+    self.writer.Close()
+    try:
+      SocketServer.StreamRequestHandler.finish(self)
+    except socket.error:
+      # The client dropped the connection
+      pass
+
+  def handle(self):
+    self.writer.Write('* OK Gimap ready for requests from %s\r\n' %
+                      self.client_address[0])
+
+    while True:
+      try:
+        line = self.rfile.readline()
+      except socket.error:
+        return
+      if not line:
+        return
+
+      parts = line.rstrip('\r\n').split(' ', 2)
+      if len(parts) < 2:
+        self.writer.Write('* BAD Could not parse command\r\n')
+        continue
+
+      tag = parts[0]
+      command = parts[1].upper()
+      arguments = len(parts) > 2 and parts[2] or ''
+      if command == 'UID':
+        (command, arguments) = (arguments.split(' ', 1) + [''])[:2]
+        command = 'UID ' + command.upper()
+      self.server.CountCommand(command)
+
+      handler = getattr(self, '_Do' + command.title().replace(' ', ''), None)
+      if handler is None:
+        self.writer.Write('%s BAD Unknown command %s\r\n' % (tag, command))
+        continue
+
+      try:
+        response = handler(tag, arguments)
+      except Exception, e:
+        response = '%s BAD Could not parse command: %s\r\n' % (tag, e)
+      self.writer.Write(response)
+
+      if command == 'LOGOUT':
+        return
+
+  def _RequireSelection(self, tag):
+    if self.selection is None:
+      return '%s BAD Command not valid in this state\r\n' % tag
+    return None
+
+  def _DoCapability(self, tag, arguments):
+    return '* CAPABILITY %s\r\n%s OK Thats all she wrote!\r\n' % (
+        CAPABILITIES, tag)
+
+  def _DoNoop(self, tag, arguments):
+    return '%s OK Success\r\n' % tag
+
+  def _DoId(self, tag, arguments):
+    return '* ID ("name" "GImap")\r\n%s OK Success\r\n' % tag
+
+  def _DoEnable(self, tag, arguments):
+    return '* ENABLED %s\r\n%s OK Success\r\n' % (arguments, tag)
+
+  def _DoLogout(self, tag, arguments):
+    return '* BYE LOGOUT Requested\r\n%s OK 73 good day (Success)\r\n' % tag
+
+  def _DoLogin(self, tag, arguments):
+    return '%s OK %s authenticated (Success)\r\n' % (tag, self.mailbox.user)
+
+  def _DoAuthenticate(self, tag, arguments):
+    self.writer.Write('+ \r\n')
+    # The XOAUTH string itself isn't checked
+    self.rfile.readline()
+    return '%s OK %s authenticated (Success)\r\n' % (tag, self.mailbox.user)
+
+  def _DoSelect(self, tag, arguments):
+    label = _ParseArguments(arguments)[0]
+    self.selection = self.mailbox.GetSelection(label)
+    if self.selection is None:
+      return '%s NO [NONEXISTENT] Unknown Mailbox: %s (Failure)\r\n' % (
+          tag, label)
+
+    return ('* FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen)\r\n'
+            '* OK [PERMANENTFLAGS (\\Answered \\Flagged \\Draft \\Deleted '
+            '\\Seen \\*)] Flags permitted.\r\n'
+            '* OK [UIDVALIDITY %s] UIDs valid.\r\n'
+            '* %s EXISTS\r\n'
+            '* 0 RECENT\r\n'
+            '* OK [UIDNEXT %s] Predicted next UID.\r\n'
+            '* OK [HIGHESTMODSEQ %s]\r\n'
+            '%s OK [READ-WRITE] %s selected. (Success)\r\n' % (
+                UIDVALIDITY, self.selection.count, self.selection.uidnext,
+                self.mailbox.GetHighestModseq(), tag, label))
+
+  _DoExamine = _DoSelect
+
+  def _DoClose(self, tag, arguments):
+    self.selection = None
+    return '%s OK Returned to authenticated state. (Success)\r\n' % tag
+
+  _DoUnselect = _DoClose
+
+  def _DoExpunge(self, tag, arguments):
+    return '%s OK Success\r\n' % tag
+
+  def _ListLabels(self, response_name, special_use):
+    lines = []
+    for (label, flag) in SYSTEM_LABELS:
+      if label == ALL_MAIL_LABEL:
+        lines.append('* %s (\\Noselect \\HasChildren) "/" "[Gmail]"\r\n' %
+                     response_name)
+      flags = '\\HasNoChildren'
+      if special_use and flag != '\\Inbox':
+        flags += ' ' + flag
+      lines.append('* %s (%s) "/" %s\r\n' % (response_name, flags,
+                                             _Quote(label)))
+    for label in self.mailbox.GetLabelNames():
+      lines.append('* %s (\\HasNoChildren) "/" %s\r\n' % (response_name,
+                                                         _Quote(label)))
+    return ''.join(lines)
+
+  def _DoList(self, tag, arguments):
+    return self._ListLabels('LIST', False) + '%s OK Success\r\n' % tag
+
+  def _DoXlist(self, tag, arguments):
+    return self._ListLabels('XLIST', True) + '%s OK Success\r\n' % tag
+
+  def _DoStatus(self, tag, arguments):
+    (label, items) = _ParseArguments(arguments)[:2]
+    selection = self.mailbox.GetSelection(label)
+    if selection is None:
+      return '%s NO [NONEXISTENT] Unknown Mailbox: %s (Failure)\r\n' % (
+          tag, label)
+
+    values = {'MESSAGES': selection.count,
+              'RECENT': 0,
+              'UIDNEXT': selection.uidnext,
+              'UIDVALIDITY': UIDVALIDITY,
+              'UNSEEN': 0,
+              'HIGHESTMODSEQ': self.mailbox.GetHighestModseq()}
+    status = ' '.join(['%s %s' % (item.upper(), values[item.upper()])
+                       for item in items])
+    return '* STATUS %s (%s)\r\n%s OK Success\r\n' % (_Quote(label), status,
+                                                     tag)
+
+  def _DoCreate(self, tag, arguments):
+    label = _ParseArguments(arguments)[0]
+    if not self.mailbox.CreateLabel(label):
+      return '%s NO [ALREADYEXISTS] Duplicate folder name %s (Failure)\r\n' % (
+          tag, label)
+    return '%s OK Success\r\n' % tag
+
+  def _Search(self, arguments, by_uid):
+    criteria = _ParseArguments(arguments)
+    selected = self.selection.GetUids()
+    matches = None
+    position = 0
+    while position < len(criteria):
+      criterion = criteria[position].upper()
+      position += 1
+      if criterion == 'UID':
+        uids = set(_ExpandSet(criteria[position],
+                              self.selection.GetLargestUid()))
+        position += 1
+        matches = [uid for uid in self._Or(matches, selected) if uid in uids]
+      elif criterion == 'MODSEQ':
+        modseq = int(criteria[position])
+        position += 1
+        matches = [uid for uid in self._Or(matches, selected)
+                   if self.mailbox.GetModseq(uid) >= modseq]
+      elif criterion == 'X-GM-RAW':
+        # Every message matches a Gmail query
+        position += 1
+    if matches is None:
+      matches = selected
+
+    if not by_uid:
+      matches = [self.selection.GetSequenceNumber(uid) for uid in matches]
+    return ' '.join(['* SEARCH'] + [str(match) for match in matches]) + '\r\n'
+
+  def _Or(self, matches, selected):
+    if matches is None:
+      return selected
+    return matches
+
+  def _DoUidSearch(self, tag, arguments):
+    return (self._RequireSelection(tag) or
+            self._Search(arguments, True) + '%s OK SEARCH completed '
+            '(Success)\r\n' % tag)
+
+  def _DoSearch(self, tag, arguments):
+    return (self._RequireSelection(tag) or
+            self._Search(arguments, False) + '%s OK SEARCH completed '
+            '(Success)\r\n' % tag)
+
+  def _SelectedUids(self, sequence_set, by_uid):
+    if by_uid:
+      for uid in _ExpandSet(sequence_set, self.selection.GetLargestUid()):
+        if self.selection.GetSequenceNumber(uid) is not None:
+          yield uid
+    else:
+      for sequence_number in _ExpandSet(sequence_set, self.selection.count):
+        uid = self.selection.GetUid(sequence_number)
+        if uid is not None:
+          yield uid
+
+  def _FetchItem(self, uid, item, message):
+    """Returns the text of one FETCH data item for a message."""
+    name = item.upper()
+    if name == 'UID':
+      return 'UID %s' % uid
+    if name == 'FLAGS':
+      return 'FLAGS (%s)' % ' '.join(self.mailbox.GetFlags(uid))
+    if name == 'INTERNALDATE':
+      return 'INTERNALDATE "%s"' % time.strftime(
+          '%d-%b-%Y %H:%M:%S +0000',
+          time.gmtime(FIRST_MESSAGE_DATE + self.mailbox.GetOriginal(uid) * 60))
+    if name == 'RFC822.SIZE':
+      return 'RFC822.SIZE %s' % len(message())
+    if name == 'X-GM-MSGID':
+      return 'X-GM-MSGID %s' % (GMAIL_ID_BASE + uid)
+    if name == 'X-GM-THRID':
+      return 'X-GM-THRID %s' % (GMAIL_ID_BASE + self.mailbox.GetOriginal(uid))
+    if name == 'X-GM-LABELS':
+      return 'X-GM-LABELS (%s)' % ' '.join(
+          ['"\\\\Inbox"'] + [_Quote(label)
+                             for label in self.mailbox.GetLabels(uid)])
+    if name == 'MODSEQ':
+      return 'MODSEQ (%s)' % self.mailbox.GetModseq(uid)
+
+    if name == 'RFC822':
+      data = message()
+    elif name == 'RFC822.HEADER':
+      data = self.mailbox.GetHeader(uid)
+    elif name == 'RFC822.TEXT':
+      data = message()[len(self.mailbox.GetHeader(uid)):]
+    elif name.startswith('BODY'):
+      name = name.replace('.PEEK', '')
+      section = name[name.index('[') + 1:-1]
+      header_fields = _HEADER_FIELDS_PATTERN.match(section)
+      if not section:
+        data = message()
+      elif section == 'HEADER':
+        data = self.mailbox.GetHeader(uid)
+      elif section == 'TEXT':
+        data = message()[len(self.mailbox.GetHeader(uid)):]
+      elif header_fields:
+        fields = set(header_fields.group(2).upper().split())
+        keep = not header_fields.group(1)
+        lines = self.mailbox.GetHeader(uid).split('\r\n')
+        data = ''.join(['%s\r\n' % line for line in lines if line and
+                        (line.split(':', 1)[0].upper() in fields) == keep])
+        data += '\r\n'
+      else:
+        raise ValueError('unsupported section %s' % section)
+    else:
+      raise ValueError('unsupported data item %s' % item)
+
+    return '%s {%s}\r\n%s' % (name, len(data), data)
+
+  def _Fetch(self, tag, arguments, by_uid):
+    (sequence_set, items) = arguments.split(' ', 1)
+    items = [body or atom for (body, atom) in _FETCH_ITEM_PATTERN.findall(
+        items.strip()[1:-1] if items.strip().startswith('(') else items)]
+    if by_uid and 'UID' not in [item.upper() for item in items]:
+      items.insert(0, 'UID')
+
+    # Literals go last, as Gmail sends them
+    items.sort(key=lambda item: '[' in item or item.upper().startswith(
+        'RFC822') and item.upper() != 'RFC822.SIZE')
+
+    lines = []
+    for uid in self._SelectedUids(sequence_set, by_uid):
+      cache = []
+
+      def Message():
+        if not cache:
+          cache.append(self.mailbox.GetMessage(uid))
+        return cache[0]
+
+      lines.append('* %s FETCH (%s)\r\n' % (
+          self.selection.GetSequenceNumber(uid),
+          ' '.join([self._FetchItem(uid, item, Message) for item in items])))
+    lines.append('%s OK Success\r\n' % tag)
+    return ''.join(lines)
+
+  def _DoUidFetch(self, tag, arguments):
+    return self._RequireSelection(tag) or self._Fetch(tag, arguments, True)
+
+  def _DoFetch(self, tag, arguments):
+    return self._RequireSelection(tag) or self._Fetch(tag, arguments, False)
+
+  def _Store(self, tag, arguments, by_uid):
+    (sequence_set, operation, values) = _ParseArguments(arguments)[:3]
+    if not isinstance(values, list):
+      values = [values]
+    uids = list(self._SelectedUids(sequence_set, by_uid))
+
+    operation = operation.upper()
+    silent = operation.endswith('.SILENT')
+    sign = operation[0] in '+-' and operation[0] or ''
+    item = operation.lstrip('+-').replace('.SILENT', '')
+    if item == 'X-GM-LABELS':
+      if sign:
+        self.mailbox.StoreLabels(uids, values, remove=sign == '-')
+      else:
+        self.mailbox.StoreLabels(uids, self.mailbox.GetLabelNames(),
+                                 remove=True)
+        self.mailbox.StoreLabels(uids, values)
+    elif item == 'FLAGS':
+      self.mailbox.StoreFlags(uids, values, sign)
+    else:
+      raise ValueError('unsupported data item %s' % item)
+
+    lines = []
+    if not silent:
+      for uid in uids:
+        lines.append('* %s FETCH (%s %s)\r\n' % (
+            self.selection.GetSequenceNumber(uid),
+            self._FetchItem(uid, 'UID', None),
+            self._FetchItem(uid, item, None)))
+    lines.append('%s OK Success\r\n' % tag)
+    return ''.join(lines)
+
+  def _DoUidStore(self, tag, arguments):
+    return self._RequireSelection(tag) or self._Store(tag, arguments, True)
+
+  def _DoStore(self, tag, arguments):
+    return self._RequireSelection(tag) or self._Store(tag, arguments, False)
+
+  def _Copy(self, tag, arguments, by_uid):
+    (sequence_set, label) = _ParseArguments(arguments)[:2]
+    uids = list(self._SelectedUids(sequence_set, by_uid))
+    if not self.mailbox.CopyMessages(uids, label):
+      return '%s NO [TRYCREATE] No folder %s (Failure)\r\n' % (tag, label)
+    return '%s OK [COPYUID %s %s %s] (Success)\r\n' % (
+        tag, UIDVALIDITY, sequence_set, sequence_set)
+
+  def _DoUidCopy(self, tag, arguments):
+    return self._RequireSelection(tag) or self._Copy(tag, arguments, True)
+
+  def _DoCopy(self, tag, arguments):
+    return self._RequireSelection(tag) or self._Copy(tag, arguments, False)
+
+
+class FakeGmailIMAPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  """A local IMAP server for a SyntheticMailbox.
+
+  Each connection is served by its own thread. The server listens on an
+  unused port of host unless port is given; host and port hold the address
+  actually used. If certfile names a PEM file with a certificate and its
+  private key, connections are encrypted, as imaplib.IMAP4_SSL expects.
+  """
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, mailbox, latency=0.0, host='127.0.0.1', port=0,
+               certfile=None):
+    SocketServer.TCPServer.__init__(self, (host, port), _IMAPHandler)
+    self.mailbox = mailbox
+    self.latency = latency
+    self.certfile = certfile
+    (self.host, self.port) = self.server_address[:2]
+
+    self.command_counts = {}
+    self.command_counts_lock = threading.Lock()
+    self.thread = None
+
+  def get_request(self):
+    (connection, address) = SocketServer.TCPServer.get_request(self)
+    if self.certfile:
+      connection = ssl.wrap_socket(connection, server_side=True,
+                                   certfile=self.certfile)
+    return (connection, address)
+
+  def Start(self):
+    """Serves connections on a background thread."""
+    self.thread = threading.Thread(target=self.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def Stop(self):
+    self.shutdown()
+    self.server_close()
+    self.thread.join()
+
+  def CountCommand(self, command):
+    self.command_counts_lock.acquire()
+    try:
+      self.command_counts[command] = self.command_counts.get(command, 0) + 1
+    finally:
+      self.command_counts_lock.release()
+
+  def GetCommandCounts(self):
+    """Returns the number of each command received so far, by name."""
+    self.command_counts_lock.acquire()
+    try:
+      return dict(self.command_counts)
+    finally:
+      self.command_counts_lock.release()
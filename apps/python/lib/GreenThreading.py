@@ -0,0 +1,191 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Google Inc. All Rights Reserved.
+"""
+GreenThreading.py runs work items concurrently on gevent greenlets.
+
+It accepts the same data_list, metadata and function(metadata, item,
+thread_number) as Threading.Threading, but each item in flight costs a
+greenlet of a few kilobytes instead of an OS thread, so a single process can
+keep thousands of Directory, Calendar or Settings API requests outstanding.
+
+Network I/O must be cooperative for this to help: gevent's monkey patching
+has to be applied before httplib, httplib2, gdata or any other module that
+opens sockets is imported, so that their blocking calls yield to other
+greenlets while waiting on the network.
+
+GreenThreading only covers the basics of Threading.Threading: retries with
+backoff, dead letters, rate limiters and latency percentiles. It has none
+of the following, so use Threading for runs that need them:
+  - stop_event, deadline, drain_timeout, Ctrl-C draining or not_started
+  - checkpoint_file and item_id, to resume an interrupted run
+  - adaptive concurrency, the process and hybrid backends, report_interval
+    and summary_file
+No tool in this repository uses it yet.
+
+Usage:
+  from gevent import monkey
+  monkey.patch_all()
+
+  from GreenThreading import GreenThreading
+
+  result = GreenThreading(users, metadata=metadata, function=UpdateUser,
+                          concurrency=2000)
+  for user in result.dead_letters:
+    ...
+
+Dependencies:
+  gevent: https://pypi.python.org/pypi/gevent
+  Threading.py, from this directory
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+###########################################################################
+DISCLAIMER:
+
+(i) GOOGLE INC. ("GOOGLE") PROVIDES YOU ALL CODE HEREIN "AS IS" WITHOUT ANY
+WARRANTIES OF ANY KIND, EXPRESS, IMPLIED, STATUTORY OR OTHERWISE, INCLUDING,
+WITHOUT LIMITATION, ANY IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NON-INFRINGEMENT; AND
+
+(ii) IN NO EVENT WILL GOOGLE BE LIABLE FOR ANY LOST REVENUES, PROFIT OR DATA,
+OR ANY DIRECT, INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE
+DAMAGES, HOWEVER CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, EVEN IF
+GOOGLE HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH DAMAGES, ARISING OUT OF
+THE USE OR INABILITY TO USE, MODIFICATION OR DISTRIBUTION OF THIS CODE OR ITS
+DERIVATIVES.
+###########################################################################
+"""
+
+import logging
+import time
+
+try:
+  import gevent
+  import gevent.event
+  import gevent.pool
+except ImportError:
+  gevent = None
+
+from Threading import DEFAULT_MAX_RETRIES
+from Threading import DEFAULT_MAX_RETRY_DELAY
+from Threading import DEFAULT_RETRY_DELAY
+from Threading import LatencyHistogram
+from Threading import RetryPolicy
+from Threading import Task
+from Threading import ThrottledError
+
+# The default number of items processed at once
+DEFAULT_CONCURRENCY = 1000
+
+
+class GreenThreading(object):
+  """Processes every item of data_list with function on a pool of greenlets.
+
+  At most concurrency items are processed at once; reading data_list pauses
+  while the pool is full, so it may be a generator of any length. Failed
+  items are retried with the same RetryPolicy as Threading, using a gevent
+  timer rather than a sleeping greenlet for the backoff, and collected in
+  dead_letters once they run out of retries. Each RateLimiter in
+  rate_limiters is acquired before every attempt.
+
+  thread_number passed to function is a slot number between 0 and
+  concurrency - 1 that no other item in progress is using at the same time.
+  """
+
+  def __init__(self, data_list, metadata={}, function=None,
+               concurrency=DEFAULT_CONCURRENCY, debug_level=0,
+               max_retries=DEFAULT_MAX_RETRIES,
+               retry_delay=DEFAULT_RETRY_DELAY,
+               max_retry_delay=DEFAULT_MAX_RETRY_DELAY, rate_limiters=()):
+    if gevent is None:
+      raise ImportError('GreenThreading requires gevent')
+
+    self.data_list = data_list
+    self.metadata = metadata
+    self.function = function
+    self.concurrency = concurrency
+    self.debug_level = debug_level
+    self.retry_policy = RetryPolicy(max_retries, retry_delay, max_retry_delay)
+    self.rate_limiters = rate_limiters
+    self.dead_letters = []
+    self.histogram = LatencyHistogram()
+    self.success = 0
+    self.failure = 0
+
+    self.pool = gevent.pool.Pool(self.concurrency)
+    self.free_slots = range(self.concurrency)
+    self.outstanding = 0
+    self.feeding = True
+    self.finished = gevent.event.Event()
+    self.start_time = time.time()
+
+    for item in data_list:
+      self.outstanding += 1
+      # spawn() waits for a free greenlet in the pool
+      self.pool.spawn(self._Process, Task(item))
+
+    self.feeding = False
+    if self.outstanding:
+      self.finished.wait()
+    self.end_time = time.time()
+
+    if self.debug_level > 0:
+      self.Report()
+
+  def _Process(self, task):
+    for rate_limiter in self.rate_limiters:
+      rate_limiter.Acquire(rate_limiter.GetKey(self.metadata, task.item))
+
+    task.attempts += 1
+    slot = self.free_slots.pop()
+    start = time.time()
+
+    try:
+      succeeded = self.function(metadata=self.metadata, item=task.item,
+                                thread_number=slot)
+    except ThrottledError, e:
+      logging.warning('Slot #%s: Throttled processing item: %s', slot, e)
+      succeeded = False
+    except Exception, e:
+      logging.warning('Slot #%s: Exception processing item: %s', slot, e)
+      succeeded = False
+
+    self.histogram.Record(time.time() - start)
+    self.free_slots.append(slot)
+
+    if succeeded:
+      self.success += 1
+      self._Done()
+    elif self.retry_policy.ShouldRetry(task):
+      self.failure += 1
+      gevent.spawn_later(self.retry_policy.GetDelay(task), self.pool.spawn,
+                         self._Process, task)
+    else:
+      self.failure += 1
+      logging.error('Giving up on item after %s attempts.', task.attempts)
+      self.dead_letters.append(task.item)
+      self._Done()
+
+  def _Done(self):
+    self.outstanding -= 1
+    if not self.outstanding and not self.feeding:
+      self.finished.set()
+
+  def Report(self):
+    elapsed = max(self.end_time - self.start_time, 0.001)
+    print('Items attempted: %s\n'
+          '  Successes: %s\n'
+          '  Failures: %s\n'
+          '  Dead letters: %s\n'
+          '  Items per second: %.1f\n'
+          '  Latency p50 %.3fs p95 %.3fs p99 %.3fs\n' % (
+              self.success + self.failure, self.success, self.failure,
+              len(self.dead_letters), self.success / elapsed,
+              self.histogram.Percentile(50), self.histogram.Percentile(95),
+              self.histogram.Percentile(99)))
@@ -30,92 +30,532 @@ Gmail account using IMAP. It is not comprehensive in the functionality it
 offers.
 """
 
+import collections
 import imaplib
+import itertools
+import random
+import re
+import socket
+import StringIO
+import tempfile
+import threading
 import time
 
-from datetime import datetime
+from XOAuth import XOAUTH_STRING_CACHE_LIFETIME
+
+# The IMAP server IMAPConnection connects to. A test server such as
+# FakeGmailIMAPServer can be used instead by changing these before
+# connecting.
+IMAP_HOST = 'imap.gmail.com'
+IMAP_PORT = 993
+IMAP_USE_SSL = True
+
+# A connection that has been idle for longer than this many seconds is
+# probed with NOOP before it is used again, and replaced if it doesn't answer
+IMAP_LIVENESS_CHECK_INTERVAL = 60
+
+# A dropped session is reconnected up to RECONNECT_ATTEMPTS times in a row,
+# waiting a random time of up to RECONNECT_DELAY seconds before the first
+# attempt, doubling up to MAX_RECONNECT_DELAY seconds for each later one
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+
+# The most idle connections an IMAPConnectionPool keeps open for each
+# (user, label)
+DEFAULT_MAX_IDLE_CONNECTIONS = 10
+
+# The number of messages requested by each UID FETCH command of a batch
+DEFAULT_FETCH_CHUNK_SIZE = 500
+
+# The default number of commands an IMAPPipeline keeps in flight
+DEFAULT_PIPELINE_DEPTH = 8
+
+# The number of messages changed by each UID STORE command of a batch
+DEFAULT_STORE_CHUNK_SIZE = 1000
+
+# Message literals larger than this many bytes are written to a temporary
+# file by GetMessageFile rather than held in memory, and are copied from the
+# socket SPOOL_READ_SIZE bytes at a time
+DEFAULT_SPOOL_THRESHOLD = 1024 * 1024
+SPOOL_READ_SIZE = 64 * 1024
+
+# Markers for parentheses in a tokenized FETCH response, distinct from any
+# atom or string
+_OPEN = object()
+_CLOSE = object()
+
+_LITERAL_PATTERN = re.compile(r'\{(\d+)\}$')
+_QUOTED_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
+# Errors after which a session can't be used any more, but a new one may work
+_SESSION_ERRORS = (imaplib.IMAP4.abort, socket.error)
+
+
+def CompressUidSet(message_locators):
+  """Compresses UIDs into an IMAP sequence set, e.g. '1:3,7,9:10'.
+
+  Args:
+    message_locators: An iterable of UIDs, as strings or integers
+
+  Returns:
+    A sequence set string listing every UID once, in ascending order.
+  """
+  uids = sorted(set([int(locator) for locator in message_locators]))
+
+  ranges = []
+  for uid in uids:
+    if ranges and ranges[-1][1] == uid - 1:
+      ranges[-1][1] = uid
+    else:
+      ranges.append([uid, uid])
+
+  return ','.join([start == end and str(start) or '%s:%s' % (start, end)
+                   for (start, end) in ranges])
+
+
+def GetReconnectDelay(attempt):
+  """Returns a randomized delay before reconnect attempt 1, 2, ..."""
+  return random.uniform(0, min(MAX_RECONNECT_DELAY,
+                               RECONNECT_DELAY * 2 ** (attempt - 1)))
+
+
+def QuoteLabel(label):
+  """Returns a label as an IMAP quoted string."""
+  return '"%s"' % label.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _TokenizeFetchText(text, tokens):
+  position = 0
+  while position < len(text):
+    character = text[position]
+    if character == ' ':
+      position += 1
+    elif character == '(':
+      tokens.append(_OPEN)
+      position += 1
+    elif character == ')':
+      tokens.append(_CLOSE)
+      position += 1
+    elif character == '"':
+      match = _QUOTED_PATTERN.match(text, position)
+      if not match:
+        raise imaplib.IMAP4.error('Unterminated quoted string in FETCH '
+                                  'response: %r' % text[position:])
+      tokens.append(re.sub(r'\\(.)', r'\1', match.group(1)))
+      position = match.end()
+    else:
+      # An atom, which may contain a bracketed section with spaces and
+      # parentheses, e.g. BODY[HEADER.FIELDS (MESSAGE-ID)]
+      start = position
+      depth = 0
+      while position < len(text):
+        character = text[position]
+        if character == '[':
+          depth += 1
+        elif character == ']':
+          depth -= 1
+        elif not depth and character in ' ()':
+          break
+        position += 1
+      atom = text[start:position]
+      tokens.append(atom != 'NIL' and atom or None)
+
+
+def _TokenizeFetchResponse(data):
+  tokens = []
+  for element in data:
+    if element is None:
+      continue
+    if isinstance(element, tuple):
+      (text, literal) = element
+      _TokenizeFetchText(_LITERAL_PATTERN.sub('', text), tokens)
+      tokens.append(literal)
+    else:
+      _TokenizeFetchText(element, tokens)
+
+  return tokens
+
+
+def _ParseFetchValue(tokens, position):
+  if position >= len(tokens):
+    raise imaplib.IMAP4.error('Truncated FETCH response')
+  if tokens[position] is _CLOSE:
+    raise imaplib.IMAP4.error('Unbalanced ")" in FETCH response')
+  if tokens[position] is not _OPEN:
+    return (tokens[position], position + 1)
+
+  values = []
+  position += 1
+  while position >= len(tokens) or tokens[position] is not _CLOSE:
+    (value, position) = _ParseFetchValue(tokens, position)
+    values.append(value)
+  return (values, position + 1)
+
+
+def ParseFetchResponse(data):
+  """Parses the data returned by imaplib for a FETCH or UID FETCH command.
+
+  Args:
+    data: The list returned by imaplib, holding strings and (text, literal)
+        tuples, possibly for many messages
+
+  Yields:
+    A dictionary for each message, mapping each data item name in upper
+    case, e.g. 'UID', 'RFC822.SIZE', 'X-GM-LABELS' or
+    'BODY[HEADER.FIELDS (MESSAGE-ID)]', to its value. Note that the server
+    reports BODY.PEEK[...] items as BODY[...]. Parenthesized values become
+    lists and NIL becomes None; everything else is returned as a string.
+
+  Raises:
+    imaplib.IMAP4.error if data is not a well-formed FETCH response.
+  """
+  tokens = _TokenizeFetchResponse(data)
+
+  # Each message is "<sequence number> (<name> <value> ...)"
+  position = 0
+  while position < len(tokens):
+    (values, position) = _ParseFetchValue(tokens, position + 1)
+    if not isinstance(values, list) or len(values) % 2:
+      raise imaplib.IMAP4.error('Malformed FETCH response: %r' % (values,))
+    attributes = {}
+    for index in range(0, len(values), 2):
+      if not isinstance(values[index], basestring):
+        raise imaplib.IMAP4.error('Malformed FETCH data item name: %r' %
+                                  (values[index],))
+      attributes[values[index].upper()] = values[index + 1]
+    yield attributes
+
+
+class PipelinedCommand(object):
+  """The eventual result of a command sent through an IMAPPipeline."""
+
+  def __init__(self, pipeline, tag, response_name):
+    self.pipeline = pipeline
+    self.tag = tag
+    self.response_name = response_name
+    self.done = False
+    self.result = None
+    self.data = None
+    self.error = None
+
+  def Result(self):
+    """Waits for the command to complete.
+
+    Returns:
+      A (result, data) tuple, as imaplib would have returned it.
+
+    Raises:
+      imaplib.IMAP4.error if the server answered BAD.
+    """
+    self.pipeline.WaitFor(self)
+    if self.error:
+      raise self.error
+    return (self.result, self.data)
+
+
+class IMAPPipeline(object):
+  """Keeps several tagged commands in flight on one IMAP connection.
+
+  imaplib waits for each command's tagged response before it returns, so a
+  series of commands costs one round trip each. A pipeline sends up to
+  depth commands before reading any response and matches responses to
+  commands by tag, so the round trips overlap.
+
+  Untagged responses (FETCH or SEARCH data) are attributed to the command
+  whose completion follows them, which is correct for servers that run the
+  commands of a connection in order, as Gmail does. The pipeline is not
+  thread-safe, and the connection must not be used for anything else while
+  commands are in flight.
+
+  Usage:
+    pipeline = connection.Pipeline()
+    futures = [pipeline.UID('FETCH', uid_set, '(RFC822.SIZE)')
+               for uid_set in uid_sets]
+    for future in futures:
+      (result, data) = future.Result()
+  """
+
+  def __init__(self, connection, depth=DEFAULT_PIPELINE_DEPTH):
+    self.imap = connection.connection
+    self.depth = depth
+    self.in_flight = collections.deque()
+
+  def Submit(self, name, *args):
+    """Sends a command without waiting for its response.
+
+    Args:
+      name: An imaplib command name, e.g. 'UID', 'SELECT' or 'NOOP'
+      args: The command's arguments, as they would be passed to imaplib
+
+    Returns:
+      A PipelinedCommand.
+    """
+    while len(self.in_flight) >= self.depth:
+      self.WaitFor(self.in_flight[0])
+
+    # imaplib.uid() and friends report the data of these untagged responses
+    if name == 'UID':
+      if args[0].upper() in ('SEARCH', 'SORT', 'THREAD'):
+        response_name = args[0].upper()
+      else:
+        response_name = 'FETCH'
+    elif name == 'STORE':
+      response_name = 'FETCH'
+    else:
+      response_name = name
+
+    tag = self.imap._command(name, *args)
+    command = PipelinedCommand(self, tag, response_name)
+    self.in_flight.append(command)
+    return command
+
+  def UID(self, command, *args):
+    return self.Submit('UID', command, *args)
+
+  def WaitFor(self, command):
+    """Reads responses until command has completed."""
+    while not command.done:
+      self.imap._get_response()
+      self._CollectCompleted()
+
+  def Flush(self):
+    """Waits for every command in flight."""
+    while self.in_flight:
+      self.WaitFor(self.in_flight[-1])
+
+  def _CollectCompleted(self):
+    for command in self.in_flight:
+      response = self.imap.tagged_commands.get(command.tag)
+      if response is not None:
+        break
+    else:
+      return
+
+    # Everything received since the previous completion belongs to command
+    untagged = self.imap.untagged_responses
+    self.imap.untagged_responses = {}
+    del self.imap.tagged_commands[command.tag]
+    self.in_flight.remove(command)
+
+    (command.result, data) = response
+    if command.result == 'BAD':
+      command.error = self.imap.error('%s command error: %s %s' % (
+          command.response_name, command.result, data))
+    elif command.result == 'OK':
+      data = untagged.get(command.response_name, [None])
+    command.data = data
+    command.done = True
+
+
+def _SpoolingRead(read, imap, size):
+  if imap.spool_threshold is None or size <= imap.spool_threshold:
+    return read(imap, size)
+
+  spool = tempfile.TemporaryFile()
+  remaining = size
+  while remaining:
+    data = read(imap, min(remaining, SPOOL_READ_SIZE))
+    spool.write(data)
+    remaining -= len(data)
+
+  spool.seek(0)
+  return spool
+
+
+class SpoolingIMAP4_SSL(imaplib.IMAP4_SSL):
+  """An IMAP4_SSL that can stream large literals into temporary files.
+
+  While spool_threshold is set, any literal larger than that many bytes is
+  copied from the socket in SPOOL_READ_SIZE pieces into an anonymous
+  temporary file, and the file, rewound, takes the place of the string in
+  the response data.
+  """
+
+  spool_threshold = None
+
+  def read(self, size):
+    return _SpoolingRead(imaplib.IMAP4_SSL.read, self, size)
 
-# The longest period of time during which an open IMAP connection should be
-# reused, in seconds.
-IMAP_CONNECTION_MAX_DURATION = 300
+
+class SpoolingIMAP4(imaplib.IMAP4):
+  """SpoolingIMAP4_SSL for unencrypted connections, e.g. to a test server."""
+
+  spool_threshold = None
+
+  def read(self, size):
+    return _SpoolingRead(imaplib.IMAP4.read, self, size)
 
 
 class IMAPConnection(object):
-  def __init__(self, imap_debug=0, xoauth_string=''):
+  """A Gmail IMAP session that recovers from dropped connections.
+
+  The session is opened on first use. When a command fails because the
+  connection dropped, the session is reopened, after a jittered exponential
+  delay, with the same label selected, and the command is sent again, up to
+  RECONNECT_ATTEMPTS times in a row. A session that has been idle for a
+  while is probed with NOOP before it is used; a healthy one is kept for as
+  long as it works.
+
+  If xoauth, an XOAuth signer, is given, the XOAUTH string for user is
+  signed when it is first needed and signed again only when it is older
+  than XOAUTH_STRING_CACHE_LIFETIME or the server rejects it. Otherwise
+  xoauth_string is used as is. Authentication failures are raised as
+  imaplib.IMAP4.error.
+  """
+
+  def __init__(self, imap_debug=0, xoauth_string='', user=None, xoauth=None):
     self.imap_debug = imap_debug
     self.xoauth_string = xoauth_string
+    self.xoauth_signed = 0
+    self.user = user
+    self.xoauth = xoauth
 
     self.connection = None
-    self.connection_start = datetime(1, 1, 1)
+    self.last_used = 0
     self.label = None
 
+  def _GetXOAuthString(self, force=False):
+    if self.xoauth and self.user and (
+        force or not self.xoauth_string or
+        time.time() - self.xoauth_signed > XOAUTH_STRING_CACHE_LIFETIME):
+      # Each connection signs its own string, so that connections to the
+      # same user, e.g. in a pool, never log in with the same nonce
+      self.xoauth_string = self.xoauth.GetXOAuthString(self.user, 'GET',
+                                                       'imap')
+      self.xoauth_signed = time.time()
+    return self.xoauth_string
+
   def _Connect(self):
-    self.connection_start = datetime.now()
-    self.connection = imaplib.IMAP4_SSL('imap.gmail.com', 993)
-    self.connection.debug = self.imap_debug
+    if IMAP_USE_SSL:
+      connection = SpoolingIMAP4_SSL(IMAP_HOST, IMAP_PORT)
+    else:
+      connection = SpoolingIMAP4(IMAP_HOST, IMAP_PORT)
+    connection.debug = self.imap_debug
 
+    xoauth_string = self._GetXOAuthString()
     try:
-      self.connection.authenticate('XOAUTH', lambda x: self.xoauth_string)
-    except Exception, e:
-      return
+      connection.authenticate('XOAUTH', lambda x: xoauth_string)
+    except imaplib.IMAP4.abort:
+      raise
+    except imaplib.IMAP4.error:
+      if not (self.xoauth and self.user):
+        connection.shutdown()
+        raise
+
+      # The string may have expired; it can only be signed again
+      xoauth_string = self._GetXOAuthString(force=True)
+      try:
+        connection.authenticate('XOAUTH', lambda x: xoauth_string)
+      except imaplib.IMAP4.error:
+        connection.shutdown()
+        raise
 
     if self.label:
-      self.connection.select(self.label)
+      (result, unused_data) = connection.select(self.label)
+      if result != 'OK':
+        connection.shutdown()
+        raise imaplib.IMAP4.error('Could not select %s again' % self.label)
+
+    self.connection = connection
+
+  def _Drop(self):
+    """Abandons a broken connection without logging out."""
+    if self.connection is not None:
+      try:
+        self.connection.shutdown()
+      except Exception, e:
+        pass
+    self.connection = None
 
   def Close(self):
+    if self.connection is None:
+      return
+
     try:
       self.connection.close()
       self.connection.logout()
     except Exception, e:
-      self.connection = None
+      pass
+    self.connection = None
 
   def _CheckRefresh(self):
-    if ((datetime.now() - self.connection_start).seconds >
-        IMAP_CONNECTION_MAX_DURATION):
-      self.Close()
+    """Makes sure there is a working session before a command is sent."""
+    if (self.connection is not None and
+        time.time() - self.last_used > IMAP_LIVENESS_CHECK_INTERVAL and
+        not self.IsAlive()):
+      self._Drop()
+
+    if self.connection is None:
       self._Connect()
+    self.last_used = time.time()
 
-  def GetMessageLocatorsInLabel(self, label, query):
-    self._CheckRefresh()
+  def _Retry(self, function):
+    """Calls function, reconnecting and calling it again if the session drops.
+
+    Raises:
+      The last session error if every reconnect attempt failed, or
+      imaplib.IMAP4.error if authentication failed.
+    """
+    attempt = 0
+    while True:
+      try:
+        self._CheckRefresh()
+        return function()
+      except _SESSION_ERRORS, e:
+        attempt += 1
+        if attempt > RECONNECT_ATTEMPTS:
+          raise
+        self._Drop()
+        time.sleep(GetReconnectDelay(attempt))
+
+  def _Call(self, command, *args):
+    """Runs an imaplib command, such as 'uid' or 'select', with _Retry."""
+    return self._Retry(lambda: getattr(self.connection, command)(*args))
+
+  def Select(self, label):
+    (result, unused_data) = self._Call('select', label)
+    if result != 'OK':
+      return False
+
+    self.label = label
+    return True
+
+  def IsAlive(self):
+    """Checks with a NOOP that the server still answers on this connection."""
+    if self.connection is None:
+      return False
 
     try:
-      (result, unused_data) = self.connection.select(label)
+      (result, unused_data) = self.connection.noop()
+    except Exception, e:
+      return False
+
+    return result == 'OK'
+
+  def GetMessageLocatorsInLabel(self, label, query):
+    try:
+      (result, unused_data) = self._Call('select', label)
     except Exception, e:
       return []
  
     self.label = label
 
-    unused_type, data = self.connection.uid('SEARCH', 'X-GM-RAW', query)
+    unused_type, data = self._Call('uid', 'SEARCH', 'X-GM-RAW', query)
 
     return data[0].split()
 
   def List(self):
-    self._CheckRefresh()
-
     try:
-      (unused_data, list) = self.connection.list()
+      (unused_data, list) = self._Call('list')
     except Exception, e:
       list = []
 
     return list
     
   def GetMessage(self, message_locator):
-    self._CheckRefresh()
-
-    remaining_tries = 4
-    while remaining_tries >= 0:
-      try:
-        (result, message_info) = self.connection.uid('FETCH', message_locator,
-                                                     '(RFC822)')
-
-        remaining_tries = -1
-      except Exception, e:
-        if remaining_tries == 0:
-          raise
-        remaining_tries -= 1
-        time.sleep(3)
-        self.Close()
-        self._Connect()
+    (result, message_info) = self._Call('uid', 'FETCH', message_locator,
+                                        '(RFC822)')
 
     message = ''
     if message_info:
@@ -126,21 +566,333 @@ class IMAPConnection(object):
 
     return message
 
-  def AddLabel(self, message_locator, label):
+  def Pipeline(self, depth=DEFAULT_PIPELINE_DEPTH):
+    """Returns an IMAPPipeline for sending commands without waiting."""
     self._CheckRefresh()
+    return IMAPPipeline(self, depth)
+
+  def GetMessageFile(self, message_locator,
+                     spool_threshold=DEFAULT_SPOOL_THRESHOLD):
+    """Returns a message as a file-like object, spooling large ones to disk.
+
+    Unlike GetMessage, a message over spool_threshold bytes never exists as
+    a string: it is streamed from the socket into a temporary file, which
+    upload and parsing code can read from directly. Smaller messages are
+    wrapped in a StringIO. The caller should close the returned object.
+
+    Returns:
+      A file-like object positioned at the start of the message, or None if
+      the message no longer exists.
+    """
+    def Fetch():
+      connection = self.connection
+      connection.spool_threshold = spool_threshold
+      try:
+        return connection.uid('FETCH', message_locator, '(RFC822)')
+      finally:
+        connection.spool_threshold = None
+
+    (result, message_info) = self._Retry(Fetch)
+
+    for attributes in ParseFetchResponse(message_info):
+      message = attributes.get('RFC822')
+      if isinstance(message, basestring):
+        return StringIO.StringIO(message)
+      if message is not None:
+        return message
+
+    return None
+
+  def FetchMessages(self, message_locators, data_items='(RFC822)',
+                    chunk_size=DEFAULT_FETCH_CHUNK_SIZE,
+                    pipeline_depth=DEFAULT_PIPELINE_DEPTH):
+    """Fetches data items for many messages with few round trips.
+
+    The UIDs are requested chunk_size at a time, each chunk compressed into
+    a single sequence set, with up to pipeline_depth chunks in flight at
+    once. Results are yielded as each chunk arrives.
+
+    Args:
+      message_locators: An iterable of UIDs in the selected label
+      data_items: The FETCH data items, e.g. '(RFC822.SIZE X-GM-LABELS)' or
+          '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])'
+      chunk_size: The number of messages per UID FETCH command
+      pipeline_depth: The number of UID FETCH commands in flight at once
+
+    Yields:
+      A (locator, attributes) tuple per message, as parsed by
+      ParseFetchResponse. Messages that no longer exist are left out.
+
+    Raises:
+      imaplib.IMAP4.error if the server rejects a FETCH command.
+    """
+    message_locators = iter(message_locators)
+    # Each entry is [uid_set, command], command being None until it is sent
+    pending = collections.deque()
+    pipeline = None
+    attempt = 0
+    while True:
+      chunk = list(itertools.islice(message_locators, chunk_size))
+      if chunk:
+        pending.append([CompressUidSet(chunk), None])
+        if len(pending) < pipeline_depth:
+          continue
+      elif not pending:
+        return
+
+      try:
+        if pipeline is None:
+          self._CheckRefresh()
+          pipeline = IMAPPipeline(self, pipeline_depth)
+        for entry in pending:
+          if entry[1] is None:
+            entry[1] = pipeline.UID('FETCH', entry[0], data_items)
+        (result, data) = pending[0][1].Result()
+      except _SESSION_ERRORS, e:
+        # Send everything that was in flight again on a new session
+        attempt += 1
+        if attempt > RECONNECT_ATTEMPTS:
+          raise
+        self._Drop()
+        pipeline = None
+        for entry in pending:
+          entry[1] = None
+        time.sleep(GetReconnectDelay(attempt))
+        continue
+
+      attempt = 0
+      self.last_used = time.time()
+      pending.popleft()
+      if result != 'OK':
+        raise imaplib.IMAP4.error('FETCH failed: %s' % data)
+
+      for attributes in ParseFetchResponse(data):
+        if 'UID' in attributes:
+          yield (attributes['UID'], attributes)
+
+  def FilterMessageLocators(self, message_locators, header_fields, predicate,
+                            chunk_size=DEFAULT_FETCH_CHUNK_SIZE,
+                            pipeline_depth=DEFAULT_PIPELINE_DEPTH):
+    """Selects messages by their headers without downloading their bodies.
+
+    Only BODY.PEEK[HEADER.FIELDS (header_fields)] is fetched for each
+    message, in batches as FetchMessages does.
+
+    Args:
+      message_locators: An iterable of UIDs in the selected label
+      header_fields: The names of the header fields predicate needs
+      predicate: A function called with the text of those header fields of
+          a message, which returns True if the message should be kept
+
+    Returns:
+      A list of the locators of the messages predicate kept.
+    """
+    data_items = '(BODY.PEEK[HEADER.FIELDS (%s)])' % ' '.join(
+        header_fields).upper()
+
+    matching = []
+    for (locator, attributes) in self.FetchMessages(
+        message_locators, data_items, chunk_size, pipeline_depth):
+      header_text = ''
+      for (name, value) in attributes.iteritems():
+        if name.startswith('BODY[HEADER') and value:
+          header_text = value
+      if predicate(header_text):
+        matching.append(locator)
+
+    return matching
+
+  def FetchMatchingMessages(self, message_locators, header_fields, predicate,
+                            data_items='(RFC822)',
+                            chunk_size=DEFAULT_FETCH_CHUNK_SIZE,
+                            pipeline_depth=DEFAULT_PIPELINE_DEPTH):
+    """Fetches data items only for messages whose headers pass predicate.
+
+    The candidates are taken chunk_size * pipeline_depth at a time: their
+    headers are fetched and checked with FilterMessageLocators, then
+    data_items are fetched for the matching ones only, so the bytes
+    transferred grow with the number of matches rather than candidates.
+
+    Yields:
+      A (locator, attributes) tuple per matching message, as FetchMessages
+      does.
+    """
+    message_locators = iter(message_locators)
+    while True:
+      candidates = list(itertools.islice(message_locators,
+                                         chunk_size * pipeline_depth))
+      if not candidates:
+        return
+
+      matching = self.FilterMessageLocators(candidates, header_fields,
+                                            predicate, chunk_size,
+                                            pipeline_depth)
+      for message in self.FetchMessages(matching, data_items, chunk_size,
+                                        pipeline_depth):
+        yield message
 
+  def AddLabel(self, message_locator, label):
+    """Adds a Gmail label to one message; see StoreLabels for many."""
+    return self.StoreLabels([message_locator], label)
+
+  def StoreLabels(self, message_locators, label, remove=False,
+                  chunk_size=DEFAULT_STORE_CHUNK_SIZE):
+    """Adds a Gmail label to, or removes it from, many messages at once.
+
+    Each chunk of UIDs is changed by a single
+    UID STORE <set> +X-GM-LABELS.SILENT command (-X-GM-LABELS.SILENT to
+    remove), with no COPY or EXPUNGE.
+
+    Returns:
+      True if every chunk was stored, False otherwise.
+    """
+    operation = remove and '-X-GM-LABELS.SILENT' or '+X-GM-LABELS.SILENT'
+    labels = '(%s)' % QuoteLabel(label)
+
+    message_locators = iter(message_locators)
+    while True:
+      chunk = list(itertools.islice(message_locators, chunk_size))
+      if not chunk:
+        return True
+
+      try:
+        (result, unused_data) = self._Call(
+            'uid', 'STORE', CompressUidSet(chunk), operation, labels)
+      except Exception, e:
+        return False
+      if result != 'OK':
+        return False
+
+  def CreateLabel(self, label):
     try:
-      self.connection.uid('COPY', message_locator, label)
-      self.connection.expunge()
+      self._Call('create', label)
       return True
     except Exception, e:
       return False
 
-  def CreateLabel(self, label):
-    self._CheckRefresh()
 
+class IMAPConnectionPool(object):
+  """A thread-safe pool of authenticated IMAPConnections.
+
+  Connections are kept per (user, label), and a checked out connection
+  already has its label selected, so each worker thread can reuse one
+  session for many messages instead of logging in for every one. An idle
+  connection probes itself with NOOP when it is next used, and reconnects
+  if needed.
+
+  Usage:
+    connection = pool.Checkout(user, xoauth_string, label)
     try:
-      self.connection.create(label)
-      return True
+      message = connection.GetMessage(locator)
     except Exception, e:
-      return False
+      pool.Return(connection, discard=True)
+      raise
+    pool.Return(connection)
+  """
+
+  def __init__(self, imap_debug=0, max_idle=DEFAULT_MAX_IDLE_CONNECTIONS):
+    self.imap_debug = imap_debug
+    self.max_idle = max_idle
+    self.idle = {}
+    self.lock = threading.Lock()
+
+  def Checkout(self, user, xoauth_string, label, xoauth=None):
+    """Returns a connection for user with label selected.
+
+    Args:
+      xoauth: An optional XOAuth signer, used by new connections to sign
+          xoauth_string again when it gets too old
+
+    Raises:
+      imaplib.IMAP4.error if a new connection cannot select label.
+    """
+    key = (user, label)
+    self.lock.acquire()
+    try:
+      connections = self.idle.get(key)
+      if connections:
+        return connections.pop()
+    finally:
+      self.lock.release()
+
+    connection = IMAPConnection(imap_debug=self.imap_debug,
+                                xoauth_string=xoauth_string, user=user,
+                                xoauth=xoauth)
+    if not connection.Select(label):
+      connection.Close()
+      raise imaplib.IMAP4.error('Could not select %s for %s' % (label, user))
+
+    return connection
+
+  def Return(self, connection, discard=False):
+    """Hands a connection back for reuse, or closes it if discard is set."""
+    if not discard:
+      key = (connection.user, connection.label)
+      self.lock.acquire()
+      try:
+        connections = self.idle.setdefault(key, [])
+        if len(connections) < self.max_idle:
+          connections.append(connection)
+          return
+      finally:
+        self.lock.release()
+
+    connection.Close()
+
+  def CloseAll(self):
+    self.lock.acquire()
+    try:
+      idle = self.idle
+      self.idle = {}
+    finally:
+      self.lock.release()
+
+    for connections in idle.values():
+      for connection in connections:
+        connection.Close()
+
+
+class LabelBatcher(object):
+  """Collects messages to label and labels them in large batches.
+
+  Add() may be called from any number of threads. Every batch_size
+  messages, and on Flush(), the collected UIDs are labelled with a single
+  StoreLabels call on connection, which must have the messages' label
+  selected and should not be used by other threads at the same time.
+  """
+
+  def __init__(self, connection, label, remove=False,
+               batch_size=DEFAULT_STORE_CHUNK_SIZE):
+    self.connection = connection
+    self.label = label
+    self.remove = remove
+    self.batch_size = batch_size
+    self.pending = []
+    self.failed = []
+    self.lock = threading.Lock()
+
+  def Add(self, message_locator):
+    self.lock.acquire()
+    try:
+      self.pending.append(message_locator)
+      if len(self.pending) >= self.batch_size:
+        self._Flush()
+    finally:
+      self.lock.release()
+
+  def Flush(self):
+    """Labels the collected messages; failures are kept in self.failed."""
+    self.lock.acquire()
+    try:
+      self._Flush()
+    finally:
+      self.lock.release()
+
+  def _Flush(self):
+    if not self.pending:
+      return
+
+    if not self.connection.StoreLabels(self.pending, self.label, self.remove,
+                                       self.batch_size):
+      self.failed.extend(self.pending)
+    self.pending = []
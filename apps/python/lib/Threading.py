@@ -29,67 +29,1011 @@ DERIVATIVES.
 This library contains functions to make process threading easier.
 """
 
+import collections
+import heapq
+import json
+import logging
+import math
+import multiprocessing
+import os
 import Queue
+import random
+import sys
 import threading
+import time
+
+# The number of additional attempts made on an item whose work function
+# fails, before the item is moved to the dead-letter list
+DEFAULT_MAX_RETRIES = 5
+# The delay before the first retry of an item, in seconds; it doubles with
+# each further attempt up to DEFAULT_MAX_RETRY_DELAY
+DEFAULT_RETRY_DELAY = 1.0
+DEFAULT_MAX_RETRY_DELAY = 60.0
+
+# Tuning of the adaptive concurrency controller: the factor applied to the
+# number of active workers on congestion, the weight given to each new
+# observation in the smoothed error rate and the error rate above which
+# the controller backs off
+CONCURRENCY_DECREASE_FACTOR = 0.5
+CONCURRENCY_SMOOTHING = 0.1
+CONCURRENCY_MAX_ERROR_RATE = 0.2
+
+# Item latencies are counted in buckets whose bounds grow by
+# HISTOGRAM_BUCKET_RATIO from HISTOGRAM_MIN_LATENCY seconds, which keeps the
+# error of a reported percentile under 10% for latencies up to about a day
+HISTOGRAM_MIN_LATENCY = 0.0001
+HISTOGRAM_BUCKET_RATIO = 2 ** 0.125
+HISTOGRAM_BUCKETS = 240
+
+# How often the number of completed items is sampled, and the windows over
+# which throughput is reported, in seconds
+THROUGHPUT_SAMPLE_INTERVAL = 5
+THROUGHPUT_WINDOWS = (60, 300)
+
+# The checkpoint journal is flushed and fsync'd after this many newly
+# completed items, or on the first completion this many seconds after the
+# last sync
+CHECKPOINT_SYNC_ITEMS = 1000
+CHECKPOINT_SYNC_INTERVAL = 5.0
+
+# How often, in seconds, a blocked producer or the waiting caller checks
+# for a stop request or an expired deadline
+STOP_POLL_INTERVAL = 1.0
+# The default time, in seconds, that a stopping run waits for items in
+# progress to finish
+DEFAULT_DRAIN_TIMEOUT = 60.0
+
+
+class ThrottledError(Exception):
+  """Raised by a work function when the API reports rate or quota limits.
+
+  For example on an HTTP 429 or 503 response or a quota exceeded error. The
+  item is retried like any other failure, and an adaptive Threading run
+  also reduces the number of items it processes at once.
+  """
+
+
+class Interrupted(KeyboardInterrupt):
+  """Raised by Threading after Ctrl-C, once the items in progress drained.
+
+  run is the interrupted Threading object, so that its not_started,
+  dead_letters, unread and Summary() can still be reported.
+  """
+
+  def __init__(self, run):
+    KeyboardInterrupt.__init__(self)
+    self.run = run
+
+
+class Task(object):
+  """An item of work and the number of attempts made to process it."""
+
+  def __init__(self, item, item_id=None):
+    self.item = item
+    self.item_id = item_id
+    self.attempts = 0
+
+
+class CheckpointJournal(object):
+  """An append-only file listing the ids of completed items, one per line.
+
+  Writes are synced to disk in batches, so a crash loses at most the last
+  CHECKPOINT_SYNC_ITEMS ids (those items are simply processed again). A
+  line left incomplete by a crash is discarded. Ids must not contain
+  newlines.
+  """
+
+  def __init__(self, filename, sync_items=CHECKPOINT_SYNC_ITEMS,
+               sync_interval=CHECKPOINT_SYNC_INTERVAL):
+    self.filename = filename
+    self.sync_items = sync_items
+    self.sync_interval = sync_interval
+    self.completed = set()
+    self.lock = threading.Lock()
+
+    valid_length = 0
+    if os.path.exists(filename):
+      journal = open(filename, 'r')
+      for line in journal:
+        if line.endswith('\n'):
+          self.completed.add(line[:-1])
+          valid_length += len(line)
+      journal.close()
+
+    self.journal = open(filename, 'a')
+    self.journal.truncate(valid_length)
+    self.pending = 0
+    self.last_sync = time.time()
+
+  def IsCompleted(self, item_id):
+    return item_id in self.completed
+
+  def Record(self, item_id):
+    self.lock.acquire()
+    try:
+      self.journal.write('%s\n' % item_id)
+      self.pending += 1
+      if (self.pending >= self.sync_items or
+          time.time() - self.last_sync >= self.sync_interval):
+        self._Sync()
+    finally:
+      self.lock.release()
+
+  def _Sync(self):
+    self.journal.flush()
+    os.fsync(self.journal.fileno())
+    self.pending = 0
+    self.last_sync = time.time()
+
+  def Close(self):
+    self.lock.acquire()
+    try:
+      self._Sync()
+      self.journal.close()
+    finally:
+      self.lock.release()
+
+
+class RetryPolicy(object):
+  """Decides whether and when a failed task is attempted again."""
+
+  def __init__(self, max_retries=DEFAULT_MAX_RETRIES,
+               retry_delay=DEFAULT_RETRY_DELAY,
+               max_retry_delay=DEFAULT_MAX_RETRY_DELAY):
+    self.max_retries = max_retries
+    self.retry_delay = retry_delay
+    self.max_retry_delay = max_retry_delay
+
+  def ShouldRetry(self, task):
+    return task.attempts <= self.max_retries
+
+  def GetDelay(self, task):
+    """Returns the jittered exponential backoff for the task's next attempt.
+
+    The delay falls between half and all of the exponential value, so that
+    items which failed together do not all come back at the same moment.
+    """
+    delay = min(self.max_retry_delay,
+                self.retry_delay * 2 ** (task.attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+class WorkQueue(Queue.Queue):
+  """A Queue.Queue whose maxsize only applies to new work.
+
+  Items handed back by a Worker for another attempt bypass the bound, so a
+  worker can never block on the very queue it is draining.
+  """
+
+  def Requeue(self, item):
+    """Puts an item that is already counted as unfinished back on the queue."""
+    self.not_full.acquire()
+    try:
+      self._put(item)
+      self.not_empty.notify()
+    finally:
+      self.not_full.release()
+
+
+class RetryScheduler(threading.Thread):
+  """Holds failed tasks on a delay heap until they are due for another try.
+
+  Workers hand a task over and immediately move on to other work; this
+  thread requeues each task once its backoff delay has passed.
+  """
+
+  def __init__(self, work_queue):
+    threading.Thread.__init__(self)
+
+    self.work_queue = work_queue
+    self.heap = []
+    self.sequence = 0
+    self.stopped = False
+    self.condition = threading.Condition()
+
+  def Schedule(self, task, delay):
+    """Holds task for delay seconds, or returns False once Drain() is called.
+
+    A task that is refused is left for the caller to account for, since
+    the tasks returned by Drain() have already been collected.
+    """
+    self.condition.acquire()
+    try:
+      if self.stopped:
+        return False
+      # The sequence number keeps tasks with equal due times in FIFO order
+      self.sequence += 1
+      heapq.heappush(self.heap, (time.time() + delay, self.sequence, task))
+      self.condition.notify()
+      return True
+    finally:
+      self.condition.release()
+
+  def run(self):
+    while True:
+      self.condition.acquire()
+      try:
+        while (not self.stopped and
+               (not self.heap or self.heap[0][0] > time.time())):
+          if self.heap:
+            self.condition.wait(self.heap[0][0] - time.time())
+          else:
+            self.condition.wait()
+        if self.stopped:
+          return
+        (unused_due_time, unused_sequence, task) = heapq.heappop(self.heap)
+      finally:
+        self.condition.release()
+
+      self.work_queue.Requeue(task)
+
+  def Drain(self):
+    """Stops the scheduler and returns the tasks still waiting on it."""
+    self.condition.acquire()
+    try:
+      self.stopped = True
+      tasks = [task for (unused_due_time, unused_sequence, task)
+               in sorted(self.heap)]
+      self.heap = []
+      self.condition.notify()
+    finally:
+      self.condition.release()
+
+    self.join()
+    return tasks
+
+
+class ConcurrencyController(object):
+  """Limits how many workers process items at once, using AIMD.
+
+  The limit starts at min_limit. Each success within target_latency seconds
+  grows it by 1/limit, i.e. by about one worker per round of requests. A
+  ThrottledError, an overly slow item or a smoothed error rate above
+  CONCURRENCY_MAX_ERROR_RATE multiplies it by CONCURRENCY_DECREASE_FACTOR,
+  at most once per smoothed item latency so that a single burst of errors
+  only counts once.
+  """
+
+  def __init__(self, min_limit=1, max_limit=10, target_latency=None):
+    self.min_limit = min_limit
+    self.max_limit = max_limit
+    self.target_latency = target_latency
+    self.limit = float(min_limit)
+    self.active = 0
+    self.error_rate = 0.0
+    self.latency = 0.0
+    self.last_decrease = 0.0
+    self.condition = threading.Condition()
+
+  def Acquire(self):
+    """Blocks until the calling worker may start on an item."""
+    self.condition.acquire()
+    try:
+      while self.active >= int(self.limit):
+        self.condition.wait()
+      self.active += 1
+    finally:
+      self.condition.release()
+
+  def Release(self, latency, succeeded, throttled=False):
+    """Records the outcome of an item and adjusts the limit accordingly.
+
+    Args:
+      latency: The time taken to process the item, in seconds
+      succeeded: Whether the work function reported success
+      throttled: Whether the work function raised a ThrottledError
+    """
+    self.condition.acquire()
+    try:
+      self.active -= 1
+      self.latency += CONCURRENCY_SMOOTHING * (latency - self.latency)
+      self.error_rate += CONCURRENCY_SMOOTHING * ((not succeeded) -
+                                                  self.error_rate)
+
+      slow = self.target_latency and latency > self.target_latency
+      if (throttled or slow or
+          self.error_rate > CONCURRENCY_MAX_ERROR_RATE):
+        self._Decrease()
+      elif succeeded:
+        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+      self.condition.notifyAll()
+    finally:
+      self.condition.release()
+
+  def _Decrease(self):
+    now = time.time()
+    if now - self.last_decrease < self.latency:
+      return
+
+    self.last_decrease = now
+    self.limit = max(self.min_limit,
+                     self.limit * CONCURRENCY_DECREASE_FACTOR)
+    logging.debug('Concurrency reduced to %d workers.', int(self.limit))
+
+
+class TokenBucket(object):
+  """Paces callers to a sustained rate while allowing short bursts.
+
+  Tokens accrue at rate per second up to burst. A caller that finds too few
+  tokens reserves them anyway and sleeps off its own debt, so waiting
+  callers are released one by one at the sustained rate instead of all
+  retrying at once.
+  """
+
+  def __init__(self, rate, burst=None):
+    self.rate = float(rate)
+    self.burst = burst or max(1.0, self.rate)
+    self.tokens = float(self.burst)
+    self.last_refill = time.time()
+    self.lock = threading.Lock()
+
+  def Acquire(self, tokens=1):
+    """Blocks until tokens may be spent, then spends them."""
+    self.lock.acquire()
+    try:
+      now = time.time()
+      self.tokens = min(self.burst,
+                        self.tokens + (now - self.last_refill) * self.rate)
+      self.last_refill = now
+      self.tokens -= tokens
+      delay = -self.tokens / self.rate
+    finally:
+      self.lock.release()
+
+    if delay > 0:
+      time.sleep(delay)
+
+
+class RateLimiter(object):
+  """A TokenBucket per key, e.g. per user, per API or per domain.
+
+  key_function is called as key_function(metadata=..., item=...) to find the
+  key an item is charged to; without one all items share a single bucket.
+  A work function that makes several API calls per item may also call
+  Acquire itself, e.g. on a limiter passed to it in metadata.
+  """
+
+  def __init__(self, rate, burst=None, key_function=None):
+    self.rate = rate
+    self.burst = burst
+    self.key_function = key_function
+    self.buckets = {}
+    self.lock = threading.Lock()
+
+  def GetKey(self, metadata, item):
+    if self.key_function:
+      return self.key_function(metadata=metadata, item=item)
+    return None
+
+  def Acquire(self, key=None, tokens=1):
+    self.lock.acquire()
+    try:
+      bucket = self.buckets.get(key)
+      if bucket is None:
+        bucket = TokenBucket(self.rate, self.burst)
+        self.buckets[key] = bucket
+    finally:
+      self.lock.release()
+
+    bucket.Acquire(tokens)
+
+
+class LatencyHistogram(object):
+  """Counts latencies in fixed, logarithmically spaced buckets."""
+
+  def __init__(self):
+    self.counts = [0] * HISTOGRAM_BUCKETS
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def Record(self, latency):
+    if latency <= HISTOGRAM_MIN_LATENCY:
+      index = 0
+    else:
+      index = min(HISTOGRAM_BUCKETS - 1,
+                  int(math.log(latency / HISTOGRAM_MIN_LATENCY,
+                               HISTOGRAM_BUCKET_RATIO)) + 1)
+
+    self.counts[index] += 1
+    self.count += 1
+    self.total += latency
+    self.max = max(self.max, latency)
+
+  def Merge(self, other):
+    for index, count in enumerate(other.counts):
+      self.counts[index] += count
+    self.count += other.count
+    self.total += other.total
+    self.max = max(self.max, other.max)
+
+  def Percentile(self, percentile):
+    """Returns the upper bound of the bucket holding the given percentile."""
+    rank = percentile / 100.0 * self.count
+    seen = 0
+    for index, count in enumerate(self.counts):
+      seen += count
+      if count and seen >= rank:
+        return min(self.max,
+                   HISTOGRAM_MIN_LATENCY * HISTOGRAM_BUCKET_RATIO ** index)
+    return 0.0
+
+  def Mean(self):
+    if not self.count:
+      return 0.0
+    return self.total / self.count
+
+
+class Monitor(threading.Thread):
+  """Samples the progress of a Threading run and periodically logs it."""
+
+  def __init__(self, pool, report_interval=None):
+    threading.Thread.__init__(self)
+
+    self.pool = pool
+    self.report_interval = report_interval
+    self.samples = collections.deque()
+    self.stopped = threading.Event()
+
+  def run(self):
+    last_report = time.time()
+    while not self.stopped.isSet():
+      self.stopped.wait(THROUGHPUT_SAMPLE_INTERVAL)
+      self.Sample()
+
+      if (self.report_interval and
+          time.time() - last_report >= self.report_interval):
+        last_report = time.time()
+        logging.info(self.pool.FormatProgress())
+
+  def Stop(self):
+    self.stopped.set()
+    self.join()
+
+  def Sample(self):
+    now = time.time()
+    self.samples.append((now, self.pool.GetCompleted()))
+    while self.samples[0][0] < now - max(THROUGHPUT_WINDOWS):
+      self.samples.popleft()
+
+  def GetThroughput(self, window):
+    """Returns the items completed per second over the last window seconds."""
+    (latest_time, latest_completed) = self.samples[-1]
+    for (sample_time, completed) in self.samples:
+      if sample_time >= latest_time - window:
+        if latest_time > sample_time:
+          return (latest_completed - completed) / (latest_time - sample_time)
+        break
+    return 0.0
+
+
+# The work function and metadata of the Threading run that started the
+# current pool process; see _InitializeProcess
+_process_function = None
+_process_metadata = None
+
+
+def _InitializeProcess(function, metadata):
+  """Stores the work function and metadata once per pool process."""
+  global _process_function
+  global _process_metadata
+  _process_function = function
+  _process_metadata = metadata
+
+
+def _CallInProcess(item, thread_number):
+  return _process_function(metadata=_process_metadata, item=item,
+                           thread_number=thread_number)
+
+
+class ThreadBackend(object):
+  """Runs the work function directly on the worker threads."""
+
+  def __init__(self, function, metadata):
+    self.function = function
+    self.metadata = metadata
+
+  def Call(self, item, thread_number):
+    return self.function(metadata=self.metadata, item=item,
+                         thread_number=thread_number)
+
+  def Close(self):
+    pass
+
+
+class ProcessBackend(object):
+  """Runs the work function in a pool of processes.
+
+  The worker threads dispatch items to the pool and wait for the results,
+  so retries, rate limiting, concurrency control and reporting behave as
+  with threads while the function itself runs outside the GIL. The
+  function must be defined at module level, and metadata, items and return
+  values must be picklable. metadata is sent to each process once.
+  """
+
+  def __init__(self, function, metadata, processes=None):
+    self.pool = multiprocessing.Pool(processes, _InitializeProcess,
+                                     (function, metadata))
+
+  def Call(self, item, thread_number):
+    return self.pool.apply(_CallInProcess, (item, thread_number))
+
+  def Close(self):
+    self.pool.close()
+    self.pool.join()
+
+
+class HybridBackend(ProcessBackend):
+  """Runs I/O on the worker threads and CPU-bound work in a process pool.
+
+  function is called on the worker thread, e.g. to download a message, and
+  returns the data to be processed; a false value counts as a failure.
+  cpu_function is then called in a pool process with that data as its item,
+  e.g. to parse it, and its return value decides whether the item
+  succeeded.
+  """
+
+  def __init__(self, function, cpu_function, metadata, processes=None):
+    ProcessBackend.__init__(self, cpu_function, metadata, processes)
+    self.thread_backend = ThreadBackend(function, metadata)
+
+  def Call(self, item, thread_number):
+    data = self.thread_backend.Call(item, thread_number)
+    if not data:
+      return data
+
+    return ProcessBackend.Call(self, data, thread_number)
 
 
 class Worker(threading.Thread):
-  def __init__(self, thread_number, work_queue, metadata={}, function=None):
+  def __init__(self, thread_number, work_queue, metadata={}, function=None,
+               retry_policy=None, retry_scheduler=None, dead_letters=None,
+               concurrency=None, rate_limiters=(), backend=None,
+               journal=None, stop_event=None, not_started=None):
     threading.Thread.__init__(self)
 
     self.thread_number = thread_number
     self.work_queue = work_queue
     self.metadata = metadata
     self.function = function
+    self.retry_policy = retry_policy or RetryPolicy()
+    self.retry_scheduler = retry_scheduler
+    self.dead_letters = dead_letters
+    self.concurrency = concurrency
+    self.rate_limiters = rate_limiters
+    self.backend = backend or ThreadBackend(function, metadata)
+    self.journal = journal
+    self.stop_event = stop_event or threading.Event()
+    self.not_started = not_started
     self.success = 0
     self.failure = 0
+    self.dead = 0
+    self.histogram = LatencyHistogram()
 
   def run(self):
     while True:
-      item = self.work_queue.get()
-      if self.function(metadata=self.metadata, item=item,
-                       thread_number=self.thread_number):
+      task = self.work_queue.get()
+      # None is the sentinel telling a worker to exit
+      if task is None:
+        break
+
+      for rate_limiter in self.rate_limiters:
+        if self.stop_event.isSet():
+          break
+        rate_limiter.Acquire(rate_limiter.GetKey(self.metadata, task.item))
+
+      if self.stop_event.isSet():
+        self._Abandon(task)
+        continue
+
+      task.attempts += 1
+      if self.concurrency:
+        self.concurrency.Acquire()
+      start = time.time()
+      throttled = False
+
+      try:
+        succeeded = self.backend.Call(task.item, self.thread_number)
+      except ThrottledError, e:
+        logging.warning('Thread #%s: Throttled processing item: %s',
+                        self.thread_number, e)
+        succeeded = False
+        throttled = True
+      except Exception, e:
+        logging.warning('Thread #%s: Exception processing item: %s',
+                        self.thread_number, e)
+        succeeded = False
+
+      latency = time.time() - start
+      self.histogram.Record(latency)
+      if self.concurrency:
+        self.concurrency.Release(latency, succeeded, throttled)
+
+      if succeeded:
+        if self.journal:
+          self.journal.Record(task.item_id)
         self.work_queue.task_done()
         self.success += 1
       else:
-        self.work_queue.put(item)
         self.failure += 1
+        self._Retry(task)
+
+  def _Abandon(self, task):
+    if self.not_started is not None:
+      self.not_started.append(task.item)
+    self.work_queue.task_done()
+
+  def _Retry(self, task):
+    if not self.retry_policy.ShouldRetry(task):
+      logging.error('Thread #%s: Giving up on item after %s attempts.',
+                    self.thread_number, task.attempts)
+      if self.dead_letters is not None:
+        self.dead_letters.append(task.item)
+      self.dead += 1
+      self.work_queue.task_done()
+    elif self.stop_event.isSet():
+      # The backlog may already have been collected, so count the item as
+      # not started rather than queue it again
+      self._Abandon(task)
+    elif self.retry_scheduler:
+      if not self.retry_scheduler.Schedule(task,
+                                           self.retry_policy.GetDelay(task)):
+        self._Abandon(task)
+    else:
+      self.work_queue.Requeue(task)
 
   def Report(self):
     print('Thread #%s:\n'
           '  Items attempted: %s\n'
           '    Successes: %s\n'
-          '    Failures: %s\n' % (self.thread_number,
-                                  self.success + self.failure,
-                                  self.success, self.failure))
+          '    Failures: %s\n'
+          '    Dead letters: %s\n' % (self.thread_number,
+                                      self.success + self.failure,
+                                      self.success, self.failure,
+                                      self.dead))
 
 
 class Threading(object):
+  """Processes every item of data_list with function on a pool of threads.
+
+  data_list may be any iterable, including a generator. Workers are started
+  before the first item is read, so items are processed while the rest of
+  data_list is still being produced. If queue_size is greater than zero, at
+  most that many items are buffered ahead of the workers and the producer
+  blocks until there is room, keeping memory flat for very large inputs.
+
+  An item whose function returns a false value or raises is retried up to
+  max_retries more times, after a jittered exponential backoff that starts
+  at retry_delay seconds and is capped at max_retry_delay. Items that use up
+  their retries are collected in the dead_letters attribute.
+
+  If adaptive is set, threads is the most workers that will process items
+  at once; a ConcurrencyController starts at min_threads and finds the
+  highest concurrency the API sustains without ThrottledErrors, errors or
+  items taking longer than target_latency seconds.
+
+  rate_limiters is a list of RateLimiter objects; before each attempt on an
+  item, a worker waits for a token from every one of them.
+
+  Every attempt is timed. If report_interval is set, progress, latency
+  percentiles and throughput are logged every report_interval seconds;
+  Summary() returns the same figures for the whole run, and they are
+  written as JSON to summary_file if one is given.
+
+  backend selects where function runs: 'thread' (the default) calls it on
+  the worker threads; 'process' calls it in a pool of processes (see
+  ProcessBackend); 'hybrid' calls function on the threads and passes its
+  result to cpu_function in the pool (see HybridBackend). processes is the
+  size of the pool and defaults to the number of CPUs.
+
+  If checkpoint_file is given, the id of each successfully processed item,
+  as returned by item_id(item), is recorded in a CheckpointJournal, and
+  items already recorded there by an earlier run are skipped. The number
+  of skipped items is kept in the skipped attribute.
+
+  A run stops early when stop_event is set (e.g. from a signal handler),
+  when deadline seconds have passed since it started, or on Ctrl-C. No
+  further items are started: items already in progress are given up to
+  drain_timeout seconds to finish, items that were queued or waiting to be
+  retried are collected in the not_started attribute, and the stopped
+  attribute is set. Input that was not yet read from data_list is left
+  unread: the unread attribute is then an iterator over it (None once all
+  of data_list was read), and items_read counts the items that were. On
+  Ctrl-C an Interrupted exception, a KeyboardInterrupt holding this object,
+  is raised once the run has drained. An error raised while reading
+  data_list or item_id stops the run the same way, and is re-raised once
+  the journal has been closed.
+  """
+
   def __init__(self, data_list, metadata={}, function=None, threads=10,
-               debug_level=0):
+               debug_level=0, queue_size=0, max_retries=DEFAULT_MAX_RETRIES,
+               retry_delay=DEFAULT_RETRY_DELAY,
+               max_retry_delay=DEFAULT_MAX_RETRY_DELAY, adaptive=False,
+               min_threads=1, target_latency=None, rate_limiters=(),
+               report_interval=None, summary_file=None, backend='thread',
+               processes=None, cpu_function=None, checkpoint_file=None,
+               item_id=str, stop_event=None, deadline=None,
+               drain_timeout=DEFAULT_DRAIN_TIMEOUT):
     self.data_list = data_list
     self.metadata = metadata
     self.function = function
     self.threads = threads
     self.debug_level = debug_level
+    self.queue_size = queue_size
+    self.retry_policy = RetryPolicy(max_retries, retry_delay, max_retry_delay)
+    self.dead_letters = []
+    self.rate_limiters = rate_limiters
+    self.skipped = 0
+    self.items_read = 0
+    self.unread = None
+    self.not_started = []
+    self.stopped = False
+    self.stop_event = stop_event or threading.Event()
 
-    self.work_queue = Queue.Queue()
+    self.journal = None
+    if checkpoint_file:
+      self.journal = CheckpointJournal(checkpoint_file)
+      logging.info('Resuming with %s items completed in earlier runs.',
+                   len(self.journal.completed))
 
-    for item in data_list:
-      self.work_queue.put(item)
+    self.concurrency = None
+    if adaptive:
+      self.concurrency = ConcurrencyController(min_threads, self.threads,
+                                               target_latency)
 
-    threads = []
+    if backend == 'thread':
+      self.backend = ThreadBackend(self.function, self.metadata)
+    elif backend == 'process':
+      self.backend = ProcessBackend(self.function, self.metadata, processes)
+    elif backend == 'hybrid':
+      self.backend = HybridBackend(self.function, cpu_function,
+                                   self.metadata, processes)
+    else:
+      raise ValueError('Unknown backend: %s' % backend)
+
+    self.work_queue = WorkQueue(self.queue_size)
+    self.start_time = time.time()
+    self.end_time = None
+    self.deadline = None
+    if deadline:
+      self.deadline = self.start_time + deadline
+
+    self.retry_scheduler = RetryScheduler(self.work_queue)
+    self.retry_scheduler.setDaemon(True)
+    self.retry_scheduler.start()
+
+    self.workers = []
     # Spawn a pool of threads to process auditing checks
     for thread_number in range(self.threads):
       thread = Worker(thread_number, self.work_queue, self.metadata,
-                      self.function)
+                      self.function, self.retry_policy, self.retry_scheduler,
+                      self.dead_letters, self.concurrency,
+                      self.rate_limiters, self.backend, self.journal,
+                      self.stop_event, self.not_started)
       thread.setDaemon(True)
-      threads.append(thread)
+      self.workers.append(thread)
       thread.start()
 
-    # wait on the queue until everything has been processed
-    self.work_queue.join()
+    self.monitor = Monitor(self, report_interval)
+    self.monitor.setDaemon(True)
+    self.monitor.Sample()
+    self.monitor.start()
+
+    interrupted = False
+    try:
+      self._Feed(data_list, item_id)
+      self._WaitForCompletion()
+    except KeyboardInterrupt:
+      logging.warning('Interrupted, finishing the items in progress.')
+      self.stop_event.set()
+      interrupted = True
+    except:
+      # The workers, backend and journal are still shut down before the
+      # error is raised, so that completions recorded so far are kept
+      error = sys.exc_info()
+      logging.error('Stopping after an error reading items: %s', error[1])
+      self.stop_event.set()
+      try:
+        self._Close(drain_timeout)
+      except Exception, e:
+        logging.error('Error shutting down after the failure: %s', e)
+      raise error[0], error[1], error[2]
+
+    self._Close(drain_timeout)
 
     if self.debug_level > 0:
-      for thread in threads:
+      for thread in self.workers:
         thread.Report()
+      if self.concurrency:
+        print('Final concurrency: %d of %d threads\n' %
+              (int(self.concurrency.limit), self.threads))
+      # Items that were never attempted belong to no worker
+      if self.not_started:
+        print('Items not started: %s\n' % len(self.not_started))
+      print(self.FormatProgress())
+
+    if summary_file:
+      summary = open(summary_file, 'w')
+      json.dump(self.Summary(), summary, indent=2, sort_keys=True)
+      summary.close()
+
+    if interrupted:
+      raise Interrupted(self)
+
+  def _Close(self, drain_timeout):
+    """Stops the workers and monitor and closes the backend and journal."""
+    try:
+      try:
+        self._Shutdown(drain_timeout)
+      finally:
+        self.monitor.Stop()
+        self.backend.Close()
+    finally:
+      if self.journal:
+        self.journal.Close()
+      self.end_time = time.time()
+
+  def Stop(self):
+    """Asks the run to stop starting new items."""
+    self.stop_event.set()
+
+  def _ShouldStop(self):
+    if (self.deadline and time.time() > self.deadline and
+        not self.stop_event.isSet()):
+      logging.warning('Deadline reached, no further items will be started.')
+      self.stop_event.set()
+    return self.stop_event.isSet()
+
+  def _Feed(self, data_list, item_id):
+    items = iter(data_list)
+    self.unread = items
+    # Stop requests are checked before reading an item, so that every item
+    # read is either queued or counted as not started
+    while not self._ShouldStop():
+      try:
+        item = items.next()
+      except StopIteration:
+        self.unread = None
+        return
+      self.items_read += 1
+
+      task = Task(item)
+      if self.journal:
+        task.item_id = item_id(item)
+        if self.journal.IsCompleted(task.item_id):
+          self.skipped += 1
+          continue
+
+      # put() blocks while a bounded queue is full, so wake up periodically
+      # to notice a stop request. An item that is never queued, including
+      # on Ctrl-C, is counted as not started.
+      queued = False
+      try:
+        while not queued:
+          try:
+            self.work_queue.put(task, timeout=STOP_POLL_INTERVAL)
+            queued = True
+          except Queue.Full:
+            if self._ShouldStop():
+              return
+      finally:
+        if not queued:
+          self.not_started.append(item)
+
+  def _WaitForCompletion(self):
+    # Unlike Queue.join(), a timed wait lets Ctrl-C through
+    condition = self.work_queue.all_tasks_done
+    while not self._ShouldStop():
+      condition.acquire()
+      try:
+        if not self.work_queue.unfinished_tasks:
+          return
+        condition.wait(STOP_POLL_INTERVAL)
+      finally:
+        condition.release()
+
+  def _Shutdown(self, drain_timeout):
+    """Collects the unstarted backlog and lets the workers exit."""
+    self.stopped = self.stop_event.isSet()
+    for task in self.retry_scheduler.Drain():
+      self.not_started.append(task.item)
+      self.work_queue.task_done()
+
+    while True:
+      try:
+        task = self.work_queue.get_nowait()
+      except Queue.Empty:
+        break
+      self.not_started.append(task.item)
+      self.work_queue.task_done()
+
+    for unused_worker in self.workers:
+      self.work_queue.Requeue(None)
+
+    deadline = time.time() + drain_timeout
+    for worker in self.workers:
+      worker.join(max(0, deadline - time.time()))
+
+    in_flight = len([worker for worker in self.workers if worker.isAlive()])
+    if in_flight:
+      logging.warning('%s items were still in progress after %ss.',
+                      in_flight, drain_timeout)
+    if self.not_started:
+      logging.warning('%s items were not started.', len(self.not_started))
+    if self.unread is not None:
+      unread_items = self.GetUnreadCount()
+      if unread_items is None:
+        logging.warning('Input after the first %s items was not read.',
+                        self.items_read)
+      else:
+        logging.warning('%s items of input were not read.', unread_items)
+
+  def GetUnreadCount(self):
+    """Returns how many items of data_list were not read, if it is known.
+
+    Only a data_list with a length, such as a list, can be counted without
+    reading the rest of it; None is returned for other input left unread.
+    """
+    if self.unread is None:
+      return 0
+    try:
+      return len(self.data_list) - self.items_read
+    except TypeError:
+      return None
+
+  def GetCompleted(self):
+    return sum([worker.success for worker in self.workers])
+
+  def GetQueueDepth(self):
+    return self.work_queue.qsize() + len(self.retry_scheduler.heap)
+
+  def GetHistogram(self):
+    histogram = LatencyHistogram()
+    for worker in self.workers:
+      histogram.Merge(worker.histogram)
+    return histogram
+
+  def Summary(self):
+    """Returns counts, latency percentiles and throughput for the run."""
+    elapsed = (self.end_time or time.time()) - self.start_time
+    histogram = self.GetHistogram()
+
+    summary = {
+        'elapsed_seconds': elapsed,
+        'attempts': histogram.count,
+        'successes': self.GetCompleted(),
+        'failures': sum([worker.failure for worker in self.workers]),
+        'dead_letters': len(self.dead_letters),
+        'skipped': self.skipped,
+        'not_started': len(self.not_started),
+        'items_read': self.items_read,
+        'unread_items': self.GetUnreadCount(),
+        'stopped': self.stopped,
+        'queue_depth': self.GetQueueDepth(),
+        'items_per_second': self.GetCompleted() / max(elapsed, 0.001),
+        'latency_seconds': {
+            'mean': histogram.Mean(),
+            'p50': histogram.Percentile(50),
+            'p95': histogram.Percentile(95),
+            'p99': histogram.Percentile(99),
+            'max': histogram.max,
+        },
+    }
+    for window in THROUGHPUT_WINDOWS:
+      summary['items_per_second_%ss' % window] = (
+          self.monitor.GetThroughput(window))
+
+    return summary
+
+  def FormatProgress(self):
+    summary = self.Summary()
+    latency = summary['latency_seconds']
+    windows = ', '.join(['%.1f/s (%ss)' % (
+        summary['items_per_second_%ss' % window], window)
+                         for window in THROUGHPUT_WINDOWS])
+    return ('Completed %s items in %.0fs (%s), %s failures, %s queued; '
+            'latency p50 %.3fs p95 %.3fs p99 %.3fs' % (
+                summary['successes'], summary['elapsed_seconds'], windows,
+                summary['failures'], summary['queue_depth'],
+                latency['p50'], latency['p95'], latency['p99']))
@@ -17,6 +17,11 @@ Usage:
   imap_conenction = imaplib.IMAP4_SSL(imap_server, imap_port)
   imap_connection.authenticate('XOAUTH', lambda x: xoauth_string)
 
+  One XOAuth can sign strings for every user of a domain, from any number of
+  threads. Every call signs a new string, with a new nonce, unless it passes
+  a max_age: a string signed for the same user at most that many seconds
+  ago, and never more than XOAUTH_STRING_CACHE_LIFETIME, is then returned
+  again instead.
 
 Licensed under the Apache License, Version 2.0 (the "License");
 you may not use this file except in compliance with the License.
@@ -45,9 +50,19 @@ import base64
 import hashlib
 import hmac
 import random
+import threading
 import time
 import urllib
 
+# Signed strings are used for up to this many seconds, well within the few
+# minutes for which Google accepts them
+XOAUTH_STRING_CACHE_LIFETIME = 180
+
+# The most signed strings kept, about 20MB; expired ones are dropped beyond
+# this, and if that isn't enough the cache starts over
+XOAUTH_STRING_CACHE_SIZE = 50000
+
+
 class XOAuth(object):
   """A wrapper of functions and data required to establish an XOAuth token."""
 
@@ -60,72 +75,54 @@ class XOAuth(object):
     self.key = key
     self.secret = secret
 
-  def _EscapeAndJoin(self, elems):
-    return '&'.join([self._UrlEscape(x) for x in elems])
-
-  def _FormatUrlParams(self, params):
-    """Formats parameters into a URL query string.
+    # Everything that doesn't depend on the requestor is computed once. The
+    # HMAC object is keyed but never updated; each signature uses a copy.
+    self.escaped_key = self._UrlEscape(key)
+    self.hmac = hmac.new(self._EscapeAndJoin([secret, '']),
+                         digestmod=hashlib.sha1)
 
-    Args:
-      params: A key-value map.
+    self.cache = {}
+    self.lock = threading.Lock()
 
-    Returns:
-      A URL query string version of the given parameters.
-    """
-    param_fragments = []
-    for param in sorted(params.iteritems(), key=lambda x: x[0]):
-      param_fragments.append('%s=%s' % (param[0], self._UrlEscape(param[1])))
-
-    return '&'.join(param_fragments)
+  def _EscapeAndJoin(self, elems):
+    return '&'.join([self._UrlEscape(x) for x in elems])
 
   def _UrlEscape(self, text):
     # See OAUTH 5.1 for a definition of which characters need to be escaped.
     return urllib.quote(text, safe='~-._')
 
-  def _GenerateOauthSignature(self, base_string, consumer_secret,
-                              token_secret=''):
-    key = self._EscapeAndJoin([consumer_secret, token_secret])
-
-    return self._GenerateHmacSha1Signature(base_string, key)
-
-  def _GenerateHmacSha1Signature(self, text, key):
-    digest = hmac.new(key, text, hashlib.sha1)
-
-    return base64.b64encode(digest.digest())
+  def _Sign(self, xoauth_requestor_id, method, protocol):
+    """Signs a new XOAUTH string.
 
-  def _GenerateSignatureBaseString(self, method, request_url_base, params):
-    """Generates an OAuth signature base string.
-
-    Args:
-      method: The HTTP request method, e.g. "GET".
-      request_url_base: The base of the requested URL. For example, if the
-        requested URL is
-        "https://mail.google.com/mail/b/xxx@domain.com/imap/?" +
-        "xoauth_requestor_id=xxx@domain.com", the request_url_base would be
-        "https://mail.google.com/mail/b/xxx@domain.com/imap/".
-      params: Key-value map of OAuth parameters, plus any parameters from the
-        request URL.
-
-    Returns:
-      A signature base string prepared according to the OAuth Spec.
-    """
-    return self._EscapeAndJoin([method, request_url_base,
-                               self._FormatUrlParams(params)])
-
-  def _FillInCommonOauthParams(self, params):
-    """Fills in parameters that are common to all oauth requests.
-
-    Args:
-      params: Parameter map, which will be added to.
+    The OAuth parameters are always the same six, so their sorted order is
+    written out rather than sorted on every call.
     """
+    escaped_requestor_id = self._UrlEscape(xoauth_requestor_id)
+    nonce = str(random.getrandbits(64))
+    timestamp = str(int(time.time()))
 
-    params['oauth_consumer_key'] = self.key
-    params['oauth_nonce'] = str(random.randrange(2**64 - 1))
-    params['oauth_signature_method'] = 'HMAC-SHA1'
-    params['oauth_version'] = '1.0'
-    params['oauth_timestamp'] = str(int(time.time()))
-
-  def GetXOAuthString(self, xoauth_requestor_id, method, protocol):
+    request_url_base = ('https://mail.google.com/mail/b/%s/%s/' % (
+                        xoauth_requestor_id, protocol))
+    params = ('oauth_consumer_key=%s&oauth_nonce=%s&'
+              'oauth_signature_method=HMAC-SHA1&oauth_timestamp=%s&'
+              'oauth_version=1.0&xoauth_requestor_id=%s' % (
+                  self.escaped_key, nonce, timestamp, escaped_requestor_id))
+    base_string = self._EscapeAndJoin([method, request_url_base, params])
+
+    digest = self.hmac.copy()
+    digest.update(base_string)
+    signature = base64.b64encode(digest.digest())
+
+    return ('%s %s?xoauth_requestor_id=%s oauth_consumer_key="%s",'
+            'oauth_nonce="%s",oauth_signature="%s",'
+            'oauth_signature_method="HMAC-SHA1",oauth_timestamp="%s",'
+            'oauth_version="1.0"' % (
+                method, request_url_base, escaped_requestor_id,
+                self.escaped_key, nonce, self._UrlEscape(signature),
+                timestamp))
+
+  def GetXOAuthString(self, xoauth_requestor_id, method, protocol,
+                      max_age=0):
     """Generates an IMAP XOAUTH authentication string.
 
     Args:
@@ -133,37 +130,38 @@ class XOAuth(object):
                            searched (full email address)
       method: The HTTP method used in the API request
       protocol: The protocol used in the API request
+      max_age: The age in seconds up to which a previously signed string
+               may be returned instead of a new one, capped at
+               XOAUTH_STRING_CACHE_LIFETIME; 0 always signs a new one
 
     Returns:
       A string that can be passed as the argument to an IMAP
       "AUTHENTICATE XOAUTH" command after being base64-encoded.
     """
-    url_params = {}
-    url_params['xoauth_requestor_id'] = xoauth_requestor_id
-    oauth_params = {}
-    self._FillInCommonOauthParams(oauth_params)
-
-    signed_params = oauth_params.copy()
-    signed_params.update(url_params)
-    request_url_base = ('https://mail.google.com/mail/b/%s/%s/' % (
-                        xoauth_requestor_id, protocol))
-    base_string = self._GenerateSignatureBaseString(method, request_url_base,
-                                                    signed_params)
-
-    oauth_params['oauth_signature'] = self._GenerateOauthSignature(base_string,
-        self.secret)
-
-    # Build list of oauth parameters
-    formatted_params = []
-    for k, v in sorted(oauth_params.iteritems()):
-      formatted_params.append('%s="%s"' % (k, self._UrlEscape(v)))
-    param_list = ','.join(formatted_params)
-
-    # Append URL parameters to request url, if present
-    if url_params:
-      request_url = '%s?%s' % (request_url_base,
-                               self._FormatUrlParams(url_params))
-    else:
-      request_url = request_url_base
-
-    return '%s %s %s' % (method, request_url, param_list)
+    key = (xoauth_requestor_id, method, protocol)
+    now = time.time()
+
+    self.lock.acquire()
+    try:
+      cached = self.cache.get(key)
+    finally:
+      self.lock.release()
+    if cached and now - cached[0] < min(max_age,
+                                        XOAUTH_STRING_CACHE_LIFETIME):
+      return cached[1]
+
+    xoauth_string = self._Sign(xoauth_requestor_id, method, protocol)
+
+    self.lock.acquire()
+    try:
+      if len(self.cache) >= XOAUTH_STRING_CACHE_SIZE:
+        for (cached_key, (signed, unused)) in self.cache.items():
+          if now - signed >= XOAUTH_STRING_CACHE_LIFETIME:
+            del self.cache[cached_key]
+        if len(self.cache) >= XOAUTH_STRING_CACHE_SIZE:
+          self.cache.clear()
+      self.cache[key] = (now, xoauth_string)
+    finally:
+      self.lock.release()
+
+    return xoauth_string
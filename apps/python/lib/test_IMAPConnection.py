@@ -0,0 +1,126 @@
+#!/usr/bin/python
+#
+# Copyright 2013 Google Inc. All Rights Reserved.
+"""
+Tests for the response parsing and UID set helpers of IMAPConnection.py.
+
+Usage:
+  cd apps/python/lib
+  python test_IMAPConnection.py
+
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+###########################################################################
+DISCLAIMER:
+
+(i) GOOGLE INC. ("GOOGLE") PROVIDES YOU ALL CODE HEREIN "AS IS" WITHOUT ANY
+WARRANTIES OF ANY KIND, EXPRESS, IMPLIED, STATUTORY OR OTHERWISE, INCLUDING,
+WITHOUT LIMITATION, ANY IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A
+PARTICULAR PURPOSE AND NON-INFRINGEMENT; AND
+
+(ii) IN NO EVENT WILL GOOGLE BE LIABLE FOR ANY LOST REVENUES, PROFIT OR DATA,
+OR ANY DIRECT, INDIRECT, SPECIAL, CONSEQUENTIAL, INCIDENTAL OR PUNITIVE
+DAMAGES, HOWEVER CAUSED AND REGARDLESS OF THE THEORY OF LIABILITY, EVEN IF
+GOOGLE HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH DAMAGES, ARISING OUT OF
+THE USE OR INABILITY TO USE, MODIFICATION OR DISTRIBUTION OF THIS CODE OR ITS
+DERIVATIVES.
+###########################################################################
+"""
+
+import imaplib
+import unittest
+
+from IMAPConnection import CompressUidSet
+from IMAPConnection import ParseFetchResponse
+
+
+class ParseFetchResponseTest(unittest.TestCase):
+
+  def Parse(self, data):
+    return list(ParseFetchResponse(data))
+
+  def testAtoms(self):
+    self.assertEqual([{'UID': '7', 'RFC822.SIZE': '1024'}],
+                     self.Parse(['1 (UID 7 RFC822.SIZE 1024)']))
+
+  def testNamesAreUpperCased(self):
+    self.assertEqual([{'UID': '7'}], self.Parse(['1 (uid 7)']))
+
+  def testLiteral(self):
+    header = 'Message-ID: <a@example.com>\r\n\r\n'
+    data = [('1 (UID 7 BODY[HEADER.FIELDS (MESSAGE-ID)] {%s}' % len(header),
+             header), ')']
+    self.assertEqual([{'UID': '7',
+                       'BODY[HEADER.FIELDS (MESSAGE-ID)]': header}],
+                     self.Parse(data))
+
+  def testLiteralsOfSeveralMessages(self):
+    data = [('1 (UID 7 RFC822 {3}', 'abc'), ')',
+            ('2 (UID 9 RFC822 {5}', '(x y)'), ')']
+    self.assertEqual([{'UID': '7', 'RFC822': 'abc'},
+                      {'UID': '9', 'RFC822': '(x y)'}],
+                     self.Parse(data))
+
+  def testQuotedEscapes(self):
+    data = [r'1 (UID 7 X-GM-LABELS ("a \"quoted\" label" "back\\slash"))']
+    self.assertEqual([{'UID': '7',
+                       'X-GM-LABELS': ['a "quoted" label', 'back\\slash']}],
+                     self.Parse(data))
+
+  def testQuotedParentheses(self):
+    self.assertEqual([{'X-GM-LABELS': ['(not a list)']}],
+                     self.Parse(['1 (X-GM-LABELS ("(not a list)"))']))
+
+  def testNestedLists(self):
+    data = [r'1 (UID 7 FLAGS (\Seen) X-GM-LABELS (a (b c) ()))']
+    self.assertEqual([{'UID': '7', 'FLAGS': ['\\Seen'],
+                       'X-GM-LABELS': ['a', ['b', 'c'], []]}],
+                     self.Parse(data))
+
+  def testNil(self):
+    self.assertEqual([{'UID': '7', 'BODY[TEXT]': None}],
+                     self.Parse(['1 (UID 7 BODY[TEXT] NIL)']))
+
+  def testNoneElementsAreIgnored(self):
+    self.assertEqual([], self.Parse([None]))
+
+  def testUnterminatedQuotedString(self):
+    self.assertRaises(imaplib.IMAP4.error, self.Parse,
+                      ['1 (UID 7 X-GM-LABELS ("unterminated)'])
+
+  def testTruncatedList(self):
+    self.assertRaises(imaplib.IMAP4.error, self.Parse, ['1 (UID 7 FLAGS (a'])
+
+  def testUnbalancedClose(self):
+    self.assertRaises(imaplib.IMAP4.error, self.Parse, ['1 )'])
+
+  def testMissingValue(self):
+    self.assertRaises(imaplib.IMAP4.error, self.Parse, ['1 (UID 7 FLAGS)'])
+
+  def testListAsName(self):
+    self.assertRaises(imaplib.IMAP4.error, self.Parse, ['1 ((UID) 7)'])
+
+
+class CompressUidSetTest(unittest.TestCase):
+
+  def testEmpty(self):
+    self.assertEqual('', CompressUidSet([]))
+
+  def testSingle(self):
+    self.assertEqual('5', CompressUidSet(['5']))
+
+  def testRangesAndSingles(self):
+    self.assertEqual('1:3,7,9:10',
+                     CompressUidSet(['1', '2', '3', '7', '9', '10']))
+
+  def testUnsortedDuplicatesAndIntegers(self):
+    self.assertEqual('1:3,10', CompressUidSet([3, '1', 10, '2', 3, '1']))
+
+
+if __name__ == '__main__':
+  unittest.main()